@@ -3,12 +3,16 @@ This is the client side of PyChat
 This is the sender part of the client
 """
 
+import collections
+import itertools
 import os
 import json
 import socket
+import threading
 import time
 import hashlib
 import struct
+import uuid
 
 try:
     from mylibs import *
@@ -17,6 +21,12 @@ except ImportError:
 
 DEFAULT_PORT = 233
 CLIENT_CREDENTIAL_FILE = 'credential.json'
+# Number of messages that may wait for their ack when the server acknowledges by message id
+SEND_WINDOW = 16
+# Seconds to wait for a reply before the connection is considered lost, then reconnect attempts (the wait doubles)
+REPLY_TIMEOUT = 30
+RECONNECT_ATTEMPTS = 5
+RECONNECT_BACKOFF = 1
 
 client_info = {
     'host': socket.gethostname(),
@@ -24,9 +34,13 @@ client_info = {
 }
 
 current_milli_time = lambda: int(round(time.time() * 1000))
+# client_msg_id of the messages sent, a message sent again with the same id is only stored once by the server
+# The prefix is new on every start, so a restarted client never reuses the id of a message it sent before
+client_msg_id_prefix = uuid.uuid4().hex
+client_msg_ids = itertools.count(1)
 
-if not os.path.exists('./MESSAGE_DUMP/'):
-    os.mkdir('./MESSAGE_DUMP')
+if not os.path.exists('./DOWNLOADS/'):
+    os.mkdir('./DOWNLOADS')
 
 # Ask the user about the server they need to connect to
 host = input('Input server name: ').strip()
@@ -48,48 +62,242 @@ if use_nickname:
     nickname = input('Input your nickname: ')
 client_info['nickname'] = nickname
 
-# Try to connect to the server
-try:
-    s = socket.socket()
-    s.connect((host, port))
-    server_data = json.loads(s.recv(1024).decode())
-    print(server_data)
-    s.send(json.dumps(client_info).encode())
-    if server_data['appid'] != client_info['appid']:
-        print('Not a PyChat Server!')
-        raise()
 
-    client_session_data = json.loads(s.recv(1024).decode())
+def load_credential_cache():
+    try:
+        with open(CLIENT_CREDENTIAL_FILE, 'r') as load_file:
+            credential_cache = json.load(load_file)
+    except (OSError, ValueError):
+        return {}
+    return credential_cache if isinstance(credential_cache, dict) else {}
+
+
+def save_credential_cache(credential_cache):
+    """Save the credential cache, a crash while saving keeps the old file"""
+
+    temp_file_name = CLIENT_CREDENTIAL_FILE + '.tmp'
+    with open(temp_file_name, 'w') as dump_file:
+        json.dump(credential_cache, dump_file)
+    os.replace(temp_file_name, CLIENT_CREDENTIAL_FILE)
+
 
+def connect():
+    """Connect to the server and register the sender
+
+    The identity of the credential cache is resumed if it is one of this server, so the client id stays the same
+    and the messages sent again after a reconnect are only stored once
+
+    Returns:
+        Method returns a tuple (socket, credential, server_data), raises OSError or ValueError if it fails
+    """
+
+    new_socket = socket.create_connection((host, port))
     try:
-        if not client_session_data['success']:
-            print('Server rejected connection.')
-            raise()
-        client_credential = client_session_data['credential']
-    except Exception:
-        print('Connection not successful.')
-        s.close()
-        input()
-        exit()
-
-    new_data = {
-        'server': host, 
-        'port': server_data['portrcv'] - 1, 
-        'id': client_credential['id'], 
-        'code': client_credential['code']}
+        new_socket.settimeout(REPLY_TIMEOUT)
+        server_data = json.loads(new_socket.recv(1024).decode())
+        client_info.pop('ack', None)
+        client_info.pop('compression', None)
+        client_info.pop('resume', None)
+        # Use length-prefixed frames if the server supports them
+        if PROTOCOL_FRAME in server_data.get('protocols', []):
+            client_info['protocol'] = PROTOCOL_FRAME
+            # Pipeline messages if the server acknowledges them by message id
+            if ACK_ID in server_data.get('acks', []):
+                client_info['ack'] = ACK_ID
+            # Compress large messages if the server supports it
+            if COMPRESSION_DEFLATE_DICT in server_data.get('compressions', []):
+                client_info['compression'] = COMPRESSION_DEFLATE_DICT
+        else:
+            client_info['protocol'] = PROTOCOL_LEGACY
+        credential_cache = load_credential_cache()
+        if credential_cache.get('server') == host and credential_cache.get('port') == server_data['portrcv'] - 1 \
+                and 'id' in credential_cache:
+            client_info['resume'] = {'id': credential_cache['id'], 'code': credential_cache.get('code')}
+        new_socket.send(json.dumps(client_info).encode())
+        if server_data['appid'] != client_info['appid']:
+            raise ValueError('Not a PyChat Server!')
+        client_session_data = json.loads(new_socket.recv(1024).decode())
+        if not client_session_data.get('success'):
+            raise ValueError('Server rejected connection.')
+        credential = client_session_data['credential']
+    except (KeyError, TypeError) as e:
+        new_socket.close()
+        raise ValueError('invalid reply of the server ' + str(e))
+    except (OSError, ValueError):
+        new_socket.close()
+        raise
+    if credential_cache.get('id') != credential['id'] or 'resume' not in client_info:
+        # A new identity, the receiver starts over
+        credential_cache = {'server': host, 'port': server_data['portrcv'] - 1}
+    credential_cache['id'] = credential['id']
+    credential_cache['code'] = credential['code']
     # Dump credential to local cache file
-    with open(CLIENT_CREDENTIAL_FILE, 'w') as dump_file:
-        json.dump(new_data, dump_file)
-    print('Please save credential below to authenticate receiver...')
-    print('ID:')
-    print(client_credential['id'])
-    print('Access Code:')
-    print(client_credential['code'])
-
-except Exception:
+    save_credential_cache(credential_cache)
+    return new_socket, credential, server_data
+
+
+# Try to connect to the server
+try:
+    s, client_credential, server_data = connect()
+except (OSError, ValueError) as e:
+    print(e)
     print('Unable to connect ' + "'" + host + "'.")
-    s.close()
     exit()
+print(server_data)
+print('Please save credential below to authenticate receiver...')
+print('ID:')
+print(client_credential['id'])
+print('Access Code:')
+print(client_credential['code'])
+pipelined = client_info.get('ack') == ACK_ID
+
+
+def show_reply(reply):
+    print(reply)
+    print()
+
+
+# File names of the downloads asked for, by sha256
+downloads = {}
+
+
+def save_download(echo_header, body):
+    """Save a file sent for ##download, it is checked against its sha256 (the name it is stored under)"""
+
+    digest = echo_header['download']
+    name = os.path.basename(downloads.pop(digest, digest))
+    if hashlib.sha256(body).hexdigest() != digest:
+        print('CLIENT: FILE {} WAS NOT RECEIVED CORRECTLY'.format(digest))
+    else:
+        with open('./DOWNLOADS/' + name, 'wb') as download_file:
+            download_file.write(body)
+        print('CLIENT: FILE SAVED TO ./DOWNLOADS/' + name)
+    print()
+
+
+# Messages waiting for their reply when pipelined, (header, body, retry) in the order they were sent
+in_flight = collections.deque()
+in_flight_slots = threading.Semaphore(SEND_WINDOW)
+# Held to send, to take a reply off in_flight and to replace the connection, so a reconnect sends in_flight again
+# without a message being sent or acknowledged on the lost connection meanwhile
+connection_lock = threading.RLock()
+closing = False
+
+
+def is_retried(send_data, header):
+    """Check if a request is sent again after a reconnect
+
+    Only messages are stored once when they are sent again (see client_msg_id), commands would run twice
+    """
+
+    return not send_data.startswith('#') or 'upload' in header
+
+
+def reconnect(lost_socket):
+    """Connect again after the connection was lost, and send the messages in flight again with their client_msg_id
+
+    Returns:
+        Method returns False if the server cannot be reached
+    """
+
+    global s
+    with connection_lock:
+        if s is not lost_socket:
+            # Already reconnected by the other thread
+            return True
+        lost_socket.close()
+        print('CLIENT: CONNECTION LOST, RECONNECTING...')
+        if pipelined:
+            for request in [request for request in in_flight if not request[2]]:
+                in_flight.remove(request)
+                in_flight_slots.release()
+                print('CLIENT: COMMAND MAY NOT HAVE RUN: ' + request[1].decode(errors='replace')[:80])
+        backoff = RECONNECT_BACKOFF
+        for attempt in range(RECONNECT_ATTEMPTS):
+            try:
+                new_socket, credential, server_data = connect()
+                if credential['id'] != client_credential['id']:
+                    print('CLIENT: IDENTITY NOT RESUMED, MESSAGES SENT AGAIN MAY BE STORED TWICE')
+                    client_credential.update(credential)
+                if pipelined:
+                    for header, body, retry in in_flight:
+                        send_frame(new_socket, dict(header), body, client_info.get('compression'))
+                break
+            except (OSError, ValueError) as e:
+                print('CLIENT: ' + str(e))
+                time.sleep(backoff)
+                backoff *= 2
+        else:
+            print('Server disconnected.')
+            return False
+        s = new_socket
+        print('CLIENT: RECONNECTED')
+        print()
+        if pipelined:
+            threading.Thread(target=reply_reader, args=(s,), daemon=True).start()
+        return True
+
+
+def reply_reader(sock):
+    """Receive the replies of pipelined messages on a connection
+
+    The server replies in order, so every reply belongs to the oldest message in flight
+    """
+
+    while True:
+        try:
+            echo_header, reply_byte = recv_frame(sock)
+        except socket.timeout:
+            if not in_flight:
+                # Nothing to wait for
+                continue
+            if not closing:
+                reconnect(sock)
+            return
+        except (OSError, ValueError):
+            if not closing:
+                reconnect(sock)
+            return
+        with connection_lock:
+            if sock is not s:
+                # The messages in flight were sent again on the new connection
+                return
+            sent_header = in_flight.popleft()[0] if in_flight else None
+            in_flight_slots.release()
+        if 'ack' in echo_header:
+            if sent_header is not None and echo_header['ack'] != sent_header['sha256']:
+                print('CLIENT: MESSAGE #{} WAS NOT RECEIVED CORRECTLY'.format(echo_header['message_id']))
+                print()
+            continue
+        if 'download' in echo_header:
+            save_download(echo_header, reply_byte)
+            continue
+        show_reply(reply_byte.decode())
+
+
+def exchange(header, send_body):
+    """Send a request and wait for its reply, when not pipelined
+
+    Returns:
+        Method returns a tuple (echo_header, reply_byte), raises OSError or ValueError if the connection is lost
+    """
+
+    if client_info['protocol'] == PROTOCOL_FRAME:
+        send_frame(s, dict(header), send_body, client_info.get('compression'))
+        return recv_frame(s)
+    s.send(json.dumps(header).encode())
+    header_size = s.recv(1024).decode()
+    s.send(send_body)
+
+    # Get echo header
+    echo_header_byte = s.recv(1024).decode()
+    echo_header = json.loads(echo_header_byte)
+    s.send(str(len(echo_header)).encode())
+    return echo_header, recv_exact(s, echo_header['size'])
+
+
+if pipelined:
+    threading.Thread(target=reply_reader, args=(s,), daemon=True).start()
 
 print('')
 # Create a loop to send messages to the server
@@ -104,7 +312,16 @@ while True:
             send_fmt = send_data[1:].lower()
             if send_fmt == 'exit':
                 if confirm('Exit client'):
-                    s.send('##EXIT'.encode())
+                    if pipelined:
+                        # Wait for the replies of the messages in flight
+                        for i in range(SEND_WINDOW):
+                            in_flight_slots.acquire(timeout=5)
+                    closing = True
+                    if client_info['protocol'] == PROTOCOL_FRAME:
+                        exit_data = '##EXIT'.encode()
+                        send_frame(s, {'time': current_milli_time(), 'size': len(exit_data), 'sha256': hashlib.sha256(exit_data).hexdigest()}, exit_data)
+                    else:
+                        s.send('##EXIT'.encode())
                     s.close()
                     break
                 else:
@@ -112,36 +329,81 @@ while True:
                     print()
                     continue
             elif send_fmt == 'recv':
-                print(s.recv(4096).decode())
+                if pipelined:
+                    print('CLIENT: REPLIES ARE PRINTED AS THEY ARRIVE')
+                else:
+                    try:
+                        if client_info['protocol'] == PROTOCOL_FRAME:
+                            print(recv_frame(s)[1].decode())
+                        else:
+                            print(s.recv(4096).decode())
+                    except socket.timeout:
+                        print('CLIENT: NOTHING RECEIVED')
                 print()
             else:
                 print('CLIENT: INVALID COMMAND')
                 print()
                 continue
-        header['size'] = len(send_data.encode())
-        header['sha256'] = hashlib.sha256(send_data.encode()).hexdigest()
-        s.send(json.dumps(header).encode())
-        header_size = s.recv(1024).decode()
-        s.send(send_data.encode())
-
-        # Get echo header
-        echo_header_byte = s.recv(1024).decode()
-        echo_header = json.loads(echo_header_byte)
-        s.send(str(len(echo_header)).encode())
-        reply = s.recv(echo_header['size']).decode()
+        send_body = send_data.encode()
+        send_cmd = send_data.split()
+        if send_cmd[0].lower() == '##upload' and len(send_cmd) > 1:
+            # The file is the body, the server stores it under its sha256 and sends a reference to it
+            upload_path = send_data.strip()[len('##upload'):].strip()
+            try:
+                with open(upload_path, 'rb') as upload_file:
+                    send_body = upload_file.read()
+            except OSError as e:
+                print('CLIENT: ' + str(e))
+                print()
+                continue
+            header['upload'] = os.path.basename(upload_path)
+        elif send_cmd[0].lower() == '##download' and len(send_cmd) > 2:
+            # ##download <sha256> <file name>, the name is only used here
+            downloads[send_cmd[1].lower()] = send_cmd[2]
+        header['size'] = len(send_body)
+        header['sha256'] = hashlib.sha256(send_body).hexdigest()
+        # Kept when the message is sent again after a reconnect
+        header['client_msg_id'] = '{}-{}'.format(client_msg_id_prefix, next(client_msg_ids))
+        retry = is_retried(send_data, header)
+        if pipelined:
+            # Wait for a free slot in the window, the reply is handled by reply_reader
+            in_flight_slots.acquire()
+            with connection_lock:
+                in_flight.append((header, send_body, retry))
+                try:
+                    send_frame(s, dict(header), send_body, client_info.get('compression'))
+                except OSError:
+                    # Sent again by reconnect if it is a message
+                    if not reconnect(s):
+                        break
+            continue
+        while True:
+            try:
+                echo_header, reply_byte = exchange(header, send_body)
+                break
+            except (OSError, ValueError):
+                lost_socket = s
+                if not reconnect(lost_socket):
+                    echo_header = None
+                    break
+                if not retry:
+                    print('CLIENT: COMMAND MAY NOT HAVE RUN: ' + send_data[:80])
+                    echo_header = {}
+                    break
+        if echo_header is None:
+            break
+        if not echo_header:
+            continue
+        if 'download' in echo_header:
+            save_download(echo_header, reply_byte)
+            continue
+        reply = reply_byte.decode()
         '''
         If the message returned from the server does not match the one sent,
          print the message returned by the server.
         '''
         if reply != send_data:
-            if echo_header['size'] > 10240:
-                message_dump_file = './MESSAGE_DUMP/MESSAGE_DUMP_' + str(echo_header['message_id']) + '_' + str(current_milli_time()) + '.txt'
-                with open(message_dump_file, 'w') as dump_file:
-                    dump_file.write(reply)
-                print('Receved message too long, dumped to ' + message_dump_file)
-            else:
-                print(reply)
-            print()
+            show_reply(reply)
 
     except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
         print('Server disconnected.')
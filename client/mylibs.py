@@ -1,3 +1,7 @@
+import json
+import struct
+import zlib
+
 
 def confirm(prompt, default=False):
     """Get confirmation from the console
@@ -20,3 +24,122 @@ def confirm(prompt, default=False):
         return False
     else:
         return default
+
+
+PROTOCOL_LEGACY = 'legacy'
+PROTOCOL_FRAME = 'frame'
+ACK_ECHO = 'echo'
+ACK_ID = 'id'
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSION_DEFLATE_DICT = 'deflate-dict'
+# Bodies smaller than this are sent as they are
+COMPRESSION_THRESHOLD = 256
+# Preset dictionary of 'deflate-dict', the same bytes as in the server (framing.py)
+DEFLATE_DICTIONARY = (
+    b'https://www.http://.com/.org/.html?id=[]{}null, true, false, "message": "name": "id": "code": '
+    b'SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATERINVALID COMMANDCLIENT NOT FOUNDDisconnectedConnected'
+    b'Traceback (most recent call last):\n  File "line , in Error: Exception WARNING INFO DEBUG '
+    b'what when where which there their have this that with from your you the and for are not '
+    b'SEARCH:\n[HISTORY:\n[RES:\n(<SERVER> [#0]: <DM> ]: [#'
+)
+FRAME_PREFIX = struct.Struct('!II')
+
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes from a socket
+
+    Args:
+        :param sock: socket object
+        :param size: number of bytes to receive
+    Returns:
+        Method returns a bytearray
+
+    """
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionResetError('connection closed')
+        received += count
+    return buffer
+
+
+def compress_body(header, body, compression):
+    """Compress the body of a frame if it is large enough and shrinks, header['encoding'] is set if it is compressed
+
+    Args:
+        :param header: dict
+        :param body: bytes
+        :param compression: compression picked in client_info, None for no compression
+    Returns:
+        Method returns the body to send
+
+    """
+
+    if compression is None or len(body) < COMPRESSION_THRESHOLD:
+        return body
+    compressor = zlib.compressobj(zdict=DEFLATE_DICTIONARY) if compression == COMPRESSION_DEFLATE_DICT else zlib.compressobj()
+    compressed = compressor.compress(body) + compressor.flush()
+    if len(compressed) >= len(body):
+        return body
+    header['encoding'] = compression
+    return compressed
+
+
+def decompress_body(header, body):
+    """Decompress the body of a frame, if header['encoding'] is set
+
+    Args:
+        :param header: dict, header['size'] is the size of the decompressed body
+        :param body: bytes
+    Returns:
+        Method returns the decompressed body
+
+    """
+
+    if 'encoding' not in header:
+        return body
+    if header['encoding'] == COMPRESSION_DEFLATE_DICT:
+        decompressor = zlib.decompressobj(zdict=DEFLATE_DICTIONARY)
+    else:
+        decompressor = zlib.decompressobj()
+    # Never more than the size in the header
+    data = decompressor.decompress(body, header['size'] + 1)
+    if len(data) != header['size'] or not decompressor.eof:
+        raise ValueError('invalid compressed body')
+    return data
+
+
+def send_frame(sock, header, body=b'', compression=None):
+    """Send a length-prefixed frame (header JSON and body in one write)
+
+    Args:
+        :param sock: socket object
+        :param header: dict, with the size and the sha256 of the body
+        :param body: bytes
+        :param compression: compression picked in client_info, None for no compression
+
+    """
+
+    body = compress_body(header, body, compression)
+    header_byte = json.dumps(header).encode()
+    sock.sendall(FRAME_PREFIX.pack(len(header_byte), len(body)) + header_byte + body)
+
+
+def recv_frame(sock):
+    """Receive a length-prefixed frame
+
+    Args:
+        :param sock: socket object
+    Returns:
+        Method returns a tuple (header, body)
+
+    """
+
+    header_size, body_size = FRAME_PREFIX.unpack(recv_exact(sock, FRAME_PREFIX.size))
+    header = json.loads(recv_exact(sock, header_size).decode())
+    body = decompress_body(header, bytes(recv_exact(sock, body_size)))
+    return header, body
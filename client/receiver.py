@@ -3,9 +3,12 @@ This is the client side of PyChat
 This is the receiver part of the client
 """
 
+import atexit
+import os
 import sys
 import socket
 import json
+import time
 
 try:
     from mylibs import *
@@ -15,6 +18,10 @@ except ImportError:
 
 DEFAULT_PORT = 233
 CLIENT_CREDENTIAL_FILE = 'credential.json'
+# The last message id is saved to the credential cache at most once per SAVE_INTERVAL seconds or
+# SAVE_MESSAGES messages, and on exit
+SAVE_INTERVAL = 5
+SAVE_MESSAGES = 100
 
 client_info = {
     'host': socket.gethostname(),
@@ -26,6 +33,9 @@ s = socket.socket()
 # Try to load credential from cache
 client_id = ''
 credential_code = ''
+load_credential = {}
+# Id of the last message received, the server sends the messages after it on reconnect
+last_message_id = None
 try:
     with open(CLIENT_CREDENTIAL_FILE, 'r') as load_f:
         load_credential = json.load(load_f)
@@ -37,7 +47,9 @@ except:
     pass
 finally:
     # If a cached credential found, ask if user want use it
-    if client_id == '' or not confirm('Use cached credential', True):
+    if client_id != '' and confirm('Use cached credential', True):
+        last_message_id = load_credential.get('last_message_id')
+    else:
         # Ask the user about the server they need to connect to
         host = input('Input server name: ').strip()
         if host == '':
@@ -55,12 +67,46 @@ finally:
 
 print()
 
+# Messages received since the credential cache was saved, and when it was
+unsaved_messages = 0
+saved_time = time.monotonic()
+
+
+def save_credential():
+    """Save the credential cache with the last message id, a crash while saving keeps the old file"""
+
+    global unsaved_messages, saved_time
+    if not unsaved_messages:
+        return
+    unsaved_messages = 0
+    saved_time = time.monotonic()
+    temp_file_name = CLIENT_CREDENTIAL_FILE + '.tmp'
+    try:
+        with open(temp_file_name, 'w') as dump_file:
+            json.dump(load_credential, dump_file)
+        os.replace(temp_file_name, CLIENT_CREDENTIAL_FILE)
+    except OSError as e:
+        print(e)
+
+
+atexit.register(save_credential)
+
 # Send credential to server
 try:
     s.connect((host, rx_port))
     server_data = json.loads(s.recv(1024).decode())
     client_info['id'] = client_id
     client_info['code'] = credential_code
+    if last_message_id is not None:
+        client_info['since_id'] = last_message_id
+    # Use length-prefixed frames if the server supports them
+    if PROTOCOL_FRAME in server_data.get('protocols', []):
+        client_info['protocol'] = PROTOCOL_FRAME
+        # Large messages are compressed if the server supports it
+        if COMPRESSION_DEFLATE_DICT in server_data.get('compressions', []):
+            client_info['compression'] = COMPRESSION_DEFLATE_DICT
+    else:
+        client_info['protocol'] = PROTOCOL_LEGACY
     s.send(json.dumps(client_info).encode())
     if server_data['appid'] != client_info['appid']:
         print('Not a PyChat Server!')
@@ -72,14 +118,24 @@ except ConnectionRefusedError:
 # Create a loop to continuously receive messages from the server
 while True:
     try:
-        rx_header_byte = s.recv(1024).decode()
-        echo_header = json.loads(rx_header_byte)
-        s.send(str(len(echo_header)).encode())
-        rx_data = s.recv(echo_header['size']).decode()
+        if client_info['protocol'] == PROTOCOL_FRAME:
+            echo_header, rx_data_byte = recv_frame(s)
+            rx_data = rx_data_byte.decode()
+        else:
+            rx_header_byte = s.recv(1024).decode()
+            echo_header = json.loads(rx_header_byte)
+            s.send(str(len(echo_header)).encode())
+            rx_data = recv_exact(s, echo_header['size']).decode()
         if rx_data == '':
             s.send('RX ACTIVE'.encode())
             continue
         print(rx_data)
+        if 'message_id' in echo_header and load_credential.get('id') == client_id:
+            # Remember the last message in the credential cache
+            load_credential['last_message_id'] = echo_header['message_id']
+            unsaved_messages += 1
+            if unsaved_messages >= SAVE_MESSAGES or time.monotonic() - saved_time >= SAVE_INTERVAL:
+                save_credential()
     except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
         print('Server disconnected.')
         s.close()
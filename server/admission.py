@@ -0,0 +1,97 @@
+"""
+Admission control of PyChat
+
+An accept loop asks the controller before it serves a connection. A connection is refused when
+max_connections connections of the listener are open, when its address already has max_per_ip of them,
+or when the listener is holding back more than accept_burst connections because they arrive faster than
+accept_rate per second.
+
+The accept rate is controlled by a Holder (the hold time grows while connections arrive faster than the rate and
+shrinks while they do not), but the controller never sleeps: every admitted connection moves the time the listener
+holds until by the hold time, a connection that would have to be held for longer than the burst allows is
+refused at once, so the accept loop keeps draining the backlog instead of letting it overflow.
+
+The counters are shared by every process forked after the controller is created,
+the open connections are counted by the process running the accept loop.
+"""
+
+import multiprocessing
+import time
+
+try:
+    from holder import Holder
+except ImportError:
+    from .holder import Holder
+
+REASON_CONNECTIONS = 'SERVER FULL'
+REASON_PER_IP = 'TOO MANY CONNECTIONS'
+REASON_RATE = 'SERVER BUSY'
+
+COUNTERS = ['accepted', 'refused_full', 'refused_ip', 'refused_rate']
+
+
+class AdmissionController(object):
+    def __init__(self, max_connections=1024, max_per_ip=64, accept_rate=100.0, accept_burst=32):
+        """
+        Args:
+            :param max_connections: int, open connections of the listener, 0 for no limit
+            :param max_per_ip: int, open connections of one address, 0 for no limit
+            :param accept_rate: float, connections accepted per second, 0 for no limit
+            :param accept_burst: int, connections accepted at once above the rate
+        """
+
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        if accept_rate > 0:
+            self.holder = Holder(0, accept_rate, 0.1 / accept_rate, 0.05 / accept_rate)
+        else:
+            self.holder = None
+        self.tolerance = accept_burst / accept_rate if accept_rate > 0 else 0
+        self.hold_until = 0
+        self.connections = 0
+        # Open connections by address
+        self.addresses = {}
+        self.counters = {name: multiprocessing.Value('q', 0) for name in COUNTERS}
+
+    def admit(self, address):
+        """Admit a connection
+
+        Args:
+            :param address: str, the IP address of the peer
+        Returns:
+            Method returns None if the connection is admitted, or the reason it is refused (str)
+
+            An admitted connection has to be released when it is closed
+        """
+
+        if self.max_connections and self.connections >= self.max_connections:
+            self.count('refused_full')
+            return REASON_CONNECTIONS
+        if self.max_per_ip and self.addresses.get(address, 0) >= self.max_per_ip:
+            self.count('refused_ip')
+            return REASON_PER_IP
+        if self.holder is not None:
+            now = time.monotonic()
+            if self.hold_until - now > self.tolerance:
+                self.count('refused_rate')
+                return REASON_RATE
+            self.hold_until = max(self.hold_until, now) + self.holder.hold()
+        self.connections += 1
+        self.addresses[address] = self.addresses.get(address, 0) + 1
+        self.count('accepted')
+        return None
+
+    def release(self, address):
+        self.connections -= 1
+        if self.addresses.get(address, 0) <= 1:
+            self.addresses.pop(address, None)
+        else:
+            self.addresses[address] -= 1
+
+    def count(self, name):
+        counter = self.counters[name]
+        with counter.get_lock():
+            counter.value += 1
+
+    def stats(self):
+        return {name: counter.value for name, counter in self.counters.items()}
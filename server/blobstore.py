@@ -0,0 +1,101 @@
+"""
+Blob store of PyChat
+
+Attachments and the bodies of large messages are files named by the sha256 of their content,
+so identical content is stored once, and a message only keeps the sha256.
+
+A blob is received into a spool file of the store and committed under its sha256 once it is complete and checked,
+the file of a blob never changes after that, so it can be sent with sendfile while another copy is committed.
+"""
+
+import json
+import os
+import tempfile
+
+DIGEST_CHARS = frozenset('0123456789abcdef')
+
+
+def is_digest(digest):
+    """Check that a str is a sha256 (64 lowercase hex digits), the only names of blobs"""
+
+    return isinstance(digest, str) and len(digest) == 64 and DIGEST_CHARS.issuperset(digest)
+
+
+def message_blob(message_header):
+    """Get the sha256 of the blob of a message from its header (or its meta), None if it has none
+
+    The blob is an attachment ('attachment' of the header, see finish_body) or a large body ('file')
+    """
+
+    attachment = message_header.get('attachment')
+    digest = attachment.get('sha256') if isinstance(attachment, dict) else message_header.get('file')
+    return digest if is_digest(digest) else None
+
+
+def meta_blob(message_meta):
+    """Get the sha256 of the blob of a message from its meta (JSON), for the messages stored before the blob column"""
+
+    if not message_meta or ('"file"' not in message_meta and '"attachment"' not in message_meta):
+        return None
+    try:
+        load_meta = json.loads(message_meta)
+    except ValueError:
+        return None
+    return message_blob(load_meta) if isinstance(load_meta, dict) else None
+
+
+class BlobStore(object):
+    def __init__(self, directory):
+        """
+        Args:
+            :param directory: str, directory of the blobs
+        """
+
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, digest):
+        """Get the path of a blob, raises ValueError if digest is not a sha256"""
+
+        if not is_digest(digest):
+            raise ValueError('invalid sha256')
+        return os.path.join(self.directory, digest)
+
+    def exists(self, digest):
+        return is_digest(digest) and os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def spool(self):
+        """Get a new spool file, the content of a blob is written to it before it is committed"""
+
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix='.spool-', delete=False)
+
+    def commit(self, spool, digest):
+        """Store the content of a spool file as a blob
+
+        The spool file is removed, a blob already stored is kept as it is
+
+        Args:
+            :param spool: the file object returned by spool(), with the content of the blob
+            :param digest: str, sha256 of the content (hex), checked by the caller
+        Returns:
+            Method returns the path of the blob
+        """
+
+        path = self.path(digest)
+        spool.close()
+        if os.path.exists(path):
+            os.remove(spool.name)
+        else:
+            os.replace(spool.name, path)
+        return path
+
+    def discard(self, spool):
+        spool.close()
+        try:
+            os.remove(spool.name)
+        except OSError:
+            pass
@@ -0,0 +1,209 @@
+"""
+Message broker of PyChat
+
+Senders publish every message right after it is stored, the broker pushes it to all subscribers.
+Events are JSON objects, one per line, over a local Unix socket (TCP on platforms without AF_UNIX).
+
+    {"op": "subscribe"}                             sent once by a subscriber
+    {"op": "subscribe", "types": ["client"]}        subscribe to some event types only
+    {"op": "subscribe", "client_id": 1}             receive only the messages delivered to client 1,
+                                                    sent again to change the client of a subscription
+    {"op": "publish", "type": "message", ...}       sent by publishers, pushed to subscribers as is
+
+An event with "payload" (a size) is followed by that many raw bytes, pushed with it (see BrokerClient.publish).
+Message events carry "recipients", the ids of the clients the message is delivered to (null for everyone),
+so a DM is only pushed to its recipients and to the subscribers that did not pick a client.
+
+Event types:
+    message     a new message was stored
+    client      a client record changed, cached copies must be dropped (client_id is null for all clients)
+"""
+
+import json
+import os
+import queue
+import socket
+import threading
+
+try:
+    from log import Log, LogSink
+except ImportError:
+    from .log import Log, LogSink
+
+
+def listen_socket(address, backlog=128):
+    """Create the listening socket of the broker
+
+    Args:
+        :param address: str for a Unix socket path, [host, port] for TCP
+        :param backlog: int, listen backlog
+    """
+
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(address)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(tuple(address))
+    s.listen(backlog)
+    return s
+
+
+def connect_socket(address):
+    """Connect to the broker
+
+    Args:
+        :param address: str for a Unix socket path, [host, port] for TCP
+    """
+
+    if isinstance(address, str):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(address)
+    else:
+        s = socket.create_connection(tuple(address))
+    return s
+
+
+def encode_event(event, payload=None):
+    if payload is None:
+        return (json.dumps(event) + '\n').encode()
+    event = dict(event)
+    event['payload'] = len(payload)
+    return (json.dumps(event) + '\n').encode() + payload
+
+
+def read_payload(file, event):
+    """Read the raw bytes following an event with "payload" from a file object of the connection"""
+
+    if 'payload' not in event:
+        return b''
+    payload = file.read(event['payload'])
+    if len(payload) != event['payload']:
+        raise ConnectionResetError('broker disconnected')
+    return payload
+
+
+class Broker(object):
+    def __init__(self, listener, max_pending=10000, log=None):
+        self.listener = listener
+        self.max_pending = max_pending
+        self.log = log if log is not None else Log(LogSink())
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        while True:
+            try:
+                cnn, addr = self.listener.accept()
+                threading.Thread(target=self.handle, args=(cnn,), daemon=True).start()
+            except OSError as e:
+                self.log.error('BROKER', error=e)
+
+    def handle(self, cnn):
+        """Read events from one connection until it is closed"""
+
+        cnn_file = cnn.makefile('rb')
+        try:
+            for line in cnn_file:
+                event = json.loads(line)
+                if event['op'] == 'subscribe':
+                    self.subscribe(cnn, event.get('types'), event.get('client_id'))
+                elif event['op'] == 'publish':
+                    self.fan_out(line + read_payload(cnn_file, event), event.get('type'), event.get('recipients'))
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.unsubscribe(cnn)
+            cnn.close()
+
+    def subscribe(self, cnn, types=None, client_id=None):
+        with self.lock:
+            if cnn in self.subscribers:
+                # Change the filter of the subscription
+                self.subscribers[cnn] = (self.subscribers[cnn][0], types, client_id)
+                return
+            # Every subscriber gets its own queue and writer thread, so a slow one never stalls the others
+            pending = queue.Queue(self.max_pending)
+            self.subscribers[cnn] = (pending, types, client_id)
+        threading.Thread(target=self.writer, args=(cnn, pending), daemon=True).start()
+
+    def unsubscribe(self, cnn):
+        with self.lock:
+            pending, types, client_id = self.subscribers.pop(cnn, (None, None, None))
+        if pending is not None:
+            try:
+                pending.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def writer(self, cnn, pending):
+        while True:
+            line = pending.get()
+            if line is None:
+                return
+            try:
+                cnn.sendall(line)
+            except OSError:
+                self.unsubscribe(cnn)
+                return
+
+    def fan_out(self, line, event_type=None, recipients=None):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for cnn, (pending, types, client_id) in subscribers:
+            if types is not None and event_type not in types:
+                continue
+            if recipients is not None and client_id is not None and client_id not in recipients:
+                continue
+            try:
+                pending.put_nowait(line)
+            except queue.Full:
+                # The subscriber is too far behind, drop it
+                self.log.warning('BROKER SUBSCRIBER DROPPED (QUEUE FULL)')
+                self.unsubscribe(cnn)
+                try:
+                    cnn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class BrokerClient(object):
+    def __init__(self, address, subscribe=False, types=None, client_id=None):
+        self.socket = connect_socket(address)
+        self.file = self.socket.makefile('rb')
+        self.lock = threading.Lock()
+        if subscribe:
+            self.subscribe(types, client_id)
+
+    def subscribe(self, types=None, client_id=None):
+        event = {'op': 'subscribe'}
+        if types is not None:
+            event['types'] = types
+        if client_id is not None:
+            event['client_id'] = client_id
+        with self.lock:
+            self.socket.sendall(encode_event(event))
+
+    def publish(self, event, payload=None):
+        """Publish an event, payload (bytes) is sent raw after it and received as event['payload']"""
+
+        event = dict(event)
+        event['op'] = 'publish'
+        with self.lock:
+            self.socket.sendall(encode_event(event, payload))
+
+    def recv(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionResetError('broker disconnected')
+        event = json.loads(line)
+        if 'payload' in event:
+            event['payload'] = read_payload(self.file, event)
+        return event
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
@@ -0,0 +1,145 @@
+"""
+Shared client table of PyChat
+
+A fixed size hash table in shared memory, keyed by client id, holding the state every handler checks per message.
+It is created by the main process before any worker is forked, so all processes map the same memory.
+
+    +--------------+-------------+-----------------+-------+------------------+-----------------+-----------+
+    | epoch uint32 | valid uint8 | name size uint8 | 2 pad | mute_until int64 | client_id int64 | name 64 B |
+    +--------------+-------------+-----------------+-------+------------------+-----------------+-----------+
+
+A client is looked up from slot client_id % capacity onwards (linear probing) until its slot, a slot never written,
+or MAX_PROBES slots.
+Client ids are never reused, so a slot is reused instead: the slot of a client that is no longer valid (it
+disconnected or was kicked) is given to the next client that needs one. A client without a slot (the table is
+full, or it is not valid) is not in the table, its state is read from the database.
+
+Slots are written under a lock and read without one, seqlock style:
+the writer makes the epoch odd while it updates a slot, a reader retries until it sees the same even epoch
+before and after reading. Epoch 0 means the slot was never written.
+"""
+
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+SLOT = struct.Struct('=IBB2xqq64s')
+EPOCH = struct.Struct('=I')
+NAME_SIZE = 64
+# The name does not fit in the slot (or is NULL), the name of the database record is used
+NAME_NOT_STORED = 0xFF
+NO_MUTE = -1
+# Slots probed for a client, a client finding no slot in them is not in the table
+MAX_PROBES = 64
+
+
+class ClientTable(object):
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.memory = shared_memory.SharedMemory(create=True, size=capacity * SLOT.size)
+        self.buffer = self.memory.buf
+        self.buffer[:capacity * SLOT.size] = bytes(capacity * SLOT.size)
+        self.lock = multiprocessing.RLock()
+
+    def read_slot(self, index):
+        """Read a slot consistently, returns (epoch, valid, name_size, mute_until, client_id, name)"""
+
+        offset = index * SLOT.size
+        while True:
+            slot = SLOT.unpack_from(self.buffer, offset)
+            if slot[0] == 0 or slot[0] % 2 == 0 and EPOCH.unpack_from(self.buffer, offset)[0] == slot[0]:
+                return slot
+
+    def find(self, client_id):
+        """Find the slot of a client
+
+        Returns:
+            Method returns a tuple (index, slot), index is None if the client is not in the table
+        """
+
+        for probe in range(min(MAX_PROBES, self.capacity)):
+            index = (client_id + probe) % self.capacity
+            slot = self.read_slot(index)
+            if slot[0] == 0:
+                break
+            if slot[4] == client_id:
+                return index, slot
+        return None, None
+
+    def read(self, client_id):
+        """Read the slot of a client
+
+        Args:
+            :param client_id: int, id of the client
+        Returns:
+            Method returns a tuple (valid, mute_until, name), or None if the client is not in the table
+
+            mute_until is None if the client was never muted, name is None if it is not stored in the table
+        """
+
+        if isinstance(client_id, bool) or not isinstance(client_id, int) or client_id <= 0:
+            return None
+        index, slot = self.find(client_id)
+        if index is None:
+            return None
+        epoch, valid, name_size, mute_until, client_id, name = slot
+        if mute_until == NO_MUTE:
+            mute_until = None
+        if name_size == NAME_NOT_STORED:
+            name = None
+        else:
+            name = name[:name_size].decode()
+        return valid, mute_until, name
+
+    def write(self, client_id, valid, mute_until, name):
+        """Write the slot of a client, a client that is not valid gives its slot back
+
+        Args:
+            :param client_id: int, id of the client
+            :param valid: int, the valid flag of the client
+            :param mute_until: int, the mute deadline in milliseconds, None if not muted
+            :param name: str, nickname of the client
+        """
+
+        if client_id <= 0:
+            return
+        name_byte = name.encode() if name is not None else b''
+        if name is None or len(name_byte) > NAME_SIZE:
+            name_size = NAME_NOT_STORED
+            name_byte = b''
+        else:
+            name_size = len(name_byte)
+        with self.lock:
+            index, slot = self.find(client_id)
+            if index is None:
+                if not valid:
+                    # Not in the table, the database has its state
+                    return
+                index = self.free_slot(client_id)
+                if index is None:
+                    # The table is full, the database has its state
+                    return
+            offset = index * SLOT.size
+            epoch = EPOCH.unpack_from(self.buffer, offset)[0]
+            EPOCH.pack_into(self.buffer, offset, epoch + 1)
+            SLOT.pack_into(self.buffer, offset, epoch + 1, 1 if valid else 0, name_size,
+                           NO_MUTE if mute_until is None else mute_until, client_id, name_byte)
+            EPOCH.pack_into(self.buffer, offset, epoch + 2)
+
+    def free_slot(self, client_id):
+        """Get the first slot a client can take, a slot never written or the slot of a client that is not valid
+
+        Call under the lock. A reused slot keeps its epoch, a reader of the old client reads it as another client.
+        """
+
+        for probe in range(min(MAX_PROBES, self.capacity)):
+            index = (client_id + probe) % self.capacity
+            epoch, valid = SLOT.unpack_from(self.buffer, index * SLOT.size)[:2]
+            if epoch == 0 or not valid:
+                return index
+        return None
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+        self.memory.unlink()
@@ -0,0 +1,67 @@
+"""
+Dedupe window of PyChat
+
+A sender may give a message a client_msg_id in its header, an id it never uses again.
+A message sent again with the same id (a retry after a timeout or a reconnect) is acknowledged with the id of the
+message already stored, instead of being stored and delivered twice.
+
+The client id a client_msg_id belongs to survives a reconnect, the client resumes its identity with its credential
+(see sender_register), so a retry on a new connection is found too.
+Every sender session keeps its last ids in an LRU, the older ones are looked up by a callable (the database).
+"""
+
+import collections
+
+# Longest client_msg_id accepted
+CLIENT_MSG_ID_MAX_LENGTH = 64
+
+
+def client_msg_id(message_header):
+    """Get the client_msg_id of a message as stored, None if the header has none (or an invalid one)"""
+
+    msg_id = message_header.get('client_msg_id')
+    if isinstance(msg_id, bool) or not isinstance(msg_id, (int, str)):
+        return None
+    msg_id = str(msg_id)
+    if not msg_id or len(msg_id) > CLIENT_MSG_ID_MAX_LENGTH:
+        return None
+    return msg_id
+
+
+class SentMessages(object):
+    def __init__(self, window, lookup=None):
+        """
+        Args:
+            :param window: int, ids remembered, 0 only uses lookup
+            :param lookup: callable, called with (client id, client_msg_id) for an id that is not remembered,
+                           returns the id of the message stored with it or None
+        """
+
+        self.window = window
+        self.lookup = lookup
+        # Message ids by (client id, client_msg_id), least recently used first
+        self.sent = collections.OrderedDict()
+
+    def get(self, client_id, msg_id):
+        """Get the id of the message a client already sent with a client_msg_id, None for a new message"""
+
+        key = (client_id, msg_id)
+        if key in self.sent:
+            self.sent.move_to_end(key)
+            return self.sent[key]
+        if self.lookup is None:
+            return None
+        message_id = self.lookup(client_id, msg_id)
+        if message_id is not None:
+            self.add(client_id, msg_id, message_id)
+        return message_id
+
+    def add(self, client_id, msg_id, message_id):
+        """Remember the id of a message stored with a client_msg_id"""
+
+        if self.window <= 0:
+            return
+        self.sent[(client_id, msg_id)] = message_id
+        self.sent.move_to_end((client_id, msg_id))
+        if len(self.sent) > self.window:
+            self.sent.popitem(last=False)
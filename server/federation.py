@@ -0,0 +1,251 @@
+"""
+Federation of PyChat
+
+Nodes that list each other in Peers relay events over one long-lived TCP link per pair of nodes.
+The node whose name sorts first dials the link and the other one accepts it, so a pair never has two links.
+Every kind of event shares the link, events are JSON objects sent in batches, one batch per line:
+
+    {"events": [{...}, ...]}                            a batch of events
+
+Both ends first prove they have the key of the federation (FederationKey) without sending it, HMAC-SHA256
+challenge-response over a random nonce of each end:
+
+    dialer   -> {"hello": <dialer name>, "nonce": <a>}
+    acceptor -> {"hello": <acceptor name>, "nonce": <b>, "proof": HMAC(key, [<acceptor name>, <b>, <a>])}
+    dialer   -> {"proof": HMAC(key, [<dialer name>, <a>, <b>])}
+
+Every proof covers the name of its sender, so a proof can not be sent back as the proof of the other end.
+The link itself is not encrypted, run it over a private network or a tunnel.
+
+Events for a peer are queued while its link is down (the oldest are dropped beyond max_queue) and sent once it is
+up again. A batch is sent when max_batch events are pending or max_delay seconds after the first one.
+
+What the events mean is up to the node, see on_events and on_link.
+"""
+
+import collections
+import hashlib
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+
+try:
+    from broker import connect_socket
+    from log import Log, LogSink
+except ImportError:
+    from .broker import connect_socket
+    from .log import Log, LogSink
+
+HELLO_TIMEOUT = 5
+NONCE_SIZE = 16
+RECONNECT_BACKOFF = 1
+RECONNECT_BACKOFF_MAX = 30
+
+
+def send_line(cnn, data):
+    cnn.sendall((json.dumps(data) + '\n').encode())
+
+
+def close_link(cnn):
+    """Close a link, the reader of the link returns at once"""
+
+    try:
+        cnn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    cnn.close()
+
+
+class Peer(object):
+    def __init__(self, name, address, max_queue):
+        self.name = name
+        self.address = address
+        self.events = collections.deque(maxlen=max_queue)
+        self.condition = threading.Condition()
+        # The socket of the link, None while it is down
+        self.link = None
+
+
+class FederationNode(object):
+    def __init__(self, node_name, listener, peers, key='', on_events=None, on_link=None,
+                 max_batch=64, max_delay=0.01, max_queue=10000, log=None):
+        """
+        Args:
+            :param node_name: str, name of this node
+            :param listener: socket object, listening socket of the links of this node
+            :param peers: dict, addresses ([host, port]) of the peers by name
+            :param key: str, shared key of the federation, a peer without it is refused
+            :param on_events: callable, called with (peer name, list of events) for every batch received
+            :param on_link: callable, called with (peer name, True) when a link is up and (peer name, False) when it is down
+            :param max_batch: int, events sent in one batch
+            :param max_delay: float, seconds an event may wait for a batch to fill
+            :param max_queue: int, events queued for a peer while its link is down
+            :param log: Log, where the links are logged
+        """
+
+        self.node_name = node_name
+        self.listener = listener
+        self.peers = {name: Peer(name, address, max_queue) for name, address in peers.items() if name != node_name}
+        self.key = str(key)
+        self.on_events = on_events
+        self.on_link = on_link
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.log = log if log is not None else Log(LogSink())
+
+    def serve_forever(self):
+        for peer in self.peers.values():
+            if self.node_name < peer.name:
+                threading.Thread(target=self.dial, args=(peer,), daemon=True).start()
+        while True:
+            try:
+                cnn, addr = self.listener.accept()
+                threading.Thread(target=self.accept, args=(cnn, addr), daemon=True).start()
+            except OSError as e:
+                self.log.error('FEDERATION', error=e)
+
+    def send(self, event, peer_names=None):
+        """Queue an event
+
+        Args:
+            :param event: dict, the event
+            :param peer_names: list, names of the peers to send the event to, None for every peer
+        """
+
+        for peer in self.peers.values():
+            if peer_names is not None and peer.name not in peer_names:
+                continue
+            with peer.condition:
+                peer.events.append(event)
+                peer.condition.notify_all()
+
+    def dial(self, peer):
+        """Keep the link to a peer up"""
+
+        backoff = RECONNECT_BACKOFF
+        while True:
+            try:
+                cnn = connect_socket(peer.address)
+                cnn.settimeout(HELLO_TIMEOUT)
+                nonce = os.urandom(NONCE_SIZE).hex()
+                send_line(cnn, {'hello': self.node_name, 'nonce': nonce})
+                cnn_file = cnn.makefile('rb')
+                hello = json.loads(cnn_file.readline())
+                if self.hello_peer(hello) != peer.name or not self.check_proof(hello, peer.name, hello['nonce'], nonce):
+                    # Not the peer, or an impostor without the key of the federation
+                    raise ValueError('unexpected peer')
+                send_line(cnn, {'proof': self.proof(self.node_name, nonce, hello['nonce'])})
+                cnn.settimeout(None)
+                backoff = RECONNECT_BACKOFF
+                self.run_link(peer, cnn, cnn_file)
+            except (OSError, ValueError) as e:
+                self.log.warning('FEDERATION LINK FAILED', node=peer.name, error=e)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+    def accept(self, cnn, addr):
+        try:
+            cnn.settimeout(HELLO_TIMEOUT)
+            cnn_file = cnn.makefile('rb')
+            hello = json.loads(cnn_file.readline())
+            peer = self.peers.get(self.hello_peer(hello))
+            if peer is None:
+                self.log.warning('FEDERATION REJECTED (UNKNOWN PEER)', address=str(addr))
+                cnn.close()
+                return
+            nonce = os.urandom(NONCE_SIZE).hex()
+            send_line(cnn, {'hello': self.node_name, 'nonce': nonce,
+                            'proof': self.proof(self.node_name, nonce, hello['nonce'])})
+            if not self.check_proof(json.loads(cnn_file.readline()), peer.name, hello['nonce'], nonce):
+                self.log.warning('FEDERATION REJECTED (INVALID KEY)', address=str(addr), node=peer.name)
+                cnn.close()
+                return
+            cnn.settimeout(None)
+        except (OSError, ValueError) as e:
+            self.log.warning('FEDERATION HANDSHAKE FAILED', address=str(addr), error=e)
+            cnn.close()
+            return
+        self.run_link(peer, cnn, cnn_file)
+
+    def hello_peer(self, hello):
+        """Get the name of the node that sent a hello, None if the hello is malformed"""
+
+        if not isinstance(hello, dict) or not isinstance(hello.get('hello'), str):
+            return None
+        nonce = hello.get('nonce')
+        if not isinstance(nonce, str) or not 0 < len(nonce) <= 2 * NONCE_SIZE:
+            return None
+        return hello['hello']
+
+    def proof(self, name, nonce, peer_nonce):
+        """Get the proof a node sends that it has the key, over its name, its nonce and the nonce of the other end"""
+
+        return hmac.new(self.key.encode(), json.dumps([name, nonce, peer_nonce]).encode(), hashlib.sha256).hexdigest()
+
+    def check_proof(self, message, name, nonce, peer_nonce):
+        """Check the proof of the node name in a message of the handshake, nonce is the nonce of that node"""
+
+        proof = message.get('proof') if isinstance(message, dict) else None
+        if not isinstance(proof, str):
+            return False
+        return hmac.compare_digest(proof.encode(), self.proof(name, nonce, peer_nonce).encode())
+
+    def run_link(self, peer, cnn, cnn_file):
+        """Serve a link until it is closed"""
+
+        with peer.condition:
+            if peer.link is not None:
+                # A new link replaces the old one, e.g. after the peer restarted
+                close_link(peer.link)
+            peer.link = cnn
+            peer.condition.notify_all()
+        self.log.info('FEDERATION LINKED', node=peer.name)
+        threading.Thread(target=self.writer, args=(peer, cnn), daemon=True).start()
+        if self.on_link is not None:
+            self.on_link(peer.name, True)
+        try:
+            for line in cnn_file:
+                events = json.loads(line).get('events', [])
+                if self.on_events is not None:
+                    self.on_events(peer.name, events)
+        except (OSError, ValueError) as e:
+            self.log.warning('FEDERATION LINK LOST', node=peer.name, error=e)
+        finally:
+            with peer.condition:
+                # Not replaced by a new link
+                current = peer.link is cnn
+                if current:
+                    peer.link = None
+                peer.condition.notify_all()
+            cnn.close()
+            self.log.info('FEDERATION UNLINKED', node=peer.name)
+            if current and self.on_link is not None:
+                self.on_link(peer.name, False)
+
+    def writer(self, peer, cnn):
+        """Send the queued events of a peer in batches while the link is up"""
+
+        while True:
+            with peer.condition:
+                while peer.link is cnn and not peer.events:
+                    peer.condition.wait()
+                if peer.link is not cnn:
+                    return
+                deadline = time.monotonic() + self.max_delay
+                while peer.link is cnn and len(peer.events) < self.max_batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    peer.condition.wait(timeout)
+                batch = [peer.events.popleft() for i in range(min(self.max_batch, len(peer.events)))]
+            try:
+                cnn.sendall((json.dumps({'events': batch}) + '\n').encode())
+            except OSError:
+                # Send the batch again on the next link, the reader ends the link
+                with peer.condition:
+                    peer.events.extendleft(reversed(batch))
+                close_link(cnn)
+                return
@@ -0,0 +1,308 @@
+"""
+Length-prefixed framing of PyChat
+
+A frame carries the JSON header and the body of a message in one write, so the legacy
+header/ack/body round trip is not needed:
+
+    +----------------------+--------------------+-------------+------+
+    | header size (uint32) | body size (uint32) | header JSON | body |
+    +----------------------+--------------------+-------------+------+
+
+The protocol of a connection is negotiated during the handshake,
+the server lists the protocols it supports in server_info['protocols'] and
+the client picks one in client_info['protocol'].
+
+With frames the client may also pick client_info['ack'] = 'id': messages are acknowledged with
+{'message_id': ..., 'ack': <sha256 from the message header>} and an empty body instead of being echoed back,
+so the client can keep several messages in flight.
+
+With frames the body may also be compressed: the server lists the compressions it supports in
+server_info['compressions'] and the client picks one in client_info['compression'].
+A compressed frame has header['encoding'] set to the compression, header['size'] and header['sha256'] are still
+those of the uncompressed body, small bodies (and bodies that do not shrink) are sent as they are.
+'deflate-dict' is deflate with DEFLATE_DICTIONARY as preset dictionary, which helps short chat messages most.
+
+Bodies are streamed in chunks of CHUNK_SIZE: recv_stream and read_stream write them to a file as they arrive and
+hash them on the way, send_stream sends a prefix and a file, so a large body is never held in memory.
+"""
+
+import asyncio
+import hashlib
+import json
+import struct
+import zlib
+
+PROTOCOL_LEGACY = 'legacy'
+PROTOCOL_FRAME = 'frame'
+PROTOCOLS = [PROTOCOL_LEGACY, PROTOCOL_FRAME]
+
+ACK_ECHO = 'echo'
+ACK_ID = 'id'
+ACKS = [ACK_ECHO, ACK_ID]
+
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSION_DEFLATE_DICT = 'deflate-dict'
+COMPRESSIONS = [COMPRESSION_DEFLATE, COMPRESSION_DEFLATE_DICT]
+
+# Preset dictionary of 'deflate-dict': strings common in messages and replies, the most common at the end.
+# Clients keep a copy of it, it must never change (a new dictionary needs a new compression name)
+DEFLATE_DICTIONARY = (
+    b'https://www.http://.com/.org/.html?id=[]{}null, true, false, "message": "name": "id": "code": '
+    b'SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATERINVALID COMMANDCLIENT NOT FOUNDDisconnectedConnected'
+    b'Traceback (most recent call last):\n  File "line , in Error: Exception WARNING INFO DEBUG '
+    b'what when where which there their have this that with from your you the and for are not '
+    b'SEARCH:\n[HISTORY:\n[RES:\n(<SERVER> [#0]: <DM> ]: [#'
+)
+
+FRAME_PREFIX = struct.Struct('!II')
+MAX_HEADER_SIZE = 65536
+CHUNK_SIZE = 65536
+
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes
+
+    A single recv(size) may return less than size bytes, keep reading into the buffer until it is full
+
+    Args:
+        :param sock: socket object
+        :param size: int, number of bytes to receive
+    Returns:
+        Method returns a bytearray
+    """
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionResetError('connection closed')
+        received += count
+    return buffer
+
+
+def recv_stream(sock, size, spool=None, chunk_size=CHUNK_SIZE):
+    """Receive exactly size bytes in chunks
+
+    Every chunk is read into the same buffer, written to spool and added to the sha256 of the body
+
+    Args:
+        :param sock: socket object
+        :param size: int, number of bytes to receive
+        :param spool: file object the body is written to, None to discard it
+        :param chunk_size: int, bytes read at once
+    Returns:
+        Method returns the sha256 of the body (hex)
+    """
+
+    digest = hashlib.sha256()
+    view = memoryview(bytearray(min(size, chunk_size)))
+    remaining = size
+    while remaining > 0:
+        count = sock.recv_into(view, min(remaining, chunk_size))
+        if count == 0:
+            raise ConnectionResetError('connection closed')
+        digest.update(view[:count])
+        if spool is not None:
+            spool.write(view[:count])
+        remaining -= count
+    return digest.hexdigest()
+
+
+async def read_stream(reader, size, spool=None, chunk_size=CHUNK_SIZE):
+    """Receive exactly size bytes in chunks from an asyncio.StreamReader, see recv_stream"""
+
+    digest = hashlib.sha256()
+    remaining = size
+    while remaining > 0:
+        chunk = await reader.readexactly(min(remaining, chunk_size))
+        digest.update(chunk)
+        if spool is not None:
+            spool.write(chunk)
+        remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def compressor(compression):
+    if compression == COMPRESSION_DEFLATE_DICT:
+        return zlib.compressobj(zdict=DEFLATE_DICTIONARY)
+    return zlib.compressobj()
+
+
+def compress(body, compression):
+    """Compress a body
+
+    Returns:
+        Method returns the compressed body, or None if it does not shrink
+    """
+
+    deflater = compressor(compression)
+    compressed = deflater.compress(body) + deflater.flush()
+    if len(compressed) >= len(body):
+        return None
+    return compressed
+
+
+def decompress(body, compression):
+    """Decompress a body, raises ValueError if it is invalid"""
+
+    inflater = Inflater(None, compression)
+    inflater.write(body)
+    if inflater.hexdigest() is None:
+        raise ValueError('invalid compressed body')
+    return inflater.body
+
+
+class Inflater(object):
+    """A file object that decompresses what is written to it
+
+    Used as the spool of recv_stream and read_stream: the decompressed body is written to file and hashed,
+    an invalid body or a body over max_size is not an exception (the rest of the frame still has to be read),
+    it leaves hexdigest() returning None
+    """
+
+    def __init__(self, file, compression, max_size=None, chunk_size=CHUNK_SIZE):
+        """
+        Args:
+            :param file: file object the decompressed body is written to, None to keep it in self.body
+            :param compression: str, one of COMPRESSIONS
+            :param max_size: int, maximum size of the decompressed body, None for no limit
+            :param chunk_size: int, bytes decompressed at once
+        """
+
+        self.file = file
+        self.body = b''
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.failed = compression not in COMPRESSIONS
+        if not self.failed:
+            self.decompressor = zlib.decompressobj(zdict=DEFLATE_DICTIONARY) if compression == COMPRESSION_DEFLATE_DICT else zlib.decompressobj()
+
+    def write(self, data):
+        while data and not self.failed:
+            try:
+                chunk = self.decompressor.decompress(data, self.chunk_size)
+            except zlib.error:
+                self.failed = True
+                return
+            self.size += len(chunk)
+            if self.max_size is not None and self.size > self.max_size:
+                self.failed = True
+                return
+            self.digest.update(chunk)
+            if self.file is not None:
+                self.file.write(chunk)
+            else:
+                self.body += chunk
+            data = self.decompressor.unconsumed_tail
+
+    def hexdigest(self):
+        """Get the sha256 of the decompressed body (hex), None if the body is invalid or too large"""
+
+        if self.failed or not self.decompressor.eof:
+            return None
+        return self.digest.hexdigest()
+
+
+def stream_digest(prefix, file, chunk_size=CHUNK_SIZE):
+    """Get the size and the sha256 (hex) of a prefix (bytes) followed by the rest of a file, the file is rewound"""
+
+    position = file.tell()
+    digest = hashlib.sha256(prefix)
+    size = len(prefix)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(position)
+    return size, digest.hexdigest()
+
+
+def send_stream(sock, prefix, file):
+    """Send a prefix (bytes) followed by the rest of a file, with sendfile where the platform has it"""
+
+    sock.sendall(prefix)
+    sock.sendfile(file)
+
+
+async def write_stream(writer, prefix, file):
+    """Send a prefix (bytes) followed by the rest of a file on an asyncio.StreamWriter
+
+    The file is sent with sendfile where the transport supports it, read in chunks otherwise
+    """
+
+    writer.write(prefix)
+    await writer.drain()
+    await asyncio.get_running_loop().sendfile(writer.transport, file, file.tell(), fallback=True)
+
+
+def pack_frame_head(header, body_size):
+    """Pack the prefix and the header of a frame, the body of body_size bytes is sent after it"""
+
+    header_byte = json.dumps(header).encode()
+    return FRAME_PREFIX.pack(len(header_byte), body_size) + header_byte
+
+
+def pack_frame(header, body=b''):
+    return pack_frame_head(header, len(body)) + body
+
+
+def unpack_prefix(prefix):
+    header_size, body_size = FRAME_PREFIX.unpack(prefix)
+    if header_size > MAX_HEADER_SIZE:
+        raise ValueError('frame header too large')
+    return header_size, body_size
+
+
+def send_frame(sock, header, body=b''):
+    sock.sendall(pack_frame(header, body))
+
+
+def recv_frame_head(sock):
+    """Receive the prefix and the header of a frame, the body is left on the socket
+
+    Returns:
+        Method returns a tuple (header, body size)
+    """
+
+    header_size, body_size = unpack_prefix(recv_exact(sock, FRAME_PREFIX.size))
+    header = json.loads(recv_exact(sock, header_size).decode())
+    return header, body_size
+
+
+async def read_frame_head(reader):
+    """Receive the prefix and the header of a frame from an asyncio.StreamReader, the body is left on the stream
+
+    Returns:
+        Method returns a tuple (header, body size)
+    """
+
+    header_size, body_size = unpack_prefix(await reader.readexactly(FRAME_PREFIX.size))
+    header = json.loads((await reader.readexactly(header_size)).decode())
+    return header, body_size
+
+
+def recv_frame(sock):
+    """Receive one frame
+
+    Returns:
+        Method returns a tuple (header, body), header is a dict and body is bytes
+    """
+
+    header, body_size = recv_frame_head(sock)
+    body = bytes(recv_exact(sock, body_size))
+    return header, body
+
+
+async def read_frame(reader):
+    """Receive one frame from an asyncio.StreamReader
+
+    Returns:
+        Method returns a tuple (header, body), header is a dict and body is bytes
+    """
+
+    header, body_size = await read_frame_head(reader)
+    body = await reader.readexactly(body_size)
+    return header, body
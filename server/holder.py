@@ -14,6 +14,20 @@ class Holder(object):
     def evoke(self):
         time.sleep(self.min_time)
         time.sleep(self.hold_time)
+        self.adjust()
+
+    def hold(self):
+        """Non-blocking evoke
+
+        Returns:
+            Method returns the seconds the caller should hold, the caller decides how to wait (or what to refuse)
+        """
+
+        hold_time = self.min_time + self.hold_time
+        self.adjust()
+        return hold_time
+
+    def adjust(self):
         if 1/(time.time()-self.first_evoke_time + 0.00000001) > self.freq:
             self.hold_time = self.hold_time + self.add
         else:
@@ -0,0 +1,179 @@
+"""
+Logging of PyChat
+
+A record is a level, a message and context fields (e.g. the address of the connection it is about),
+written as a line of text or as a JSON object per line.
+
+Logging never blocks the handlers: a record is appended to an in-memory ring buffer of the process, a background
+thread formats the records and writes them out, so a slow terminal or pipe only delays the log.
+When the buffer is full the oldest records are dropped, the writer reports how many.
+
+The level is shared by every process forked after the Log is created, so it can be changed at runtime from any of them.
+"""
+
+import collections
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+FORMAT_TEXT = 'text'
+FORMAT_JSON = 'json'
+FORMATS = [FORMAT_TEXT, FORMAT_JSON]
+
+# Taken by the first record of a process, which starts the writer
+start_lock = threading.Lock()
+
+
+def level_value(name):
+    """Get the level of a name ('debug', 'info', 'warning' or 'error'), raises ValueError for an unknown name"""
+
+    try:
+        return LEVELS[str(name).lower()]
+    except KeyError:
+        raise ValueError('unknown log level ' + str(name))
+
+
+class LogSink(object):
+    def __init__(self, log_format=FORMAT_TEXT, stream=None, buffer_size=10000, flush_interval=0.2):
+        """
+        Args:
+            :param log_format: str, FORMAT_TEXT or FORMAT_JSON
+            :param stream: file object the records are written to, sys.stdout by default
+            :param buffer_size: int, records kept in memory until they are written
+            :param flush_interval: float, seconds the writer waits for more records before writing them
+        """
+
+        self.log_format = log_format
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        # The buffer and the writer belong to one process, a forked process starts its own on its first record
+        self.pid = None
+
+    def start(self):
+        self.pid = os.getpid()
+        self.records = collections.deque(maxlen=self.buffer_size)
+        self.dropped = 0
+        self.ready = threading.Event()
+        self.write_lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        # Write what is left when the process exits
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=100)
+
+    def put(self, record):
+        """Queue a record (time, level, message, fields), it is formatted and written by the writer thread"""
+
+        if self.pid != os.getpid():
+            with start_lock:
+                if self.pid != os.getpid():
+                    self.start()
+        if len(self.records) == self.buffer_size:
+            self.dropped += 1
+        self.records.append(record)
+        self.ready.set()
+
+    def serve_forever(self):
+        while True:
+            self.ready.wait()
+            time.sleep(self.flush_interval)
+            self.ready.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the records in the buffer"""
+
+        if self.pid != os.getpid():
+            return
+        with self.write_lock:
+            lines = []
+            while self.records:
+                lines.append(self.format(*self.records.popleft()))
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.format(time.time(), WARNING, 'LOG RECORDS DROPPED', {'count': dropped}))
+            if not lines:
+                return
+            stream = self.stream or sys.stdout
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def format(self, record_time, level, message, fields):
+        if self.log_format == FORMAT_JSON:
+            record = {'time': round(record_time, 3), 'level': LEVEL_NAMES[level], 'pid': self.pid, 'message': message}
+            record.update(fields)
+            return json.dumps(record, default=str)
+        line = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record_time)) + \
+            '.{:03d} {} {}'.format(int(record_time * 1000) % 1000, LEVEL_NAMES[level], message)
+        if fields:
+            line += ' ' + ' '.join('{}={}'.format(key, value) for key, value in fields.items())
+        return line
+
+
+class Log(object):
+    def __init__(self, sink, level=INFO, fields=None, shared_level=None):
+        """
+        Args:
+            :param sink: LogSink, where the records go
+            :param level: int, records below the level are not logged
+            :param fields: dict, context fields added to every record
+            :param shared_level: the shared level of the Log this one is bound from, internal
+        """
+
+        self.sink = sink
+        self.fields = fields or {}
+        # Read on every record, without a lock (a level is set at once)
+        self.shared_level = shared_level if shared_level is not None else multiprocessing.RawValue('i', level)
+
+    def bind(self, **fields):
+        """Get a Log adding fields to every record, e.g. the address of a connection"""
+
+        bound_fields = dict(self.fields)
+        bound_fields.update(fields)
+        return Log(self.sink, fields=bound_fields, shared_level=self.shared_level)
+
+    @property
+    def level(self):
+        return self.shared_level.value
+
+    @level.setter
+    def level(self, level):
+        self.shared_level.value = level
+
+    def enabled(self, level):
+        return level >= self.shared_level.value
+
+    def log(self, level, message, **fields):
+        if level < self.shared_level.value:
+            return
+        if self.fields:
+            record_fields = dict(self.fields)
+            record_fields.update(fields)
+        else:
+            record_fields = fields
+        self.sink.put((time.time(), level, str(message), record_fields))
+
+    def debug(self, message, **fields):
+        self.log(DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(ERROR, message, **fields)
@@ -0,0 +1,79 @@
+"""
+Rate limiter of PyChat
+
+A GCRA limiter (the virtual scheduling form of a token bucket) per client:
+a client may send `burst` messages at once and `rate` messages per second after that.
+The limiter never sleeps, it tells the caller how long a message has to wait, so an engine can
+reject it or delay it without blocking other clients.
+
+The counters are shared by every process forked after the limiter is created.
+"""
+
+import multiprocessing
+import time
+
+POLICY_DELAY = 'delay'
+POLICY_REJECT = 'reject'
+POLICIES = [POLICY_DELAY, POLICY_REJECT]
+
+COUNTERS = ['allowed', 'delayed', 'rejected', 'muted']
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst, policy=POLICY_DELAY, max_delay=5.0, max_clients=10000):
+        """
+        Args:
+            :param rate: float, messages per second
+            :param burst: int, messages a client may send at once
+            :param policy: POLICY_DELAY to delay a message over the limit, POLICY_REJECT to reject it
+            :param max_delay: float, seconds, a message that would wait longer is rejected with POLICY_DELAY too
+            :param max_clients: int, forget idle clients beyond this number
+        """
+
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.policy = policy
+        self.max_delay = max_delay
+        self.max_clients = max_clients
+        # Theoretical arrival time of the next message of every client
+        self.tat = {}
+        self.counters = {name: multiprocessing.Value('q', 0) for name in COUNTERS}
+
+    def admit(self, client_id):
+        """Admit a message of a client
+
+        Args:
+            :param client_id: int, id of the client
+        Returns:
+            Method returns the seconds the message has to wait before it is processed,
+            or None if the message is rejected
+        """
+
+        now = time.monotonic()
+        tat = max(self.tat.get(client_id, now), now)
+        wait = tat - self.tolerance - now
+        if wait <= 0:
+            self.count('allowed')
+            wait = 0
+        elif self.policy == POLICY_REJECT or wait > self.max_delay:
+            self.count('rejected')
+            return None
+        else:
+            self.count('delayed')
+        if len(self.tat) >= self.max_clients and client_id not in self.tat:
+            self.forget(now)
+        self.tat[client_id] = tat + self.interval
+        return wait
+
+    def forget(self, now):
+        # A client whose theoretical arrival time has passed has a full bucket, it does not need an entry
+        for client_id in [client_id for client_id, tat in self.tat.items() if tat <= now]:
+            del self.tat[client_id]
+
+    def count(self, name):
+        counter = self.counters[name]
+        with counter.get_lock():
+            counter.value += 1
+
+    def stats(self):
+        return {name: counter.value for name, counter in self.counters.items()}
@@ -0,0 +1,205 @@
+"""
+Message retention of PyChat
+
+Messages older than retention_days move out of the database into one archive database per month
+(ArchiveDir/messages-YYYY-MM.db, by the UTC time of the messages), so the database only holds recent messages.
+An archive has the same "messages" table (and "messages_fts" index) as the database, so a query of the
+database runs unchanged on the archives.
+
+The engine runs in the writer process. Messages move in batches in id order: a batch is copied into its
+archive and committed there, then deleted from the database through the writer, so the database is only locked for
+one short transaction per batch and other writes go on between batches.
+Messages are cut by id, not by time: a run stops at the first message that is not older than the retention, even
+if later ones are (a message of a peer carries the clock of the peer), and a message never goes to an archive
+older than the newest one written. So the database keeps every id above the archived ones and newer archives hold
+greater ids, which history and search read in that order (see read_archives in server.py).
+A batch copied but not deleted (e.g. the server stopped in between) is copied again, the copy ignores the rows
+already in the archive.
+"""
+
+import os
+import sqlite3
+import time
+
+try:
+    from blobstore import meta_blob
+    from log import Log, LogSink
+except ImportError:
+    from .blobstore import meta_blob
+    from .log import Log, LogSink
+
+ARCHIVE_PREFIX = 'messages-'
+ARCHIVE_SUFFIX = '.db'
+
+
+def archive_name(message_time):
+    """Get the name of the archive of a message
+
+    Args:
+        :param message_time: int, time of the message (milliseconds)
+    """
+
+    return ARCHIVE_PREFIX + time.strftime('%Y-%m', time.gmtime(message_time / 1000)) + ARCHIVE_SUFFIX
+
+
+def archive_paths(archive_dir):
+    """Get the paths of the archives, the newest first"""
+
+    if not archive_dir or not os.path.isdir(archive_dir):
+        return []
+    names = [name for name in os.listdir(archive_dir) if name.startswith(ARCHIVE_PREFIX) and name.endswith(ARCHIVE_SUFFIX)]
+    return [os.path.join(archive_dir, name) for name in sorted(names, reverse=True)]
+
+
+def create_archive(archive_db, search=True):
+    """Create the tables of an archive
+
+    Args:
+        :param archive_db: sqlite connection of the archive, read-write
+        :param search: bool, create the full-text index (FTS5)
+    """
+
+    archive_db.execute('''CREATE TABLE IF NOT EXISTS "messages" (
+                            "id"	INTEGER NOT NULL PRIMARY KEY,
+                            "client"	INTEGER NOT NULL,
+                            "time"  INTEGER NOT NULL,
+                            "content"	TEXT,
+                            "meta"	TEXT,
+                            "recipient_id"	INTEGER,
+                            "kind"	INTEGER NOT NULL DEFAULT 0,
+                            "nosend"	INTEGER NOT NULL DEFAULT 0,
+                            "client_msg_id"	TEXT,
+                            "blob"	TEXT
+                            );''')
+    columns = [column[1] for column in archive_db.execute('''PRAGMA table_info("messages");''')]
+    if 'client_msg_id' not in columns:
+        archive_db.execute('''ALTER TABLE "messages" ADD COLUMN "client_msg_id" TEXT;''')
+    if 'blob' not in columns:
+        # An archive written before the blob column, backfilled from the meta like the database (schema v6)
+        archive_db.execute('''ALTER TABLE "messages" ADD COLUMN "blob" TEXT;''')
+        messages = archive_db.execute('''SELECT "id", "meta" FROM "messages"
+                                         WHERE "meta" LIKE '%"file"%' OR "meta" LIKE '%"attachment"%';''').fetchall()
+        archive_db.executemany('''UPDATE "messages" SET "blob"=? WHERE "id"=?;''',
+                               [(meta_blob(message_meta), message_id) for message_id, message_meta in messages
+                                if meta_blob(message_meta) is not None])
+    archive_db.execute('''CREATE INDEX IF NOT EXISTS "messages_recipient_id" ON "messages" ("recipient_id", "id");''')
+    archive_db.execute('''CREATE INDEX IF NOT EXISTS "messages_client" ON "messages" ("client", "id");''')
+    archive_db.execute('''CREATE INDEX IF NOT EXISTS "messages_blob" ON "messages" ("blob") WHERE "blob" IS NOT NULL;''')
+    if search:
+        archive_db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS "messages_fts" USING fts5("content", content="messages", content_rowid="id");''')
+        # Archives are only appended to
+        archive_db.execute('''CREATE TRIGGER IF NOT EXISTS "messages_fts_insert" AFTER INSERT ON "messages" WHEN new."nosend" = 0
+                                BEGIN
+                                    INSERT INTO "messages_fts"("rowid", "content") VALUES (new."id", new."content");
+                                END;''')
+    archive_db.commit()
+
+
+def upgrade_archives(archive_dir, search=True):
+    """Bring the archives written by an older version to the current tables, see create_archive"""
+
+    for path in archive_paths(archive_dir):
+        archive_db = sqlite3.connect(path)
+        try:
+            create_archive(archive_db, search)
+        finally:
+            archive_db.close()
+
+
+class RetentionEngine(object):
+    def __init__(self, database_file, writer, retention_days, archive_dir='', search=True,
+                 batch_size=500, batch_pause=0.05, interval=3600, log=None):
+        """
+        Args:
+            :param database_file: str, path of the database
+            :param writer: GroupCommitWriter, the writer of the database
+            :param retention_days: float, days messages are kept in the database
+            :param archive_dir: str, directory of the archives, '' to drop old messages without archiving them
+            :param search: bool, index the archived messages for full-text search
+            :param batch_size: int, messages moved in one batch
+            :param batch_pause: float, seconds between two batches
+            :param interval: float, seconds between two runs
+            :param log: Log, where the runs are logged
+        """
+
+        self.database_file = database_file
+        self.writer = writer
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.search = search
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval = interval
+        self.log = log if log is not None else Log(LogSink())
+        # Open archives by name
+        self.archives = {}
+        # Name of the newest archive, messages never go to an older one
+        paths = archive_paths(archive_dir)
+        self.newest_archive = os.path.basename(paths[0]) if paths else ''
+
+    def serve_forever(self):
+        while True:
+            try:
+                moved = self.run()
+                if moved:
+                    self.log.info('RETENTION', archived=moved)
+            except (OSError, sqlite3.Error) as e:
+                self.log.error('RETENTION', error=e)
+            time.sleep(self.interval)
+
+    def run(self):
+        """Move every message older than the retention out of the database
+
+        Returns:
+            Method returns the number of messages moved
+        """
+
+        db = sqlite3.connect('file:{}?mode=ro'.format(self.database_file), uri=True)
+        moved = 0
+        try:
+            while True:
+                cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+                batch = db.execute('''SELECT "id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend",
+                                             "client_msg_id", "blob"
+                                      FROM "messages"
+                                      ORDER BY "id" LIMIT ?;''', (self.batch_size,)).fetchall()
+                # Up to the first message within the retention
+                for i, message in enumerate(batch):
+                    if message[2] >= cutoff:
+                        batch = batch[:i]
+                        break
+                if not batch:
+                    return moved
+                self.archive(batch)
+                # Only messages stored after the batch have greater ids
+                self.writer.execute('''DELETE FROM "main"."messages" WHERE "id" <= ?;''', (batch[-1][0],))
+                moved += len(batch)
+                time.sleep(self.batch_pause)
+        finally:
+            db.close()
+
+    def archive(self, batch):
+        """Copy a batch of messages into their archives"""
+
+        if not self.archive_dir:
+            return
+        months = {}
+        for message in batch:
+            self.newest_archive = max(self.newest_archive, archive_name(message[2]))
+            months.setdefault(self.newest_archive, []).append(message)
+        for name, messages in months.items():
+            archive_db = self.get_archive(name)
+            archive_db.executemany('''INSERT OR IGNORE INTO "messages"
+                                      ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend",
+                                       "client_msg_id", "blob")
+                                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''', messages)
+            archive_db.commit()
+
+    def get_archive(self, name):
+        if name not in self.archives:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            archive_db = sqlite3.connect(os.path.join(self.archive_dir, name))
+            archive_db.execute('PRAGMA journal_mode=WAL')
+            create_archive(archive_db, self.search)
+            self.archives[name] = archive_db
+        return self.archives[name]
@@ -16,8 +16,130 @@ Requirements: {
                     "AllowAdminCommands": true,
                     "AllowNickname": true,
                     "ServerName": "default",
-                    "WelcomeMessage": "Welcome to PyChat Server!"
+                    "WelcomeMessage": "Welcome to PyChat Server!",
+                    "Engine": "process",
+                    "ExecutorWorkers": 16,
+                    "Workers": 1,
+                    "PreforkWorkers": 4,
+                    "MaxSessionsPerWorker": 1000,
+                    "Broker": true,
+                    "BrokerAddress": "./broker.sock",
+                    "WriterAddress": "./writer.sock",
+                    "ReceiverBatchSize": 100,
+                    "BackfillLimit": 1000,
+                    "ClientTableSize": 65536,
+                    "Durability": "group",
+                    "GroupCommitRows": 64,
+                    "GroupCommitMs": 5,
+                    "RetentionDays": 0,
+                    "ArchiveDir": "./archive",
+                    "MaxMessageSize": 16777216,
+                    "LargeMessageSize": 1048576,
+                    "BlobDir": "./blobs",
+                    "MaxUploadSize": 104857600,
+                    "Compression": true,
+                    "CompressionThreshold": 256,
+                    "DedupeWindow": 1024,
+                    "RateLimitRate": 20,
+                    "RateLimitBurst": 40,
+                    "RateLimitPolicy": "delay",
+                    "MutedPolicy": "reply",
+                    "ListenBacklog": 128,
+                    "MaxConnections": 1024,
+                    "MaxConnectionsPerIP": 64,
+                    "AcceptRate": 100,
+                    "AcceptBurst": 32,
+                    "LogLevel": "info",
+                    "LogFormat": "text",
+                    "NodeName": "default",
+                    "FederationPort": 0,
+                    "FederationKey": "",
+                    "Peers": {"node2": ["10.0.0.2", 2333]}
                 }
+
+        Engine:
+            "process" forks a process for every sender and receiver connection
+            "asyncio" serves all connections as coroutines on one event loop
+            "prefork" hands every connection over to one of PreforkWorkers long-lived processes,
+                      which serves it on a thread, a worker is replaced after MaxSessionsPerWorker connections
+                      (0 for never)
+        Workers:
+            number of processes running the asyncio engine, every worker listens on Port and PortRcv (SO_REUSEPORT)
+            and the kernel spreads the connections between them,
+            the workers share the broker, the writer and the client table, so a message reaches a receiver
+            on any worker, the connection limits and rate limits apply per worker
+        Broker:
+            new messages are pushed to the receivers through the broker listening on BrokerAddress
+            (a Unix socket path, or [host, port] for TCP), receivers poll the database when it is disabled
+        WriterAddress:
+            the writer process owns the only read-write connection of the database,
+            handlers send their writes to it on WriterAddress (a Unix socket path, or [host, port] for TCP)
+        ReceiverBatchSize:
+            number of messages a receiver reads at once when it catches up from the database
+        BackfillLimit:
+            a receiver sending since_id (the id of the last message it got) in client_info is first sent
+            the messages it missed, at most BackfillLimit of them, 0 disables it
+        ClientTableSize:
+            number of valid clients whose valid flag, mute deadline and nickname are shared between processes in
+            memory (see client_table.py), the slot of a client is reused once it disconnects,
+            the others are read from the database
+        Durability:
+            "message" commits every message on its own before it is acknowledged
+            "group" commits messages in groups of up to GroupCommitRows or every GroupCommitMs milliseconds,
+                    a message is acknowledged after its group is committed
+            "async" acknowledges a message as soon as it is written, the group is committed later
+        RetentionDays, ArchiveDir:
+            messages older than RetentionDays move out of the database into one archive database per month in
+            ArchiveDir, history and search read the archives after the database, 0 keeps every message in the database,
+            with ArchiveDir "" old messages are deleted
+        MaxMessageSize, LargeMessageSize:
+            message bodies are received in chunks and checked against the sha256 of their header,
+            a body over MaxMessageSize bytes is refused, a body over LargeMessageSize bytes is written to the blob
+            store as it arrives and streamed from there to the receivers,
+            the database only keeps the beginning of it (history and search show that)
+        BlobDir, MaxUploadSize:
+            large message bodies, attachments and large ###dbcmd results are stored once in BlobDir under their sha256
+            (see blobstore.py),
+            a message with "upload" (a file name) in its header is an attachment of up to MaxUploadSize bytes,
+            the database only keeps a reference to it, "##download <sha256>" sends it back with sendfile
+            to a client that can see a message with it
+        Compression, CompressionThreshold:
+            offer the compressions of framing.py to the clients using frames, message bodies of at least
+            CompressionThreshold bytes are compressed, a broadcast message is compressed once by the publish
+            thread of the writer (with deflate-dict, the compression client.py picks), it goes through the broker
+            as raw bytes and the receivers send the same bytes
+        DedupeWindow:
+            a message with client_msg_id in its header is stored and delivered once, a retry with the same
+            client_msg_id is acknowledged with the id of the message already stored,
+            every sender session remembers its last DedupeWindow ids, older ones are looked up in the database,
+            so a client must never reuse a client_msg_id (client.py prefixes them with a random id per start),
+            a client sending its credential as "resume" in client_info keeps its client id, so its retries on
+            a new connection are found too (see dedupe.py)
+        RateLimitRate, RateLimitBurst:
+            every client may send RateLimitBurst messages at once and RateLimitRate messages per second after that,
+            0 disables the limit
+        RateLimitPolicy:
+            "delay" holds a message over the limit back until it conforms, "reject" refuses it
+        MutedPolicy:
+            "reply" refuses the messages of a muted client at once, "delay" answers after a second
+        ListenBacklog:
+            length of the queue of connections waiting to be accepted, per listening port
+        MaxConnections, MaxConnectionsPerIP:
+            open connections per listening port, and per client address on it, 0 for no limit
+        AcceptRate, AcceptBurst:
+            connections accepted per second per listening port, the accept loop holds back new connections
+            while they arrive faster and refuses them once more than AcceptBurst are held back, 0 for no limit,
+            a connection over any of these limits is refused with a reason instead of being served
+        LogLevel, LogFormat:
+            records below LogLevel ("debug", "info", "warning" or "error") are not logged, "debug" logs every message,
+            "###log level <level>" changes it at runtime, LogFormat is "text" or "json" (one JSON object per line),
+            the log is written by a background thread of every process (see log.py)
+        NodeName, FederationPort, FederationKey, Peers:
+            servers listing each other in Peers (addresses [host, port] of their FederationPort by NodeName) relay
+            broadcast messages, DMs and presence over one link per pair, 0 disables the federation (needs the broker),
+            a client of a peer shows up as <name>@<node> and can be addressed by that name or by <node>:<id>,
+            FederationKey must be the same on every node (the nodes prove they have it, it is never sent, see
+            federation.py), NodeName defaults to ServerName
 }
 
 Run:
@@ -25,20 +147,75 @@ Run:
 """
 
 
+import asyncio
+import codecs
+import collections
+import concurrent.futures
 import hashlib
+import hmac
+import io
 import json
 import multiprocessing
+import multiprocessing.connection
 import os
+import queue
 import random
+import selectors
 import socket
 import sqlite3
 import struct
+import sys
+import threading
 import time
 
 try:
-    from holder import Holder
+    from framing import (ACK_ECHO, ACK_ID, ACKS, CHUNK_SIZE, COMPRESSION_DEFLATE_DICT, COMPRESSIONS, PROTOCOL_FRAME, PROTOCOL_LEGACY, PROTOCOLS, Inflater, compress,
+                         pack_frame, pack_frame_head, read_frame_head, read_stream, recv_frame_head, recv_stream, send_frame, send_stream,
+                         stream_digest, write_stream)
+except ImportError:
+    from .framing import (ACK_ECHO, ACK_ID, ACKS, CHUNK_SIZE, COMPRESSION_DEFLATE_DICT, COMPRESSIONS, PROTOCOL_FRAME, PROTOCOL_LEGACY, PROTOCOLS, Inflater, compress,
+                          pack_frame, pack_frame_head, read_frame_head, read_stream, recv_frame_head, recv_stream, send_frame, send_stream,
+                          stream_digest, write_stream)
+try:
+    from admission import AdmissionController
+except ImportError:
+    from .admission import AdmissionController
+try:
+    from blobstore import BlobStore, is_digest, message_blob, meta_blob
+except ImportError:
+    from .blobstore import BlobStore, is_digest, message_blob, meta_blob
+try:
+    from broker import Broker, BrokerClient, encode_event, listen_socket
+except ImportError:
+    from .broker import Broker, BrokerClient, encode_event, listen_socket
+try:
+    from client_table import ClientTable
+except ImportError:
+    from .client_table import ClientTable
+try:
+    from dedupe import SentMessages, client_msg_id
+except ImportError:
+    from .dedupe import SentMessages, client_msg_id
+try:
+    from federation import FederationNode
+except ImportError:
+    from .federation import FederationNode
+try:
+    from log import DEBUG, FORMAT_TEXT, LEVEL_NAMES, Log, LogSink, level_value
+except ImportError:
+    from .log import DEBUG, FORMAT_TEXT, LEVEL_NAMES, Log, LogSink, level_value
+try:
+    from ratelimit import POLICY_DELAY, RateLimiter
+except ImportError:
+    from .ratelimit import POLICY_DELAY, RateLimiter
+try:
+    from retention import RetentionEngine, archive_paths, upgrade_archives
+except ImportError:
+    from .retention import RetentionEngine, archive_paths, upgrade_archives
+try:
+    from writer import GroupCommitWriter, WriterClient, WriterServer
 except ImportError:
-    from .holder import Holder
+    from .writer import GroupCommitWriter, WriterClient, WriterServer
 
 CONFIG_FILE = './config.json'
 DATABASE_FILE = './server.db'
@@ -91,6 +268,631 @@ else:
     db = sqlite3.connect(DATABASE_FILE)
     db_cursor = db.cursor()
 
+# Schema versions are tracked in PRAGMA user_version
+SCHEMA_VERSION = 6
+
+# messages.kind
+MESSAGE_KIND_CHAT = 0
+MESSAGE_KIND_DM = 1
+MESSAGE_KIND_SU = 2
+
+MIGRATION_BATCH_SIZE = 10000
+
+
+def fts5_available(tokenize='unicode61'):
+    try:
+        sqlite3.connect(':memory:').execute('''CREATE VIRTUAL TABLE "fts5_test" USING fts5("content", tokenize="{}");'''.format(tokenize))
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def add_column(db_cursor, table, column, declaration):
+    """Add a column to a table, unless an interrupted migration already added it"""
+
+    columns = [row[1] for row in db_cursor.execute('''PRAGMA table_info("{}");'''.format(table)).fetchall()]
+    if column not in columns:
+        db_cursor.execute('''ALTER TABLE "{}" ADD COLUMN "{}" {};'''.format(table, column, declaration))
+
+
+def migrate_batches(db, version, migrate):
+    """Run a step of a migration over the messages in batches of MIGRATION_BATCH_SIZE ids, committing every batch
+
+    The last id of the batches committed is kept in the "migration" table with them, so a step that is interrupted
+    goes on after it, a batch is never run twice.
+    Call in a transaction (the batches commit it and begin another one).
+
+    Args:
+        :param db: sqlite connection, read-write
+        :param version: int, the version the step migrates to
+        :param migrate: callable, called with the first and the last id of every batch
+    """
+
+    db_cursor = db.cursor()
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS "migration" ("version" INTEGER NOT NULL PRIMARY KEY, "cursor" INTEGER NOT NULL);''')
+    done = db_cursor.execute('''SELECT "cursor" FROM "migration" WHERE "version" = ?;''', (version,)).fetchall()
+    min_id, max_id = db_cursor.execute('''SELECT min("id"), max("id") FROM "messages";''').fetchall()[0]
+    cursor = done[0][0] if done else (min_id or 0) - 1
+    while max_id is not None and cursor < max_id:
+        migrate(cursor + 1, cursor + MIGRATION_BATCH_SIZE)
+        cursor += MIGRATION_BATCH_SIZE
+        db_cursor.execute('''INSERT OR REPLACE INTO "migration"("version", "cursor") VALUES (?, ?);''', (version, cursor))
+        db.commit()
+        db_cursor.execute('''BEGIN;''')
+
+
+def finish_migration(db, version):
+    """Commit a step of a migration with the version it reaches"""
+
+    db_cursor = db.cursor()
+    db_cursor.execute('''PRAGMA user_version = {};'''.format(version))
+    if db_cursor.execute('''SELECT 1 FROM "sqlite_master" WHERE "name" = 'migration';''').fetchall():
+        db_cursor.execute('''DELETE FROM "migration" WHERE "version" = ?;''', (version,))
+    db.commit()
+
+
+def migrate_database(db):
+    """database migration
+
+    This method upgrades the schema of the database to SCHEMA_VERSION
+
+    v2: routing and moderation move from the JSON meta to typed columns
+        messages.recipient_id   DM: id of the recipient, SU: id of the new identity, NULL otherwise
+        messages.kind           MESSAGE_KIND_CHAT, MESSAGE_KIND_DM or MESSAGE_KIND_SU
+        messages.nosend         1 for messages that are never delivered (e.g. commands)
+        clients.mute_until      the client may not send messages until this time (milliseconds)
+    v3: messages_fts, a full-text index (FTS5) of the content of the messages that are delivered,
+        kept in sync with messages by triggers, skipped if sqlite is built without FTS5
+    v4: client lookup only reads the clients that are online ("valid" = 1), however many rows clients has
+        clients_online_name     partial index of the names of the online clients
+        clients_online_address  partial index of the addresses of the online clients
+        clients_fts             a trigram index (FTS5) of the names and addresses of the online clients,
+                                kept in sync with clients by triggers, skipped if sqlite has no trigram tokenizer
+    v5: messages.client_msg_id  the id the sender gave the message (client_msg_id in the header), NULL if none,
+                                a retry of a message is found by it (see dedupe.py)
+    v6: messages.blob           sha256 of the blob of the message (an attachment or a large body), NULL if none,
+                                ##download only sends a blob referenced by a message the client can see
+
+    Args:
+        :param db: sqlite connection, read-write
+    """
+
+    db_cursor = db.cursor()
+    version = db_cursor.execute('''PRAGMA user_version;''').fetchall()[0][0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    # Every step is committed with the version it reaches, and its batches as they go (see migrate_batches),
+    # so a large table is never rewritten in one transaction, an interrupted step is run again from its last batch
+    if version < 2:
+        print('Migrating database to schema v2...')
+        db_cursor.execute('''BEGIN;''')
+        add_column(db_cursor, 'messages', 'recipient_id', 'INTEGER')
+        add_column(db_cursor, 'messages', 'kind', 'INTEGER NOT NULL DEFAULT 0')
+        add_column(db_cursor, 'messages', 'nosend', 'INTEGER NOT NULL DEFAULT 0')
+        add_column(db_cursor, 'clients', 'mute_until', 'INTEGER')
+
+        # Backfill from the JSON meta
+        client_names = {}
+        for client_id, client_name, client_meta in db_cursor.execute('''SELECT "id", "name", "meta" FROM "clients" ORDER BY "id";''').fetchall():
+            if client_name:
+                client_names[client_name.lower()] = client_id
+            try:
+                mute_until = json.loads(client_meta).get('mute')
+            except (TypeError, ValueError, AttributeError):
+                continue
+            if mute_until is not None:
+                db_cursor.execute('''UPDATE "clients" SET "mute_until"=? WHERE "id"=?;''', (mute_until, client_id))
+
+        def migrate_routing(first_id, last_id):
+            batch = db_cursor.execute('''SELECT "id", "meta" FROM "messages"
+                                         WHERE "id" >= ? AND "id" <= ? AND "meta" IS NOT NULL;''', (first_id, last_id)).fetchall()
+            updates = []
+            for message_id, message_meta in batch:
+                try:
+                    load_meta = json.loads(message_meta)
+                except ValueError:
+                    continue
+                if not isinstance(load_meta, dict):
+                    continue
+                if 'to' in load_meta:
+                    target = str(load_meta['to'])
+                    if load_meta.get('dm') == True:
+                        if target.startswith('#') and target[1:].isdigit():
+                            updates.append((int(target[1:]), MESSAGE_KIND_DM, 0, message_id))
+                        else:
+                            updates.append((client_names.get(target.lower()), MESSAGE_KIND_DM, 0, message_id))
+                    elif 'su' in load_meta:
+                        updates.append((load_meta.get('id'), MESSAGE_KIND_SU, 0, message_id))
+                    else:
+                        updates.append((None, MESSAGE_KIND_CHAT, 1, message_id))
+                elif load_meta.get('nosend') == True:
+                    updates.append((None, MESSAGE_KIND_CHAT, 1, message_id))
+            db_cursor.executemany('''UPDATE "messages" SET "recipient_id"=?, "kind"=?, "nosend"=? WHERE "id"=?;''', updates)
+
+        migrate_batches(db, 2, migrate_routing)
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "messages_recipient_id" ON "messages" ("recipient_id", "id");''')
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "messages_client" ON "messages" ("client", "id");''')
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "messages_time" ON "messages" ("time");''')
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "clients_name" ON "clients" ("name" COLLATE NOCASE);''')
+        finish_migration(db, 2)
+
+    if version < 3:
+        db_cursor.execute('''BEGIN;''')
+        if fts5_available():
+            print('Migrating database to schema v3...')
+            # External content table, the text is only stored in messages
+            db_cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS "messages_fts" USING fts5("content", content="messages", content_rowid="id");''')
+            db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS "messages_fts_insert" AFTER INSERT ON "messages" WHEN new."nosend" = 0
+                                    BEGIN
+                                        INSERT INTO "messages_fts"("rowid", "content") VALUES (new."id", new."content");
+                                    END;''')
+            db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS "messages_fts_delete" AFTER DELETE ON "messages" WHEN old."nosend" = 0
+                                    BEGIN
+                                        INSERT INTO "messages_fts"("messages_fts", "rowid", "content") VALUES ('delete', old."id", old."content");
+                                    END;''')
+            db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS "messages_fts_update" AFTER UPDATE OF "content", "nosend" ON "messages"
+                                    BEGIN
+                                        INSERT INTO "messages_fts"("messages_fts", "rowid", "content")
+                                            SELECT 'delete', old."id", old."content" WHERE old."nosend" = 0;
+                                        INSERT INTO "messages_fts"("rowid", "content")
+                                            SELECT new."id", new."content" WHERE new."nosend" = 0;
+                                    END;''')
+            # Index the existing messages in batches of ids, a batch is never indexed twice
+            migrate_batches(db, 3, lambda first_id, last_id: db_cursor.execute(
+                '''INSERT INTO "messages_fts"("rowid", "content")
+                   SELECT "id", "content" FROM "messages"
+                   WHERE "id" >= ? AND "id" <= ? AND "nosend" = 0;''', (first_id, last_id)))
+        else:
+            print('FTS5 NOT AVAILABLE, MESSAGE SEARCH DISABLED')
+        finish_migration(db, 3)
+
+    if version < 4:
+        print('Migrating database to schema v4...')
+        db_cursor.execute('''BEGIN;''')
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "clients_online_name" ON "clients" ("name" COLLATE NOCASE, "id") WHERE "valid" = 1;''')
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "clients_online_address" ON "clients" ("address" COLLATE NOCASE, "id") WHERE "valid" = 1;''')
+        if fts5_available('trigram'):
+            db_cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS "clients_fts" USING fts5("name", "address", content="clients", content_rowid="id", tokenize="trigram");''')
+            db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS "clients_fts_insert" AFTER INSERT ON "clients" WHEN new."valid" = 1
+                                    BEGIN
+                                        INSERT INTO "clients_fts"("rowid", "name", "address") VALUES (new."id", new."name", new."address");
+                                    END;''')
+            db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS "clients_fts_delete" AFTER DELETE ON "clients" WHEN old."valid" = 1
+                                    BEGIN
+                                        INSERT INTO "clients_fts"("clients_fts", "rowid", "name", "address") VALUES ('delete', old."id", old."name", old."address");
+                                    END;''')
+            db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS "clients_fts_update" AFTER UPDATE OF "name", "address", "valid" ON "clients"
+                                    BEGIN
+                                        INSERT INTO "clients_fts"("clients_fts", "rowid", "name", "address")
+                                            SELECT 'delete', old."id", old."name", old."address" WHERE old."valid" = 1;
+                                        INSERT INTO "clients_fts"("rowid", "name", "address")
+                                            SELECT new."id", new."name", new."address" WHERE new."valid" = 1;
+                                    END;''')
+            db_cursor.execute('''INSERT INTO "clients_fts"("rowid", "name", "address")
+                                   SELECT "id", "name", "address" FROM "clients" WHERE "valid" = 1;''')
+        else:
+            print('FTS5 TRIGRAM TOKENIZER NOT AVAILABLE, CLIENT LOOKUP SCANS THE ONLINE CLIENTS')
+        finish_migration(db, 4)
+
+    if version < 5:
+        print('Migrating database to schema v5...')
+        db_cursor.execute('''BEGIN;''')
+        add_column(db_cursor, 'messages', 'client_msg_id', 'TEXT')
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "messages_client_msg_id" ON "messages" ("client", "client_msg_id") WHERE "client_msg_id" IS NOT NULL;''')
+        finish_migration(db, 5)
+
+    if version < 6:
+        print('Migrating database to schema v6...')
+        db_cursor.execute('''BEGIN;''')
+        add_column(db_cursor, 'messages', 'blob', 'TEXT')
+
+        # Backfill from the JSON meta of the messages with a blob
+        def migrate_blobs(first_id, last_id):
+            batch = db_cursor.execute('''SELECT "id", "meta" FROM "messages"
+                                         WHERE "id" >= ? AND "id" <= ? AND "meta" IS NOT NULL;''', (first_id, last_id)).fetchall()
+            updates = [(meta_blob(message_meta), message_id) for message_id, message_meta in batch
+                       if meta_blob(message_meta) is not None]
+            db_cursor.executemany('''UPDATE "messages" SET "blob"=? WHERE "id"=?;''', updates)
+
+        migrate_batches(db, 6, migrate_blobs)
+        db_cursor.execute('''CREATE INDEX IF NOT EXISTS "messages_blob" ON "messages" ("blob") WHERE "blob" IS NOT NULL;''')
+        finish_migration(db, 6)
+
+    db_cursor.execute('''DROP TABLE IF EXISTS "migration";''')
+    db.commit()
+
+
+migrate_database(db)
+SEARCH_ENABLED = bool(db_cursor.execute('''SELECT 1 FROM "sqlite_master" WHERE "name" = 'messages_fts';''').fetchall())
+LOOKUP_INDEXED = bool(db_cursor.execute('''SELECT 1 FROM "sqlite_master" WHERE "name" = 'clients_fts';''').fetchall())
+
+_db_local = threading.local()
+
+
+def get_db():
+    """Get the database connection of the current thread
+
+    sqlite handles must not be shared across a fork or between threads, so every process and every thread
+    opens its own connection on first use.
+    The connection is read-only, writes go through db_write().
+
+    Returns:
+        Method returns a tuple (connection, cursor)
+    """
+
+    if getattr(_db_local, 'pid', None) != os.getpid():
+        _db_local.pid = os.getpid()
+        _db_local.db = sqlite3.connect('file:{}?mode=ro'.format(DATABASE_FILE), uri=True)
+        _db_local.db_cursor = _db_local.db.cursor()
+    return _db_local.db, _db_local.db_cursor
+
+
+def get_archives():
+    """Get the connections of the current thread to the message archives
+
+    Returns:
+        Method returns a list of cursors, the newest archive first
+    """
+
+    if getattr(_db_local, 'archives_pid', None) != os.getpid():
+        _db_local.archives_pid = os.getpid()
+        _db_local.archives = {}
+    archive_cursors = []
+    for path in archive_paths(ArchiveDir):
+        if path not in _db_local.archives:
+            _db_local.archives[path] = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True).cursor()
+        archive_cursors.append(_db_local.archives[path])
+    return archive_cursors
+
+
+def read_archives(query, rows, before_id, limit):
+    """Continue a query of the latest messages before an id into the archives
+
+    Messages move to the archives the oldest first, so the archives are only read when the database has fewer
+    than limit messages before the id, the newest archive first
+
+    Args:
+        :param query: callable, runs the query on a cursor with (before_id, limit), returns rows in descending id order
+        :param rows: list, the rows of the query on the database
+        :param before_id: int, the before_id of the query on the database
+        :param limit: int, maximum number of rows
+
+    Returns:
+        Method returns a list of rows in descending id order
+    """
+
+    for archive_cursor in get_archives():
+        if len(rows) >= limit:
+            break
+        rows = rows + query(archive_cursor, rows[-1][0] if rows else before_id, limit - len(rows))
+    return rows
+
+
+broker_client = None
+broker_client_pid = None
+
+
+def get_broker():
+    """Get the broker connection of the current process
+
+    Returns:
+        Method returns a BrokerClient, or None if the broker is disabled or not available
+    """
+
+    global broker_client
+    global broker_client_pid
+    if not UseBroker:
+        return None
+    if broker_client_pid != os.getpid():
+        broker_client_pid = os.getpid()
+        try:
+            broker_client = BrokerClient(BrokerAddress)
+        except OSError as e:
+            log.error('BROKER NOT AVAILABLE', error=e)
+            broker_client = None
+    return broker_client
+
+
+def get_writer():
+    """Get the writer connection of the current thread
+
+    Returns:
+        Method returns a WriterClient connected to the writer process
+    """
+
+    if getattr(_db_local, 'writer_pid', None) != os.getpid():
+        _db_local.writer_pid = os.getpid()
+        _db_local.writer = WriterClient(WriterAddress)
+    return _db_local.writer
+
+
+def db_write(sql, params=(), durable=True, publish=False):
+    """Run a write request on the writer process
+
+    Args:
+        :param sql: str, statement to execute
+        :param params: tuple, parameters of the statement
+        :param durable: wait until the request is committed, otherwise only until it is executed
+        :param publish: bool, publish the row as a message once it is committed
+
+    Returns:
+        Method returns the request, with lastrowid, rowcount and rows
+    """
+
+    try:
+        return get_writer().execute(sql, params, durable, publish)
+    except OSError:
+        # Reconnect on next write
+        _db_local.writer_pid = None
+        raise
+
+
+def message_recipients(message):
+    """Get the clients a message is delivered to
+
+    Args:
+        :param message: list, [id, client, time, content, meta, recipient_id, kind, nosend, client_msg_id, blob]
+
+    Returns:
+        Method returns a list of client ids, or None if the message is delivered to everyone
+    """
+
+    if message[6] == MESSAGE_KIND_DM:
+        return [message[5], message[1]]
+    if message[6] == MESSAGE_KIND_SU:
+        return [message[1]]
+    if message[7]:
+        return []
+    return None
+
+
+def publish_message(message):
+    """Publish a stored message to the receivers
+
+    Args:
+        :param message: list, [id, client, time, content, meta, recipient_id, kind, nosend, client_msg_id, blob]
+    """
+
+    global broker_client_pid
+    publisher = get_broker()
+    if publisher is not None:
+        try:
+            event = {'type': 'message', 'message': message, 'recipients': message_recipients(message)}
+            payload = None
+            if event['recipients'] is None:
+                compressed = compress_broadcast(message)
+                if compressed is not None:
+                    event['compressed'], payload = compressed
+            publisher.publish(event, payload)
+        except OSError as e:
+            log.error('BROKER', error=e)
+            # Reconnect on next publish
+            broker_client_pid = None
+
+
+def store_message(client, message_time, content, meta=None, recipient_id=None, kind=MESSAGE_KIND_CHAT, nosend=0,
+                  client_msg_id=None, blob=None):
+    """Store a message and publish it to the receivers
+
+    The message is written by the writer process and published once its group is committed.
+    The method returns after the commit, or right after the write when Durability is "async".
+
+    Args:
+        :param client: int, id of the author
+        :param message_time: int, time of the message in milliseconds
+        :param content: str, content of the message
+        :param meta: str, meta of the message (JSON)
+        :param recipient_id: int, recipient of a DM, new identity of a SU
+        :param kind: int, MESSAGE_KIND_CHAT, MESSAGE_KIND_DM or MESSAGE_KIND_SU
+        :param nosend: int, 1 if the message is never delivered
+        :param client_msg_id: str, the id the author gave the message, see dedupe.py
+        :param blob: str, sha256 of the blob of the message (an attachment or a large body), see message_blob
+
+    Returns:
+        Method returns the id of the message
+    """
+
+    return db_write('''
+                    INSERT INTO "main"."messages"
+                    ("client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob")
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''', (client, message_time, content, meta, recipient_id, kind, nosend, client_msg_id, blob),
+                    Durability != 'async', True).lastrowid
+
+
+def stored_message_id(client_id, msg_id):
+    """Get the id of the message a client stored with a client_msg_id, None if there is none (see dedupe.py)"""
+
+    db, db_cursor = get_db()
+    row = db_cursor.execute('''SELECT "id" FROM "main"."messages"
+                               WHERE "client" = ? AND "client_msg_id" = ?
+                               ORDER BY "id" DESC LIMIT 1;''', (client_id, msg_id)).fetchone()
+    return None if row is None else row[0]
+
+
+def resolve_recipient(target):
+    """Resolve the target of a DM to a client id
+
+    Args:
+        :param target: str, '#<id>', '<node>:<id>' for a client of a peer or a nickname (case insensitive)
+
+    Returns:
+        Method returns the id of the client, or None if no client matches
+    """
+
+    if target.startswith('#') and target[1:].isdigit():
+        return int(target[1:])
+    db, db_cursor = get_db()
+    node, _, client_id = target.rpartition(':')
+    if node and client_id.isdigit():
+        client = db_cursor.execute('''SELECT "id" FROM "main"."clients"
+                                      WHERE "address" = ? COLLATE NOCASE;''', ('@' + target,)).fetchall()
+        return client[0][0] if client else None
+    client = db_cursor.execute('''SELECT "id" FROM "main"."clients"
+                                  WHERE "name" = ? COLLATE NOCASE
+                                  ORDER BY "valid" DESC, "id" DESC LIMIT 1;''', (target,)).fetchall()
+    if not client:
+        return None
+    return client[0][0]
+
+
+# Client records cached by id, ("id", "address", "code", "valid", "name", "mute_until")
+# The cache is only used in processes that receive the invalidation events of the broker
+client_cache = {}
+# valid, mute_until and name are read from the shared client table, created by the main process
+client_table = None
+client_cache_pid = None
+client_cache_epoch = 0
+
+
+def enable_client_cache():
+    global client_cache_pid
+    client_cache.clear()
+    client_cache_pid = os.getpid()
+
+
+def disable_client_cache():
+    global client_cache_pid
+    client_cache_pid = None
+    client_cache.clear()
+
+
+def invalidate_client_cache(client_id):
+    """Drop a cached client record
+
+    Args:
+        :param client_id: int, id of the client, None drops every record
+    """
+
+    global client_cache_epoch
+    client_cache_epoch += 1
+    if client_id is None:
+        client_cache.clear()
+    else:
+        client_cache.pop(client_id, None)
+
+
+def get_client(client_id):
+    """Get a client record, from the cache when possible
+
+    valid, mute_until and name come from the shared client table, so kicks and mutes apply at once in every process
+
+    Args:
+        :param client_id: int, id of the client
+
+    Returns:
+        Method returns a tuple ("id", "address", "code", "valid", "name", "mute_until"), or None if there is no such client
+    """
+
+    client = load_client_record(client_id)
+    if client is None or client_table is None:
+        return client
+    state = client_table.read(client_id)
+    if state is None:
+        return client
+    valid, mute_until, name = state
+    return client[0], client[1], client[2], valid, client[4] if name is None else name, mute_until
+
+
+def load_client_record(client_id):
+    """Get a client record from the cache, or from the database on a miss"""
+
+    if client_cache_pid == os.getpid():
+        client = client_cache.get(client_id)
+        if client is not None:
+            return client
+    # A record loaded while an invalidation arrives must not be cached
+    epoch = client_cache_epoch
+    db, db_cursor = get_db()
+    load_client = db_cursor.execute('''SELECT "id", "address", "code", "valid", "name", "mute_until"
+                                        FROM "main"."clients"
+                                        WHERE "id" = ?''', (client_id,)).fetchall()
+    if not load_client:
+        return None
+    if client_cache_pid == os.getpid() and epoch == client_cache_epoch:
+        client_cache[client_id] = load_client[0]
+    return load_client[0]
+
+
+def publish_client_change(client_id):
+    """Tell every process that a client record changed
+
+    Call after every write to the clients table, so that cached copies are dropped
+
+    Args:
+        :param client_id: int, id of the client, None for every client
+    """
+
+    global broker_client_pid
+    try:
+        client_id = None if client_id is None else int(client_id)
+    except (TypeError, ValueError):
+        client_id = None
+    update_client_table(client_id)
+    invalidate_client_cache(client_id)
+    publisher = get_broker()
+    if publisher is not None:
+        try:
+            publisher.publish({'type': 'client', 'client_id': client_id})
+        except OSError as e:
+            log.error('BROKER', error=e)
+            # Reconnect on next publish
+            broker_client_pid = None
+
+
+def update_client_table(client_id=None):
+    """Copy client records from the database to the shared client table
+
+    Args:
+        :param client_id: int, id of the client, None for every client
+    """
+
+    if client_table is None:
+        return
+    db, db_cursor = get_db()
+    # The records are read under the lock, so the last writer always copies the latest committed record
+    with client_table.lock:
+        if client_id is None:
+            clients = db_cursor.execute('''SELECT "id", "valid", "mute_until", "name" FROM "main"."clients";''').fetchall()
+        else:
+            clients = db_cursor.execute('''SELECT "id", "valid", "mute_until", "name" FROM "main"."clients"
+                                            WHERE "id" = ?;''', (client_id,)).fetchall()
+        for client in clients:
+            client_table.write(*client)
+
+
+def client_watcher(subscriber):
+    """Apply the invalidation events of the broker to the client cache until the broker is lost"""
+
+    try:
+        while True:
+            event = subscriber.recv()
+            if event['type'] == 'client':
+                invalidate_client_cache(event['client_id'])
+    except (OSError, ValueError) as e:
+        log.error('BROKER', error=e)
+        disable_client_cache()
+
+
+def watch_clients():
+    """Enable the client cache of this process
+
+    The invalidation events are received by a background thread,
+    the cache stays disabled when the broker is not available
+    """
+
+    if not UseBroker or client_cache_pid == os.getpid():
+        # Disabled, or already watched by this process (a prefork worker serves many connections)
+        return
+    try:
+        subscriber = BrokerClient(BrokerAddress, subscribe=True, types=['client'])
+    except OSError as e:
+        log.error('BROKER NOT AVAILABLE', error=e)
+        return
+    enable_client_cache()
+    threading.Thread(target=client_watcher, args=(subscriber,), daemon=True).start()
+
+
 # Detect and create default config file
 if not os.path.exists(CONFIG_FILE):
     print('Creating config file...')
@@ -103,11 +905,45 @@ if not os.path.exists(CONFIG_FILE):
             "AllowAdminCommands": True,
             "AllowNickname": True,
             "ServerName": "default",
-            "WelcomeMessage": "Welcome to PyChat Server!"
+            "WelcomeMessage": "Welcome to PyChat Server!",
+            "Engine": "process",
+            "ExecutorWorkers": 16,
+            "Workers": 1,
+            "PreforkWorkers": 4,
+            "MaxSessionsPerWorker": 1000,
+            "Broker": True,
+            "ReceiverBatchSize": 100,
+            "BackfillLimit": 1000,
+            "ClientTableSize": 65536,
+            "Durability": "group",
+            "GroupCommitRows": 64,
+            "GroupCommitMs": 5,
+            "RetentionDays": 0,
+            "ArchiveDir": "./archive",
+            "MaxMessageSize": 16777216,
+            "LargeMessageSize": 1048576,
+            "BlobDir": "./blobs",
+            "MaxUploadSize": 104857600,
+            "Compression": True,
+            "CompressionThreshold": 256,
+            "DedupeWindow": 1024,
+            "RateLimitRate": 20,
+            "RateLimitBurst": 40,
+            "RateLimitPolicy": "delay",
+            "MutedPolicy": "reply",
+            "ListenBacklog": 128,
+            "MaxConnections": 1024,
+            "MaxConnectionsPerIP": 64,
+            "AcceptRate": 100,
+            "AcceptBurst": 32,
+            "LogLevel": "info",
+            "LogFormat": "text",
+            "NodeName": "default",
+            "FederationPort": 0,
+            "FederationKey": "",
+            "Peers": {}
         }
         json.dump(dump_data, dump_file)
-if not os.path.exists('./MESSAGE_DUMP/'):
-    os.mkdir('./MESSAGE_DUMP')
 # Load config from file
 with open(CONFIG_FILE, 'r') as load_file:
     load_conf = json.load(load_file)
@@ -120,813 +956,2836 @@ AllowAdminCommands = load_conf['AllowAdminCommands']
 AllowNickname = load_conf['AllowNickname']
 ServerName = load_conf['ServerName']
 WelcomeMessage = load_conf['WelcomeMessage']
+Engine = load_conf.get('Engine', 'process')
+ExecutorWorkers = load_conf.get('ExecutorWorkers', 16)
+Workers = load_conf.get('Workers', 1)
+PreforkWorkers = load_conf.get('PreforkWorkers', 4)
+MaxSessionsPerWorker = load_conf.get('MaxSessionsPerWorker', 1000)
+UseBroker = load_conf.get('Broker', True)
+ReceiverBatchSize = load_conf.get('ReceiverBatchSize', 100)
+BackfillLimit = load_conf.get('BackfillLimit', 1000)
+ClientTableSize = load_conf.get('ClientTableSize', 65536)
+Durability = load_conf.get('Durability', 'group')
+GroupCommitRows = load_conf.get('GroupCommitRows', 64)
+GroupCommitMs = load_conf.get('GroupCommitMs', 5)
+RetentionDays = load_conf.get('RetentionDays', 0)
+ArchiveDir = load_conf.get('ArchiveDir', './archive')
+MaxMessageSize = load_conf.get('MaxMessageSize', 16777216)
+LargeMessageSize = load_conf.get('LargeMessageSize', 1048576)
+BlobDir = load_conf.get('BlobDir', './blobs')
+MaxUploadSize = load_conf.get('MaxUploadSize', 104857600)
+Compression = load_conf.get('Compression', True)
+CompressionThreshold = load_conf.get('CompressionThreshold', 256)
+DedupeWindow = load_conf.get('DedupeWindow', 1024)
+RateLimitRate = load_conf.get('RateLimitRate', 20)
+RateLimitBurst = load_conf.get('RateLimitBurst', 40)
+RateLimitPolicy = load_conf.get('RateLimitPolicy', POLICY_DELAY)
+MutedPolicy = load_conf.get('MutedPolicy', 'reply')
+ListenBacklog = load_conf.get('ListenBacklog', 128)
+MaxConnections = load_conf.get('MaxConnections', 1024)
+MaxConnectionsPerIP = load_conf.get('MaxConnectionsPerIP', 64)
+AcceptRate = load_conf.get('AcceptRate', 100)
+AcceptBurst = load_conf.get('AcceptBurst', 32)
+LogLevel = load_conf.get('LogLevel', 'info')
+LogFormat = load_conf.get('LogFormat', FORMAT_TEXT)
+NodeName = load_conf.get('NodeName', 'default')
+FederationPort = load_conf.get('FederationPort', 0)
+FederationKey = load_conf.get('FederationKey', '')
+Peers = load_conf.get('Peers', {})
+if 'BrokerAddress' in load_conf:
+    BrokerAddress = load_conf['BrokerAddress']
+elif hasattr(socket, 'AF_UNIX'):
+    BrokerAddress = './broker.sock'
+else:
+    BrokerAddress = ['127.0.0.1', port + 2]
+if 'WriterAddress' in load_conf:
+    WriterAddress = load_conf['WriterAddress']
+elif hasattr(socket, 'AF_UNIX'):
+    WriterAddress = './writer.sock'
+else:
+    WriterAddress = ['127.0.0.1', port + 3]
 
 if load_conf['Host'] != 'default':
     HOST = load_conf['Host']
+blob_store = BlobStore(BlobDir)
+
+# Created before any worker is forked, so that the log level is shared
+log = Log(LogSink(LogFormat), level_value(LogLevel))
+
+# Created before any worker is forked, so that the counters are shared
+if RateLimitRate > 0:
+    rate_limiter = RateLimiter(RateLimitRate, RateLimitBurst, RateLimitPolicy)
+else:
+    rate_limiter = None
+sender_admission = AdmissionController(MaxConnections, MaxConnectionsPerIP, AcceptRate, AcceptBurst)
+receiver_admission = AdmissionController(MaxConnections, MaxConnectionsPerIP, AcceptRate, AcceptBurst)
 
 if ServerName == 'default':
     ServerName = socket.gethostname()
+if NodeName == 'default':
+    NodeName = ServerName
 
 server_info = {
     'host': socket.gethostname(),
     'appid': 1,
     'portrcv': rx_port,
-    'name': ServerName
+    'name': ServerName,
+    'protocols': PROTOCOLS,
+    'acks': ACKS,
+    'compressions': COMPRESSIONS if Compression else []
 }
 
 
-def echo(cnn, message, header = {}):
-    try:
-        header['time'] = current_milli_time()
-        header['size'] = len(message.encode())
-        header['sha256'] = hashlib.sha256(message.encode()).hexdigest()
-        cnn.send(json.dumps(header).encode())
-        header_size = cnn.recv(1024).decode()
-        cnn.send(message.encode())
-        return 0
-    except Exception as e:
-        print('ECHO')
-        print(e)
+def negotiate_protocol(client_data):
+    """Get the protocol picked by the client in client_info, the legacy protocol if it is not supported"""
 
-def sender_main(cnn, addr):
-    """sender communication
+    if client_data.get('protocol') in PROTOCOLS:
+        return client_data['protocol']
+    return PROTOCOL_LEGACY
 
-    This method is used to communicate with the sender (client)
-    
-    Args:
-        :param cnn: socket object, for socket communication
-        :param addr: tuple, store the client address
 
-    Returns:
-        Method returns an integer
+def negotiate_ack(client_data):
+    """Get the ack mode picked by the client in client_info
 
-        Normal exit returns 0
+    Acknowledging by message id is only possible with frames, since the client may have several
+    messages in flight
     """
 
-    global AllowAdminCommands
-    global AllowNickname
-    errcount = 0
-    client_address = str(addr)
-    nickname = ''
-    print(client_address + ' Connected')
+    if client_data.get('ack') == ACK_ID and negotiate_protocol(client_data) == PROTOCOL_FRAME:
+        return ACK_ID
+    return ACK_ECHO
 
-    # Exchange info
-    cnn.send(json.dumps(server_info).encode())
-    client_data = json.loads(cnn.recv(1024).decode())
-    print(client_data)
-    client_session_data = {}
 
-    try:
-        db_cursor.execute('''INSERT INTO "main"."clients"("address","name","code","valid","meta") VALUES (?,NULL,NULL,0,?);''', (addr[0]+','+str(addr[1]), json.dumps(client_data),))
-        db.commit()
-    except Exception as e:
-        print(e)
-        client_session_data['success'] = False
-        cnn.send(json.dumps(client_session_data).encode())
-        cnn.close()
-        exit()
+def negotiate_compression(client_data):
+    """Get the compression picked by the client in client_info, None for no compression
 
-    # TODO: Add verification here
-    if client_data['appid'] != server_info['appid']:
-        print(client_address + ' Failed (AppID Not Match)')
-        cnn.close()
-        exit()
-    else:
-        client_session_data['success'] = True
+    Only frames flag a compressed body
+    """
 
-    # Generate credential
-    client_id = db_cursor.lastrowid
-    client_code_pre = str(current_milli_time()) + str(client_id) + str(random.randint(100000, 655360))
-    client_code = hashlib.sha512(client_code_pre.encode()).hexdigest()
+    if Compression and client_data.get('compression') in COMPRESSIONS and negotiate_protocol(client_data) == PROTOCOL_FRAME:
+        return client_data['compression']
+    return None
 
-    client_session_data['credential'] = {
-        'id': client_id,
-        'code': client_code
-    }
-    # Send session data to client
-    cnn.send(json.dumps(client_session_data).encode())
 
-    # Dump to db
-    if client_data['nickname'] != '':
-        client_alias = client_data['nickname']
-        nickname = client_data['nickname'].strip('#').strip('<').strip('>').strip(':')
-        use_nickname = True
-    else:
-        client_alias = str(addr)
-        use_nickname = False
-    db_cursor.execute('''
-                        UPDATE "main"."clients"
-                        SET "address"=?, "name"=?, "code"=?, valid=1
-                        WHERE "_rowid_"=?;
-                        ''', (addr[0]+','+str(addr[1]), nickname, client_code, client_id))
-    message_time = current_milli_time()
-    message_content = '{} [#{}] Connected'.format(client_alias, client_id)
-    db_cursor.execute('''
-                        INSERT INTO "main"."messages"
-                        ("client", "time", "content")
-                        VALUES (?, ?, ?);''', (0, message_time, message_content))
-    db.commit()
+# Compressed bodies by (sha256, compression), the receivers of a message get the bytes compressed for the first one,
+# or by the publish thread of the writer for a broadcast message (see compress_broadcast)
+COMPRESSED_CACHE_SIZE = 256
+compressed_bodies = collections.OrderedDict()
+compressed_bodies_lock = threading.Lock()
+# The compression of the broadcast messages compressed by the publish thread of the writer
+BROADCAST_COMPRESSION = COMPRESSION_DEFLATE_DICT
 
-    # Create a loop to receive and process messages
-    while True:
-        try:
-            message_id = -1
-            # Receive header
-            message_header_byte = cnn.recv(1024).decode()
-            message_header = json.loads(message_header_byte)
-            cnn.send(str(len(message_header_byte)).encode())
-            # Receive message
-            print(message_header['size'])
-            request = cnn.recv(message_header['size']).decode()
-            message_time = current_milli_time()
-            print(client_address + ': ' + str(message_header))
-            if len(request) > 80:
-                print(client_address + ': ' + request[:40] + '...' + request[-40:])
-            else:
-                print(client_address + ': ' + request)
-            # Validate credentials
-            try:
-                load_credential = db_cursor.execute('''SELECT "id", "code", "valid", "meta", "name"
-                                                        FROM "main"."clients"
-                                                        WHERE "id" = ?''', (client_id,)).fetchall()[0]
-                if not (load_credential[2]):
-                    print(client_address + ' Rejected (Invalid Credential)')
-                    echo(cnn, 'Invalid Credential', {'message_id': message_id})
-                    cnn.close()
-                    return 1
-            except:
-                print(client_address + ' Rejected (Invalid Credential)')
-                echo(cnn, '##Invalid Credential', {'message_id': message_id})
+
+def cache_compressed(key, compressed):
+    with compressed_bodies_lock:
+        compressed_bodies[key] = compressed
+        if len(compressed_bodies) > COMPRESSED_CACHE_SIZE:
+            compressed_bodies.popitem(last=False)
+
+
+def compress_broadcast(message):
+    """Compress the text of a broadcast message once for every receiver, in the publish thread of the writer
+
+    Args:
+        :param message: list, [id, client, time, content, meta, recipient_id, kind, nosend, ...]
+
+    Returns:
+        Method returns ([sha256 of the text, compression], compressed text), the event key and the payload of
+        the broker event, None if the text is not compressed (its content is under CompressionThreshold, it is streamed from a blob
+        or it does not shrink)
+    """
+
+    if not Compression or len(message[3]) < CompressionThreshold:
+        return None
+    text = message_text(message)
+    if text is None or isinstance(text, LargeText):
+        return None
+    body = text.encode()
+    compressed = compress(body, BROADCAST_COMPRESSION)
+    if compressed is None:
+        return None
+    return [hashlib.sha256(body).hexdigest(), BROADCAST_COMPRESSION], compressed
+
+
+def receive_compressed(event):
+    """Keep the text of a broadcast message compressed by the writer, frame_body sends it if the text matches"""
+
+    if 'compressed' in event:
+        digest, compression = event['compressed']
+        cache_compressed((digest, compression), event['payload'])
+
+
+def frame_body(header, body, compression=None):
+    """Get the body of a frame, compressed if the connection has a compression and the body is large enough
+
+    Args:
+        :param header: dict, header of the frame with the sha256 of the body, 'encoding' is set if it is compressed
+        :param body: bytes, the body
+        :param compression: str, the compression of the connection, None for no compression
+
+    Returns:
+        Method returns the bytes to send
+    """
+
+    if compression is None or len(body) < CompressionThreshold:
+        return body
+    key = (header['sha256'], compression)
+    with compressed_bodies_lock:
+        compressed = compressed_bodies.get(key, False)
+        if compressed is not False:
+            compressed_bodies.move_to_end(key)
+    if compressed is False:
+        compressed = compress(body, compression)
+        cache_compressed(key, compressed)
+    if compressed is None:
+        # It does not shrink
+        return body
+    header['encoding'] = compression
+    return compressed
+
+
+# Bytes of a large message kept in the database
+LARGE_MESSAGE_PREVIEW = 1024
+
+
+class LargeText(str):
+    """The text of a large message, or an attachment
+
+    The str is a preview of the text (what history, search and the logs show),
+    the text sent is prefix followed by the body kept in the file,
+    sha256 is the sha256 of the file when it is known (a blob), so that it is not read to send it without prefix
+    """
+
+    def __new__(cls, preview, prefix, file, sha256=None):
+        text = str.__new__(cls, preview)
+        text.prefix = prefix
+        text.file = file
+        text.sha256 = sha256
+        return text
+
+
+def body_spool(size, upload=False):
+    """Get the file a body of size bytes is received into
+
+    Returns:
+        Method returns a file object: in memory up to LargeMessageSize, a spool file of the blob store above
+        or for an attachment, None over MaxMessageSize (MaxUploadSize for an attachment, the body is discarded)
+    """
+
+    if upload:
+        if MaxUploadSize and size > MaxUploadSize:
+            return None
+        return blob_store.spool()
+    if MaxMessageSize and size > MaxMessageSize:
+        return None
+    if size > LargeMessageSize:
+        return blob_store.spool()
+    return io.BytesIO()
+
+
+def discard_spool(spool):
+    if isinstance(spool, io.BytesIO) or spool is None:
+        return
+    blob_store.discard(spool)
+
+
+def attachment_text(attachment):
+    """Get the text of the message of an attachment, what the receivers, history and search show"""
+
+    return '[FILE] {} ({} BYTES) ##download {}'.format(attachment['name'], attachment['size'], attachment['sha256'])
+
+
+def finish_body(message_header, spool, digest):
+    """Check a received body
+
+    A large body is kept in the blob store under its sha256, the header gets its name as 'file',
+    the body of an attachment (header['upload'] is its file name) is kept there whatever its size,
+    the header gets it as 'attachment' and the message is only a reference to it
+
+    Args:
+        :param message_header: dict, header of the message
+        :param spool: the file object returned by body_spool, with the body
+        :param digest: str, sha256 of the body (hex), None for an invalid compressed body
+
+    Returns:
+        Method returns a tuple (request, error)
+
+        request is the text of the message (LargeText for a large body), None if the body is refused
+        error is the reply to send instead when the body is refused
+    """
+
+    # Only set by the server
+    message_header.pop('file', None)
+    message_header.pop('attachment', None)
+    upload = message_header.pop('upload', None)
+    if spool is None:
+        return None, 'FILE TOO LARGE' if upload is not None else 'MESSAGE TOO LARGE'
+    if digest is None or ('sha256' in message_header and message_header['sha256'] != digest):
+        discard_spool(spool)
+        return None, 'MESSAGE CORRUPTED'
+    if upload is not None:
+        # Stored once, an identical upload only adds a reference
+        size = spool.tell()
+        blob_store.commit(spool, digest)
+        name = os.path.basename(str(upload).replace('\\', '/')).strip() or digest
+        message_header['attachment'] = {'name': name[:255], 'size': size, 'sha256': digest}
+        return attachment_text(message_header['attachment']), None
+    if isinstance(spool, io.BytesIO):
+        return spool.getvalue().decode(), None
+    # Check the encoding in chunks, the receivers decode the body
+    spool.seek(0)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        preview = decoder.decode(spool.read(LARGE_MESSAGE_PREVIEW))
+        for chunk in iter(lambda: spool.read(CHUNK_SIZE), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', True)
+    except UnicodeDecodeError:
+        discard_spool(spool)
+        return None, 'MESSAGE CORRUPTED'
+    if preview.startswith('#'):
+        # Commands are parsed from the text in memory
+        discard_spool(spool)
+        return None, 'MESSAGE TOO LARGE'
+    blob_store.commit(spool, digest)
+    message_header['file'] = digest
+    return LargeText(preview + ' ...', '', blob_store.path(digest), digest), None
+
+
+def query_result(rows):
+    """Get the text of the result of a query of ###dbcmd (JSON)
+
+    The JSON is encoded a chunk at a time, a result over LargeMessageSize bytes is written to the blob store
+    and sent from there like a large message
+
+    Args:
+        :param rows: list, rows of the result
+    Returns:
+        Method returns a str, or a LargeText for a large result
+    """
+
+    spool = io.BytesIO()
+    sha256 = hashlib.sha256()
+    pieces = []
+    pieces_size = 0
+    for piece in json.JSONEncoder().iterencode(rows):
+        pieces.append(piece)
+        pieces_size += len(piece)
+        if pieces_size >= CHUNK_SIZE:
+            spool = write_result(spool, sha256, pieces)
+            pieces, pieces_size = [], 0
+    spool = write_result(spool, sha256, pieces)
+    if isinstance(spool, io.BytesIO):
+        return spool.getvalue().decode()
+    digest = sha256.hexdigest()
+    spool.seek(0)
+    # The JSON is ASCII, a preview never splits a character
+    preview = spool.read(LARGE_MESSAGE_PREVIEW).decode()
+    blob_store.commit(spool, digest)
+    return LargeText(preview + ' ...', '', blob_store.path(digest), digest)
+
+
+def write_result(spool, sha256, pieces):
+    """Write a chunk of a query result, the result moves to a spool file of the blob store over LargeMessageSize"""
+
+    chunk = ''.join(pieces).encode()
+    sha256.update(chunk)
+    if isinstance(spool, io.BytesIO) and spool.tell() + len(chunk) > LargeMessageSize:
+        memory_spool, spool = spool, blob_store.spool()
+        spool.write(memory_spool.getbuffer())
+    spool.write(chunk)
+    return spool
+
+
+def body_inflater(message_header, spool):
+    """Get the Inflater of a compressed body (header['encoding']), None for a body that is not compressed"""
+
+    if 'encoding' not in message_header or spool is None:
+        # Not compressed, or refused (it is discarded as it is)
+        return None
+    # The body may not grow over the size in the header
+    max_size = body_size(message_header, 0)
+    return Inflater(spool, message_header.pop('encoding'), max_size)
+
+
+def body_size(message_header, size):
+    """Get the size of a body once decompressed
+
+    Args:
+        :param message_header: dict, header of the message
+        :param size: int, bytes of the body on the wire
+    """
+
+    if 'encoding' not in message_header:
+        return size
+    if not isinstance(message_header.get('size'), int) or message_header['size'] < 0:
+        return 0
+    return message_header['size']
+
+
+def receive_body(cnn, message_header, size):
+    """Receive the body of a message in chunks, see finish_body
+
+    Args:
+        :param cnn: socket object
+        :param message_header: dict, header of the message, its size is the size of the body once decompressed
+        :param size: int, bytes of the body on the wire
+    """
+
+    spool = body_spool(body_size(message_header, size), 'upload' in message_header)
+    inflater = body_inflater(message_header, spool)
+    try:
+        digest = recv_stream(cnn, size, spool if inflater is None else inflater)
+    except BaseException:
+        discard_spool(spool)
+        raise
+    if inflater is not None:
+        digest = inflater.hexdigest()
+    return finish_body(message_header, spool, digest)
+
+
+async def receive_body_async(reader, message_header, size):
+    """Receive the body of a message in chunks from an asyncio.StreamReader, see receive_body"""
+
+    spool = body_spool(body_size(message_header, size), 'upload' in message_header)
+    inflater = body_inflater(message_header, spool)
+    try:
+        digest = await read_stream(reader, size, spool if inflater is None else inflater)
+    except BaseException:
+        discard_spool(spool)
+        raise
+    if inflater is not None:
+        digest = inflater.hexdigest()
+    return finish_body(message_header, spool, digest)
+
+
+def message_digest(message, prefix, body_file):
+    """Get the size and the sha256 of a LargeText as it is sent, a blob sent without prefix is not read"""
+
+    if message.sha256 is not None and not prefix:
+        return os.fstat(body_file.fileno()).st_size, message.sha256
+    return stream_digest(prefix, body_file)
+
+
+def text_preview(text):
+    """Shorten a text for the log"""
+
+    if len(text) > 80:
+        return text[:40] + '...' + text[-40:]
+    return text
+
+
+def echo(cnn, message, header = {}, protocol = PROTOCOL_LEGACY, compression = None):
+    try:
+        header['time'] = current_milli_time()
+        if isinstance(message, LargeText):
+            # Streamed from the file, the header needs the size and sha256 first
+            with open(message.file, 'rb') as body_file:
+                prefix = message.prefix.encode()
+                header['size'], header['sha256'] = message_digest(message, prefix, body_file)
+                if protocol == PROTOCOL_FRAME:
+                    send_stream(cnn, pack_frame_head(header, header['size']) + prefix, body_file)
+                    return 0
+                cnn.send(json.dumps(header).encode())
+                header_size = cnn.recv(1024).decode()
+                send_stream(cnn, prefix, body_file)
+                return 0
+        header['size'] = len(message.encode())
+        header['sha256'] = hashlib.sha256(message.encode()).hexdigest()
+        if protocol == PROTOCOL_FRAME:
+            # Header and body in one frame, no ack
+            body = frame_body(header, message.encode(), compression)
+            send_frame(cnn, header, body)
+            return 0
+        cnn.send(json.dumps(header).encode())
+        header_size = cnn.recv(1024).decode()
+        cnn.send(message.encode())
+        return 0
+    except Exception as e:
+        log.error('ECHO', error=e)
+
+
+async def echo_async(reader, writer, message, header=None, protocol=PROTOCOL_LEGACY, compression=None):
+    """echo on an asyncio stream
+
+    Same exchange as echo(), but connection errors are raised so that the caller can end the session
+
+    Args:
+        :param reader: asyncio.StreamReader of the connection
+        :param writer: asyncio.StreamWriter of the connection
+        :param message: str, message to send
+        :param header: dict, extra header fields
+        :param protocol: str, protocol of the connection
+        :param compression: str, compression of the connection, None for no compression
+    """
+
+    if header is None:
+        header = {}
+    header['time'] = current_milli_time()
+    if isinstance(message, LargeText):
+        with open(message.file, 'rb') as body_file:
+            prefix = message.prefix.encode()
+            header['size'], header['sha256'] = message_digest(message, prefix, body_file)
+            if protocol == PROTOCOL_FRAME:
+                await write_stream(writer, pack_frame_head(header, header['size']) + prefix, body_file)
+                return 0
+            writer.write(json.dumps(header).encode())
+            await writer.drain()
+            if await reader.read(1024) == b'':
+                raise ConnectionResetError()
+            await write_stream(writer, prefix, body_file)
+            return 0
+    message_byte = message.encode()
+    header['size'] = len(message_byte)
+    header['sha256'] = hashlib.sha256(message_byte).hexdigest()
+    if protocol == PROTOCOL_FRAME:
+        writer.write(pack_frame(header, frame_body(header, message_byte, compression)))
+        await writer.drain()
+        return 0
+    writer.write(json.dumps(header).encode())
+    await writer.drain()
+    if await reader.read(1024) == b'':
+        raise ConnectionResetError()
+    writer.write(message_byte)
+    await writer.drain()
+    return 0
+
+
+# Refusals handled at the same time by the accept loop of the process engine, more are closed without a reason
+REFUSE_THREADS = 16
+REFUSE_TIMEOUT = 5
+refuse_semaphore = threading.BoundedSemaphore(REFUSE_THREADS)
+
+
+def refuse_connection(cnn, addr, reason, sender=True):
+    """Refuse a connection over the admission limits
+
+    The handshake is finished on a thread so that the accept loop is not blocked by the client:
+    a sender gets client_session_data with success set to False, a receiver gets the reason as a message
+
+    Args:
+        :param cnn: socket object, for socket communication
+        :param addr: tuple, store the client address
+        :param reason: str, the reason returned by the admission controller
+        :param sender: bool, the connection is a sender, otherwise a receiver
+    """
+
+    log.warning('REFUSED', client=str(addr), reason=reason)
+    if not refuse_semaphore.acquire(blocking=False):
+        cnn.close()
+        return
+    threading.Thread(target=refuse_handshake, args=(cnn, reason, sender), daemon=True).start()
+
+
+def refuse_handshake(cnn, reason, sender):
+    try:
+        cnn.settimeout(REFUSE_TIMEOUT)
+        cnn.send(json.dumps(server_info).encode())
+        client_data = json.loads(cnn.recv(1024).decode())
+        if sender:
+            cnn.send(json.dumps({'success': False, 'reason': reason}).encode())
+        else:
+            echo(cnn, reason, {}, negotiate_protocol(client_data))
+    except (OSError, ValueError):
+        pass
+    finally:
+        cnn.close()
+        refuse_semaphore.release()
+
+
+def reap_connections(connections, admission):
+    """Release the connections of the processes that have exited
+
+    Args:
+        :param connections: dict, the handler processes of a listener by the address they serve
+        :param admission: AdmissionController of the listener
+    """
+
+    for m in [m for m in connections if not m.is_alive()]:
+        m.join()
+        admission.release(connections.pop(m))
+
+
+def admission_handler(handler, admission, sender=True):
+    """Wrap a connection handler of the asyncio engine with admission control
+
+    Args:
+        :param handler: coroutine function, sender_main_async or receiver_main_async
+        :param admission: AdmissionController of the listener
+        :param sender: bool, the handler serves senders, otherwise receivers
+    """
+
+    async def handle(reader, writer):
+        addr = writer.get_extra_info('peername')[:2]
+        reason = admission.admit(addr[0])
+        if reason is None:
+            try:
+                return await handler(reader, writer)
+            finally:
+                admission.release(addr[0])
+        log.warning('REFUSED', client=str(addr), reason=reason)
+        try:
+            writer.write(json.dumps(server_info).encode())
+            await writer.drain()
+            client_data = json.loads((await asyncio.wait_for(reader.read(1024), REFUSE_TIMEOUT)).decode())
+            if sender:
+                writer.write(json.dumps({'success': False, 'reason': reason}).encode())
+                await writer.drain()
+            else:
+                await asyncio.wait_for(
+                    echo_async(reader, writer, reason, {}, negotiate_protocol(client_data)), REFUSE_TIMEOUT)
+        except (ConnectionError, ValueError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+        return 1
+
+    return handle
+
+
+def sender_register(addr, client_data):
+    """sender registration
+
+    This method creates the client record and the credential of a new sender
+
+    Args:
+        :param addr: tuple, store the client address
+        :param client_data: dict, client_info received from the client
+
+    Returns:
+        Method returns a tuple (client_session_data, session)
+
+        client_session_data is None when nothing should be sent back to the client
+        session is None when the connection should be closed
+    """
+
+    client_address = str(addr)
+    nickname = ''
+    client_session_data = {}
+
+    # A client sending the credential it kept resumes its identity, e.g. to retry its messages after a reconnect
+    resumed = resumed_client(client_data.get('resume'))
+    if resumed is None:
+        try:
+            client_write = db_write('''INSERT INTO "main"."clients"("address","name","code","valid","meta") VALUES (?,NULL,NULL,0,?);''', (addr[0]+','+str(addr[1]), json.dumps(client_data),))
+        except Exception as e:
+            log.error('REGISTRATION FAILED', client=client_address, error=e)
+            client_session_data['success'] = False
+            return client_session_data, None
+
+    # TODO: Add verification here
+    if client_data['appid'] != server_info['appid']:
+        log.warning('FAILED (APPID NOT MATCH)', client=client_address)
+        return None, None
+    else:
+        client_session_data['success'] = True
+
+    if resumed is None:
+        # Generate credential
+        client_id = client_write.lastrowid
+        client_code_pre = str(current_milli_time()) + str(client_id) + str(random.randint(100000, 655360))
+        client_code = hashlib.sha512(client_code_pre.encode()).hexdigest()
+    else:
+        client_id, client_code = resumed
+
+    client_session_data['credential'] = {
+        'id': client_id,
+        'code': client_code
+    }
+
+    # Dump to db
+    if client_data['nickname'] != '':
+        client_alias = client_data['nickname']
+        nickname = client_data['nickname'].strip('#').strip('<').strip('>').strip(':')
+        use_nickname = True
+    else:
+        client_alias = str(addr)
+        use_nickname = False
+    db_write('''
+                UPDATE "main"."clients"
+                SET "address"=?, "name"=?, "code"=?, valid=1
+                WHERE "_rowid_"=?;
+                ''', (addr[0]+','+str(addr[1]), nickname, client_code, client_id))
+    publish_client_change(client_id)
+    message_time = current_milli_time()
+    message_content = '{} [#{}] Connected'.format(client_alias, client_id)
+    store_message(0, message_time, message_content)
+
+    session = {
+        'addr': addr,
+        'client_address': client_address,
+        'client_id': client_id,
+        'nickname': nickname,
+        'use_nickname': use_nickname,
+        'allow_admin_commands': AllowAdminCommands,
+        'allow_nickname': AllowNickname,
+        'protocol': negotiate_protocol(client_data),
+        'ack': negotiate_ack(client_data),
+        'compression': negotiate_compression(client_data),
+        'paused': False,
+        'search': None,
+        'lookup': None,
+        'sent': SentMessages(DedupeWindow, stored_message_id),
+        'closed': None,
+        'delay': 0,
+        'log': log.bind(client=client_address, client_id=client_id)
+    }
+    session['log'].info('REGISTERED', nickname=nickname, protocol=session['protocol'], resumed=resumed is not None)
+    return client_session_data, session
+
+
+def resumed_client(resume):
+    """Get the identity a sender resumes with the credential it kept ("resume" in client_info)
+
+    The server and the clients of the peers are never resumed, nor a kicked client (kick clears its code)
+
+    Args:
+        :param resume: dict, {"id": <client id>, "code": <access code>}
+
+    Returns:
+        Method returns a tuple (client id, code), or None if the sender gets a new identity
+    """
+
+    if not isinstance(resume, dict) or not isinstance(resume.get('code'), str):
+        return None
+    client_id = resume.get('id')
+    if isinstance(client_id, bool) or not isinstance(client_id, int) or client_id == 0:
+        return None
+    db, db_cursor = get_db()
+    client = db_cursor.execute('''SELECT "id", "address", "code" FROM "main"."clients" WHERE "id" = ?;''', (client_id,)).fetchone()
+    if client is None or client[2] is None or (client[1] is not None and client[1].startswith('@')):
+        return None
+    if not hmac.compare_digest(client[2].encode(), resume['code'].encode()):
+        return None
+    return client[0], client[2]
+
+
+def sender_disconnected(session):
+    """sender disconnection
+
+    This method marks the sender offline after its connection is lost
+
+    Args:
+        :param session: dict, the sender session created by sender_register
+    """
+
+    session['log'].info('DISCONNECTED (UNEXPECTED)')
+    # Unless the client already resumed its identity on a new connection (the address is the one of the connection)
+    db_write('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=? AND "address"=?;''',
+             (session['client_id'], session['addr'][0]+','+str(session['addr'][1])))
+    publish_client_change(session['client_id'])
+    if session['paused']:
+        log.warning('SERVICE TERMINATED')
+        message_time = current_milli_time()
+        message_content = 'SERVICE TERMINATED, YOU MAY DISCONNECT NOW'
+        store_message(0, message_time, message_content)
+
+
+def process_request(session, message_header, request):
+    """request processing
+
+    This method processes one request received from the sender.
+    It never touches the socket, so the process engine and the asyncio engine share it.
+
+    Args:
+        :param session: dict, the sender session created by sender_register
+        :param message_header: dict, the header received with the request
+        :param request: str, the request received
+
+    Returns:
+        Method returns a list of replies, each reply is a tuple (message, header) to be echoed to the sender
+
+        session['delay'] is the time to wait before the replies are sent
+        session['closed'] is set to the exit code when the connection should be closed after the replies
+    """
+
+    db, db_cursor = get_db()
+    replies = []
+    message_id = -1
+    session['delay'] = 0
+
+    # The server was paused by this client, wait for "RESUME"
+    if session['paused']:
+        if request.strip().lower() != 'resume':
+            replies.append(('SERVER PAUSED, SEND "RESUME" TO RESUME', {'message_id': message_id}))
+            return replies
+        session['paused'] = False
+        message_time = current_milli_time()
+        message_content = 'SERVER RESUMED'
+        store_message(0, message_time, message_content)
+        session['log'].warning('SERVER RESUMED')
+        replies.append(('SERVER RESUMED', {'message_id': message_id}))
+        return replies
+
+    # Validate credentials
+    try:
+        load_credential = get_client(session['client_id'])
+        if not (load_credential[3]):
+            session['log'].warning('REJECTED (INVALID CREDENTIAL)')
+            replies.append(('Invalid Credential', {'message_id': message_id}))
+            session['closed'] = 1
+            return replies
+    except:
+        session['log'].warning('REJECTED (INVALID CREDENTIAL)')
+        replies.append(('##Invalid Credential', {'message_id': message_id}))
+        session['closed'] = 1
+        return replies
+
+    # Check mute
+    if load_credential[5] is not None and load_credential[5] > current_milli_time():
+        remain_mute_time = int((load_credential[5] - current_milli_time()) / 1000)
+        if rate_limiter is not None:
+            rate_limiter.count('muted')
+        if MutedPolicy == 'delay':
+            session['delay'] = 0.9
+        replies.append(('YOU ARE NOT ALLOWED TO SEND MESSAGES IN {} SECONDS'.format(str(remain_mute_time)), {'message_id': message_id}))
+        return replies
+
+    # Update nickname
+    session['nickname'] = load_credential[4]
+
+    # Detect if the received message is an instruction to the server
+    if len(request.strip()) > 2 and request[0] == '#':
+        message_time = current_milli_time()
+        message_content = request
+        cmd_meta_data = message_header
+        cmd_meta_data.update({'nosend': True})
+        
+        try:
+            cmd_meta_data_dump = json.dumps(cmd_meta_data)
+            message_id = store_message(session['client_id'], message_time, message_content, cmd_meta_data_dump, nosend=1)
+        except Exception:
+            replies.append(('SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {'message_id': message_id}))
+            return replies
+        if request[0:2] == '##' and request[2] != '#':
+            # Session command
+            request_cmd_session_fmt = request.lower()[2:].strip()
+            user_cmd = ' '.join(filter(lambda x: x, request_cmd_session_fmt.split(' '))).split(' ')
+            if user_cmd[0] == 'exit':
+                session['log'].info('DISCONNECTED')
+                db_write('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (session['client_id'],))
+                publish_client_change(session['client_id'])
+                cmd_meta_data['command_result'] = {'code': 0, 'message': 'Success'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                session['closed'] = 0
+                return replies
+            elif user_cmd[0] == 'welcome':
+                cmd_meta_data['command_result'] = {'code': 0, 'message': 'Success'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append((WelcomeMessage, {'message_id': message_id}))
+            elif len(user_cmd) > 1 and user_cmd[0] == 'nick':
+                if user_cmd[1] == 'get':
+                    if session['use_nickname']:
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': session['nickname']}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append((session['nickname'], {'message_id': message_id}))
+                    else:
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': '#NICKNAME NOT SET#'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('#NICKNAME NOT SET#', {'message_id': message_id}))
+                elif len(user_cmd) > 2 and user_cmd[1] == 'set':
+                    new_nickname = request[request.lower().find(user_cmd[2]):]
+                    new_nickname = new_nickname.strip('#').strip('<').strip('>').strip(':')
+                    db_write('''UPDATE "main"."clients" SET "name"=? WHERE "_rowid_"=?;''', (new_nickname, session['client_id'],))
+                    publish_client_change(session['client_id'])
+                    message_time = current_milli_time()
+                    if session['use_nickname']:
+                        client_alias = session['nickname']
+                    else:
+                        client_alias = str(session['addr'])
+                    message_content = client_alias + ' ==> ' + new_nickname
+                    store_message(0, message_time, message_content)
+                    session['use_nickname'] = True
+                    cmd_meta_data['command_result'] = {'code': 0, 'message': 'NICKNAME SET'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('NICKNAME SET', {'message_id': message_id}))
+                else:
+                    cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND', {'message_id': message_id}))
+            elif len(user_cmd) > 2 and user_cmd[0] == 'dm':
+                meta_data = json.dumps({'to': user_cmd[1], 'dm': True})
+                message_time = current_milli_time()
+                message_content = request[request.lower().find(user_cmd[2]):]
+                try:
+                    recipient_id = resolve_recipient(user_cmd[1])
+                    store_message(session['client_id'], message_time, message_content, meta_data, recipient_id, MESSAGE_KIND_DM)
+                    cmd_meta_data['command_result'] = {'code': 0, 'message': 'MESSAGE SENT'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('MESSAGE SENT', {'message_id': message_id}))
+                except Exception:
+                    replies.append(('SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {'message_id': message_id}))
+                    return replies
+            elif user_cmd[0] == 'history':
+                try:
+                    limit = min(int(user_cmd[1]), HISTORY_MAX_PAGE_SIZE) if len(user_cmd) > 1 else HISTORY_PAGE_SIZE
+                    before_id = int(user_cmd[2]) if len(user_cmd) > 2 else None
+                    # The command itself is not part of the history
+                    history = fetch_history(session['client_id'], message_id if before_id is None else before_id, limit)
+                except ValueError as e:
+                    cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND: ' + str(e)}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND: ' + str(e), {'message_id': message_id}))
+                    return replies
+                history_str = 'HISTORY:'
+                for message in reversed(history):
+                    text = message_text(message)
+                    if text is not None:
+                        history_str = history_str + '\n[{}] {}'.format(message[0], text)
+                # The id to ask for the next (older) page, None on the last page
+                next_before_id = history[-1][0] if len(history) == limit else None
+                cmd_meta_data['command_result'] = {'code': 0, 'message': '{} MESSAGES'.format(len(history))}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append((history_str, {'message_id': message_id, 'before_id': next_before_id}))
+            elif user_cmd[0] == 'search':
+                if not SEARCH_ENABLED:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'SEARCH NOT AVAILABLE'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('SEARCH NOT AVAILABLE', {'message_id': message_id}))
+                    return replies
+                # Every word must match, without the query syntax of FTS5
+                terms = request.strip()[2:].strip()[len('search'):].strip()
+                search_str = search_page(session, search_query(terms) if terms else None, session['client_id'])
+                cmd_meta_data['command_result'] = {'code': 0, 'message': search_str.split('\n')[0]}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append((search_str, {'message_id': message_id}))
+            elif len(user_cmd) > 1 and user_cmd[0] == 'download':
+                # Only a blob of a message the sender can see, other blobs are not found either
+                if not is_digest(user_cmd[1]) or not blob_visible(session['client_id'], user_cmd[1]) \
+                        or not blob_store.exists(user_cmd[1]):
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'FILE NOT FOUND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('FILE NOT FOUND', {'message_id': message_id}))
+                    return replies
+                cmd_meta_data['command_result'] = {'code': 0, 'message': 'FILE SENT'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                # Sent from the blob store with sendfile, the client saves the body instead of printing it
+                file = LargeText('[FILE {}]'.format(user_cmd[1]), '', blob_store.path(user_cmd[1]), user_cmd[1])
+                replies.append((file, {'message_id': message_id, 'download': user_cmd[1]}))
+            elif user_cmd[0] == 'su' and (len(user_cmd) > 2 or (len(user_cmd) > 1 and session['client_id'] == 0)):
+                try:
+                    new_uid = int(user_cmd[1])
+                    load_credential = db_cursor.execute('''SELECT "id", "code"
+                                                            FROM "main"."clients"
+                                                            WHERE "id" = ?''', (new_uid,)).fetchall()[0]
+                    if session['client_id'] == 0 or (user_cmd[2] == load_credential[1]):
+                        if new_uid == 0:
+                            session['allow_admin_commands'] = True
+                            session['allow_nickname'] = True
+                        meta_data = json.dumps({'to': '#'+str(session['client_id']),
+                                                 'su': True,
+                                                 'id': new_uid
+                                                 })
+                        try:
+                            message_time = current_milli_time()
+                            message_content = '#SU'
+                            store_message(session['client_id'], message_time, message_content, meta_data, new_uid, MESSAGE_KIND_SU)
+                            db_write('''UPDATE "main"."clients" SET "address"=? WHERE "_rowid_"=?;''',
+                                     (session['addr'][0]+','+str(session['addr'][1]), new_uid))
+                            publish_client_change(new_uid)
+                        except Exception:
+                            replies.append(('SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {'message_id': message_id}))
+                            return replies
+                        load_credential = db_cursor.execute('''SELECT "id", "name"
+                                                                                FROM "main"."clients"
+                                                                                WHERE "id" = ?''',
+                                                            (new_uid,)).fetchall()[0]
+                        session['client_id'] = new_uid
+                        if load_credential[1] == '' or load_credential[1] is None:
+                            session['use_nickname'] = False
+                            session['nickname'] = ''
+                        else:
+                            session['use_nickname'] = True
+                            session['nickname'] = load_credential[1]
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'SU SUCCESS'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('Welcome!', {'message_id': message_id}))
+                        return replies
+                    else:
+                        cmd_meta_data['command_result'] = {'code': 2, 'message': 'SU FAILURE'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('SU FAILURE!', {'message_id': message_id}))
+                        return replies
+                except Exception:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('CLIENT NOT FOUND', {'message_id': message_id}))
+            else:
+                cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append(('INVALID COMMAND', {'message_id': message_id}))
+            return replies
+
+        elif len(request.strip()) > 3 and request[0:3] == '###':
+            # Server command
+            if not session['allow_admin_commands']:
+                cmd_meta_data['command_result'] = {'code': 3, 'message': 'INVALID COMMAND: ADMIN COMMANDS NOT ALLOWED'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append(('INVALID COMMAND', {'message_id': message_id}))
+                return replies
+            request_cmd_server_fmt = request.lower()[3:].strip()
+            user_cmd = ' '.join(filter(lambda x: x, request_cmd_server_fmt.split(' '))).split(' ')
+            session['log'].info('SERVER COMMAND', command=' '.join(user_cmd))
+            if len(user_cmd) > 2 and user_cmd[0] == 'pause':
+                try:
+                    pause_time = int(user_cmd[1])
+                    resume_time = int(user_cmd[2])
+                except Exception:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND', {'message_id': message_id}))
+                    return replies
+                message_time = current_milli_time()
+                if resume_time > 0:
+                    message_content = 'THE SERVER WILL PAUSE AFTER {} SECONDS AND WILL REMAIN UNAVAILABLE FOR {} SECONDS'.format(pause_time, resume_time)
+                else:
+                    message_content = 'THE SERVER WILL PAUSE AFTER {} SECONDS AND WILL REMAIN UNAVAILABLE UNTIL IT IS RESUMED'.format(pause_time)
+                store_message(0, message_time, message_content)
+                time.sleep(pause_time)
+                message_time = current_milli_time()
+                message_content = 'SERVER PAUSED'.format(pause_time, resume_time)
+                store_message(0, message_time, message_content)
+                cmd_meta_data['command_result'] = {'code': 0, 'message': 'SERVER PAUSED'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                db_write('''UPDATE "main"."clients" SET "valid"=1 WHERE "_rowid_"=?;''', (session['client_id'],))
+                publish_client_change(session['client_id'])
+                log.warning('SERVER PAUSED', client_id=session['client_id'])
+                if resume_time > 0:
+                    time.sleep(resume_time)
+                else:
+                    # Remain paused until the client sends "RESUME"
+                    session['paused'] = True
+                    replies.append(('SERVER PAUSED, SEND "RESUME" TO RESUME', {'message_id': message_id}))
+                    return replies
+                message_time = current_milli_time()
+                message_content = 'SERVER RESUMED'.format(pause_time, resume_time)
+                store_message(0, message_time, message_content)
+                log.warning('SERVER RESUMED', client_id=session['client_id'])
+                replies.append(('SERVER RESUMED', {'message_id': message_id}))
+                return replies
+            elif user_cmd[0] == 'kick' and len(user_cmd) > 1:
+                target_client_id = user_cmd[1]
+                try:
+                    # The code is cleared so that the client cannot resume its identity
+                    kick_result = db_write('''UPDATE "main"."clients" SET "valid"=0, "code"=NULL WHERE "_rowid_"=?;''', (target_client_id,))
+                    publish_client_change(target_client_id)
+                    if kick_result.rowcount > 0:
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'KICKED'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('KICKED', {'message_id': message_id}))
+                    else:
+                        cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('CLIENT NOT FOUND', {'message_id': message_id}))
+                except Exception:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND', {'message_id': message_id}))
+                return replies
+            elif user_cmd[0] == 'mute' and len(user_cmd) > 2:
+                target_client_id = user_cmd[1]
+                try:
+                    load_credential = db_cursor.execute('''SELECT "id", "code", "valid", "mute_until", "name"
+                                FROM "main"."clients"
+                                WHERE "id" = ?''', (target_client_id,)).fetchall()[0]
+                    mute_time = int(user_cmd[2])*1000
+                    mute_until = current_milli_time() + mute_time
+                    try:
+                        db_write('''UPDATE "main"."clients" SET "mute_until"=? WHERE "_rowid_"=?;''',
+                                 (mute_until, target_client_id,))
+                        publish_client_change(target_client_id)
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'MUTE'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('MUTE', {'message_id': message_id}))
+                    except Exception:
+                        cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data, message_id,))
+                        replies.append(('CLIENT NOT FOUND', {'message_id': message_id}))
+                    return replies
+                except Exception:
+                    cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND', {'message_id': message_id}))
+                    return replies
+            elif user_cmd[0] == 'unmute' and len(user_cmd) > 1:
+                target_client_id = user_cmd[1]
+                try:
+                    load_meta = db_cursor.execute('''SELECT "id", "address", "name", "code", "valid", "mute_until" FROM "main"."clients" WHERE "id" = ?''', (target_client_id,)).fetchall()[0]
+                    db_write('''UPDATE "main"."clients" SET "mute_until"=NULL WHERE "_rowid_"=?;''',
+                             (target_client_id,))
+                    publish_client_change(target_client_id)
+                    cmd_meta_data['command_result'] = {'code': 0, 'message': 'UNMUTE'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('UNMUTE', {'message_id': message_id}))
+                except Exception as e:
+                    session['log'].warning('CLIENT NOT FOUND', target=target_client_id, error=e)
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('CLIENT NOT FOUND', {'message_id': message_id}))
+            elif len(user_cmd) > 1 and user_cmd[0] == 'get':
+                if user_cmd[1] == 'id':
+                    # ###get id <name or address> [exact|prefix|substring], ###get id alone gets the next page
+                    if len(user_cmd) > 3 and user_cmd[3] not in LOOKUP_MODES:
+                        cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('INVALID COMMAND', {'message_id': message_id}))
+                        return replies
+                    if len(user_cmd) > 2:
+                        target_str = lookup_page(session, user_cmd[2], user_cmd[3] if len(user_cmd) > 3 else LOOKUP_SUBSTRING)
+                    else:
+                        target_str = lookup_page(session)
+                    cmd_meta_data['command_result'] = {'code': 0, 'message': target_str.strip('\n')}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append((target_str.strip('\n'), {'message_id': message_id}))
+                    return replies
+                elif user_cmd[1] == 'cdt':
+                    try:
+                        target_client_id = int(user_cmd[2])
+                        if target_client_id == 0:
+                            cmd_meta_data['command_result'] = {'code': 2, 'message': 'OPERATION NOT ALLOWED'}
+                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                            db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                            replies.append(('OPERATION NOT ALLOWED', {'message_id': message_id}))
+                            return replies
+                        load_credential = db_cursor.execute('''SELECT "id", "code"
+                                                                FROM "main"."clients"
+                                                                WHERE "id" = ?''',
+                                                            (target_client_id,)).fetchall()[0]
+                        target_str = 'ID:\n' + str(load_credential[0]) + '\nAccess Code:\n' + load_credential[1]
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': target_str}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append((target_str, {'message_id': message_id}))
+                        return replies
+                    except Exception as e:
+                        cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND: ' + str(e)}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('INVALID COMMAND: ' + str(e), {'message_id': message_id}))
+                        return replies
+                else:
+                    cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND', {'message_id': message_id}))
+            elif len(user_cmd) > 2 and user_cmd[0] == 'block':
+                pass
+            elif user_cmd[0] == 'search':
+                if not SEARCH_ENABLED:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'SEARCH NOT AVAILABLE'}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('SEARCH NOT AVAILABLE', {'message_id': message_id}))
+                    return replies
+                # The query syntax of FTS5 is available, every message is searched
+                query = request.strip()[3:].strip()[len('search'):].strip()
+                try:
+                    search_str = search_page(session, query if query else None, None)
+                except sqlite3.OperationalError as e:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND: ' + str(e)}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append(('INVALID COMMAND: ' + str(e), {'message_id': message_id}))
+                    return replies
+                cmd_meta_data['command_result'] = {'code': 0, 'message': search_str.split('\n')[0]}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append((search_str, {'message_id': message_id}))
+            elif user_cmd[0] == 'stats':
+                stats = rate_limiter.stats() if rate_limiter is not None else {}
+                stats['senders'] = sender_admission.stats()
+                stats['receivers'] = receiver_admission.stats()
+                stats = json.dumps(stats)
+                cmd_meta_data['command_result'] = {'code': 0, 'message': stats}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append((stats, {'message_id': message_id}))
+            elif user_cmd[0] == 'log' and (len(user_cmd) == 1 or (user_cmd[1] == 'level' and len(user_cmd) < 4)):
+                # ###log [level] shows the log level, ###log level <level> changes it in every process
+                if len(user_cmd) == 3:
+                    try:
+                        log.level = level_value(user_cmd[2])
+                    except ValueError as e:
+                        cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND: ' + str(e)}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        replies.append(('INVALID COMMAND: ' + str(e), {'message_id': message_id}))
+                        return replies
+                    log.warning('LOG LEVEL CHANGED', client_id=session['client_id'], log_level=LEVEL_NAMES[log.level])
+                log_str = 'LOG LEVEL ' + LEVEL_NAMES[log.level]
+                cmd_meta_data['command_result'] = {'code': 0, 'message': log_str}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append((log_str, {'message_id': message_id}))
+            elif user_cmd[0] == 'dbcmd' and len(user_cmd) > 1:
+                try:
+                    sql = request[request.lower().find(user_cmd[1]):]
+                    session['log'].warning('QUERY', sql=sql)
+                    res = query_result(db_write(sql).rows)
+                    # The statement may have changed any client
+                    publish_client_change(None)
+                    replies.append((res, {'message_id': message_id}))
+                    if isinstance(res, LargeText):
+                        # Streamed from the blob store, the database only keeps its sha256
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'RESULT TOO LONG', 'meta': {'file': res.sha256}}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        session['log'].info('QUERY END, RESULT TOO LONG', file=res.sha256)
+                    elif len(res) > 8192:
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'RESULT TOO LONG'}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        session['log'].info('QUERY END, RESULT TOO LONG', result=text_preview(res))
+                    else:
+                        cmd_meta_data['command_result'] = {'code': 0, 'message': res}
+                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                        db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                        session['log'].info('QUERY END', result=text_preview(res))
+                except Exception as e:
+                    cmd_meta_data['command_result'] = {'code': 2, 'message': str(e)}
+                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                    db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                    replies.append((str(e), {'message_id': message_id}))
+                return replies
+            else:
+                cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
+                cmd_meta_data_dump = json.dumps(cmd_meta_data)
+                db_write('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
+                replies.append(('INVALID COMMAND', {}))
+            return replies
+
+    # Send message
+    msg_id = client_msg_id(message_header)
+    if msg_id is not None:
+        message_id = session['sent'].get(session['client_id'], msg_id)
+        if message_id is not None:
+            # A retry, acknowledged again without storing or delivering the message twice
+            if session['ack'] == ACK_ID:
+                replies.append(('', {'message_id': message_id, 'ack': message_header.get('sha256'), 'duplicate': True}))
+            else:
+                replies.append((request, {'message_id': message_id, 'duplicate': True}))
+            return replies
+    message_time = current_milli_time()
+    message_content = request
+    meta_data = json.dumps(message_header)
+    try:
+        message_id = store_message(session['client_id'], message_time, message_content, meta_data, client_msg_id=msg_id,
+                                   blob=message_blob(message_header))
+    except Exception as e:
+        # The write failed in the writer (or the writer is not reachable), nothing was stored
+        session['log'].error('STORE FAILED', error=e)
+        replies.append(('SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {}))
+        return replies
+    if msg_id is not None:
+        session['sent'].add(session['client_id'], msg_id, message_id)
+
+    # The received message is returned to the client receiver to help the client confirm that the message has
+    # been delivered.
+    if session['ack'] == ACK_ID:
+        # Only acknowledge the message id and the sha256 sent by the client
+        replies.append(('', {'message_id': message_id, 'ack': message_header.get('sha256')}))
+    else:
+        replies.append((request, {'message_id': message_id}))
+    return replies
+
+
+def admit_request(session):
+    """Rate limit a request of the sender
+
+    Args:
+        :param session: dict, the sender session created by sender_register
+
+    Returns:
+        Method returns a tuple (delay, replies)
+
+        delay is the time to wait before the request is processed, the caller must not block other clients
+        replies is None when the request may be processed, otherwise the replies to send instead
+    """
+
+    if rate_limiter is None:
+        return 0, None
+    delay = rate_limiter.admit(session['client_id'])
+    if delay is None:
+        session['delay'] = 0
+        return 0, [('TOO MANY MESSAGES, PLEASE SLOW DOWN', {'message_id': -1})]
+    return delay, None
+
+
+def sender_main(cnn, addr):
+    """sender communication
+
+    This method is used to communicate with the sender (client)
+
+    Args:
+        :param cnn: socket object, for socket communication
+        :param addr: tuple, store the client address
+
+    Returns:
+        Method returns an integer
+
+        Normal exit returns 0
+    """
+
+    errcount = 0
+    client_address = str(addr)
+
+    # Exchange info
+    cnn.send(json.dumps(server_info).encode())
+    client_data = json.loads(cnn.recv(1024).decode())
+    log.debug('CONNECTED', client=client_address, client_info=client_data)
+    client_session_data, session = sender_register(addr, client_data)
+    # Send session data to client
+    if client_session_data is not None:
+        cnn.send(json.dumps(client_session_data).encode())
+    if session is None:
+        cnn.close()
+        exit()
+    # Serve the client records of this process from memory
+    watch_clients()
+
+    # Create a loop to receive and process messages
+    while True:
+        try:
+            if session['protocol'] == PROTOCOL_FRAME:
+                message_header, body_size = recv_frame_head(cnn)
+            else:
+                # Receive header
+                message_header_byte = cnn.recv(1024).decode()
+                if message_header_byte == '':
+                    # Closed by the client, release the connection at once
+                    raise ConnectionResetError()
+                message_header = json.loads(message_header_byte)
+                cnn.send(str(len(message_header_byte)).encode())
+                # Only frames are compressed
+                message_header.pop('encoding', None)
+                body_size = message_header['size']
+            # Receive message
+            request, refusal = receive_body(cnn, message_header, body_size)
+            if refusal is not None:
+                session['log'].warning('MESSAGE REFUSED', reason=refusal, header=message_header)
+                echo(cnn, refusal, {'message_id': -1}, session['protocol'])
+                continue
+            if session['log'].enabled(DEBUG):
+                # The header is changed by process_request before the record is written
+                session['log'].debug('MESSAGE', header=dict(message_header), text=text_preview(request))
+
+            '''
+            If the client is disconnected, the server may receive an empty message indefinitely.
+            If an empty message is received, a message is sent to the client receiver to confirm if that client is still alive.
+            '''
+            if request == '':
+                time.sleep(0.5)
+                if session['protocol'] == PROTOCOL_FRAME:
+                    echo(cnn, 'ACTIVE', {}, session['protocol'])
+                else:
+                    cnn.send('ACTIVE'.encode())
+                continue
+
+            delay, replies = admit_request(session)
+            if delay:
+                time.sleep(delay)
+            if replies is None:
+                replies = process_request(session, message_header, request)
+            time.sleep(session['delay'])
+            for reply in replies:
+                echo(cnn, reply[0], reply[1], session['protocol'], session['compression'])
+            if session['closed'] is not None:
+                cnn.close()
+                return session['closed']
+            errcount = 0
+
+        except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
+            sender_disconnected(session)
+            cnn.close()
+            return 0
+        except Exception as e:
+            session['log'].error('SENDER', error=e)
+            echo(cnn, 'ACTIVE', {}, session['protocol'])
+            time.sleep(1)
+            errcount += 1
+            if errcount >= 10:
+                sender_disconnected(session)
                 cnn.close()
+                return 0
+            continue
+
+
+async def sender_main_async(reader, writer):
+    """sender communication (asyncio)
+
+    Coroutine version of sender_main, database work is sent to the executor
+
+    Args:
+        :param reader: asyncio.StreamReader of the connection
+        :param writer: asyncio.StreamWriter of the connection
+
+    Returns:
+        Method returns an integer
+
+        Normal exit returns 0
+    """
+
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')[:2]
+    errcount = 0
+    client_address = str(addr)
+
+    # Exchange info
+    try:
+        writer.write(json.dumps(server_info).encode())
+        await writer.drain()
+        client_data = json.loads((await reader.read(1024)).decode())
+        log.debug('CONNECTED', client=client_address, client_info=client_data)
+        client_session_data, session = await loop.run_in_executor(executor, sender_register, addr, client_data)
+        # Send session data to client
+        if client_session_data is not None:
+            writer.write(json.dumps(client_session_data).encode())
+            await writer.drain()
+    except Exception as e:
+        log.error('HANDSHAKE FAILED', client=client_address, error=e)
+        writer.close()
+        return 1
+    if session is None:
+        writer.close()
+        return 1
+
+    # Create a loop to receive and process messages
+    while True:
+        try:
+            if session['protocol'] == PROTOCOL_FRAME:
+                message_header, body_size = await read_frame_head(reader)
+            else:
+                # Receive header
+                message_header_byte = (await reader.read(1024)).decode()
+                if message_header_byte == '':
+                    raise ConnectionResetError()
+                message_header = json.loads(message_header_byte)
+                writer.write(str(len(message_header_byte)).encode())
+                await writer.drain()
+                # Only frames are compressed
+                message_header.pop('encoding', None)
+                body_size = message_header['size']
+            # Receive message
+            request, refusal = await receive_body_async(reader, message_header, body_size)
+            if refusal is not None:
+                session['log'].warning('MESSAGE REFUSED', reason=refusal, header=message_header)
+                await echo_async(reader, writer, refusal, {'message_id': -1}, session['protocol'])
+                continue
+            if session['log'].enabled(DEBUG):
+                # The header is changed by process_request before the record is written
+                session['log'].debug('MESSAGE', header=dict(message_header), text=text_preview(request))
+
+            if request == '':
+                await asyncio.sleep(0.5)
+                if session['protocol'] == PROTOCOL_FRAME:
+                    await echo_async(reader, writer, 'ACTIVE', {}, session['protocol'])
+                else:
+                    writer.write('ACTIVE'.encode())
+                    await writer.drain()
+                continue
+
+            delay, replies = admit_request(session)
+            if delay:
+                await asyncio.sleep(delay)
+            if replies is None:
+                replies = await loop.run_in_executor(executor, process_request, session, message_header, request)
+            await asyncio.sleep(session['delay'])
+            for reply in replies:
+                await echo_async(reader, writer, reply[0], reply[1], session['protocol'], session['compression'])
+            if session['closed'] is not None:
+                writer.close()
+                return session['closed']
+            errcount = 0
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await loop.run_in_executor(executor, sender_disconnected, session)
+            writer.close()
+            return 0
+        except Exception as e:
+            session['log'].error('SENDER', error=e)
+            errcount += 1
+            if errcount >= 10:
+                await loop.run_in_executor(executor, sender_disconnected, session)
+                writer.close()
+                return 0
+            try:
+                await echo_async(reader, writer, 'ACTIVE', {}, session['protocol'])
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            await asyncio.sleep(1)
+            continue
+
+
+def receiver_launcher():
+    """receiver launcher
+
+    This method is used to create a child process that communicates with the receiver (client)
+    """
+
+    rxs = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    rxs.bind((HOST, rx_port))
+    rxs.listen(ListenBacklog)
+    # Receiver processes by the address they serve
+    connections = {}
+
+    while True:
+        try:
+            # Listening port, waiting for connection (for receivers)
+            rxcnn, addr = rxs.accept()
+            reap_connections(connections, receiver_admission)
+            reason = receiver_admission.admit(addr[0])
+            if reason is not None:
+                refuse_connection(rxcnn, addr, reason, False)
+                continue
+            m = multiprocessing.Process(target=receiver_main, args=(
+                rxcnn,
+                addr,
+            ))
+            # Enable daemon
+            m.daemon = True
+            # Initiate a subprocess
+            m.start()
+            rxcnn.close()
+            connections[m] = addr[0]
+
+        except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
+            pass
+        except Exception as e:
+            log.error('RECEIVER ACCEPT', error=e)
+            continue
+
+
+def receiver_register(addr, client_data):
+    """receiver registration
+
+    This method validates the credential sent by the receiver (client)
+
+    Args:
+        :param addr: tuple, store the client address
+        :param client_data: dict, client_info received from the receiver
+
+    Returns:
+        Method returns the receiver session (dict), or None if validation fails
+    """
+
+    client_address = str(addr)
+    client_id = client_data['id']
+    client_credential = client_data['code']
+
+    # Validate credentials
+    try:
+        load_credential = get_client(client_id)
+        if not ((load_credential[2] == client_credential) and load_credential[3] and (
+                load_credential[1].split(',')[0] == addr[0])):
+            db_write('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (client_id,))
+            publish_client_change(client_id)
+            log.warning('RX REJECTED (INVALID CREDENTIAL)', client=client_address, client_id=client_id)
+            return None
+    except:
+        log.warning('RX REJECTED (INVALID CREDENTIAL)', client=client_address, client_id=client_id)
+        return None
+
+    return {
+        'addr': addr,
+        'client_address': client_address,
+        'client_id': client_id,
+        'client_credential': client_credential,
+        'protocol': negotiate_protocol(client_data),
+        'compression': negotiate_compression(client_data),
+        'since_id': client_data.get('since_id'),
+        'closed': False,
+        'log': log.bind(client=client_address, client_id=client_id, role='rx')
+    }
+
+
+def receiver_route(rx, message):
+    """message routing
+
+    This method decides what a receiver gets for a message from the messages table
+
+    Args:
+        :param rx: dict, the receiver session created by receiver_register
+        :param message: tuple, ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob") of the message
+
+    Returns:
+        Method returns the text to send, or None if the message is not for this receiver
+
+        rx['closed'] is set when the connection should be closed after the text is sent
+    """
+
+    client_id = rx['client_id']
+    addr = rx['addr']
+    # Validate credentials
+    try:
+        load_credential = get_client(client_id)
+        if not ((load_credential[2] == rx['client_credential']) and load_credential[3] and (
+                load_credential[1].split(',')[0] == addr[0])):
+            rx['log'].warning('RX REJECTED (INVALID CREDENTIAL)')
+            rx['closed'] = True
+            return 'Invalid Credential'
+    except:
+        rx['log'].warning('RX REJECTED (INVALID CREDENTIAL)')
+        rx['closed'] = True
+        return 'Invalid Credential'
+
+    # Send message
+    if message[6] == MESSAGE_KIND_DM:
+        if message[5] != client_id and message[1] != client_id:
+            return None
+        return message_text(message)
+    elif message[6] == MESSAGE_KIND_SU:
+        # A SU message goes to the receivers of its author, recipient_id is the new identity
+        if message[1] != client_id:
+            return None
+        rx['client_id'] = message[5]
+        load_credential = get_client(rx['client_id'])
+        rx['client_credential'] = load_credential[2]
+        return 'Identity change to ' + str(rx['client_id'])
+    elif message[7]:
+        return None
+
+    return message_text(message)
+
+
+def message_text(message):
+    """Get the text a receiver is sent for a broadcast message or a DM, None for a hidden message
+
+    Args:
+        :param message: tuple, ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob") of the message
+    """
+
+    if message[3] == '#':
+        return None
+    client = get_client(message[1])
+    if message[6] == MESSAGE_KIND_DM:
+        prefix = '<DM> {} [#{}]: '.format(client_alias(client), client[0])
+    else:
+        prefix = '{} [#{}]: '.format(client_alias(client), str(client[0]))
+    digest = large_message_blob(message)
+    if digest is not None and blob_store.exists(digest):
+        # A large message, the database only keeps its preview
+        return LargeText(prefix + message[3], prefix, blob_store.path(digest))
+    return prefix + message[3]
+
+
+def large_message_blob(message):
+    """Get the sha256 of the body of a large message, None for another message
+
+    The meta is only read for a message with a blob, which is either a large body ('file') or an attachment
+    (whose text is the content)
+
+    Args:
+        :param message: tuple, ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob") of the message
+    """
+
+    if message[9] is None:
+        return None
+    try:
+        load_meta = json.loads(message[4])
+    except (TypeError, ValueError):
+        return None
+    return message[9] if isinstance(load_meta, dict) and load_meta.get('file') == message[9] else None
+
+
+def receiver_main(rxcnn, addr):
+    """receiver communication
+
+    This method is used to communicate with the receiver (client)
+
+    Args:
+        :param rxcnn: socket object, for socket communication
+        :param addr: tuple, store the client address
+
+    Returns:
+        Method returns an integer
+
+        Normal exit returns 0
+        Validation fails returns 1
+    """
+
+    errcount = 0
+    client_address = str(addr)
+
+    log.debug('RX CONNECTED', client=client_address)
+    # Receive credential from the client
+    rxcnn.send(json.dumps(server_info).encode())
+    client_data = json.loads(rxcnn.recv(1024).decode())
+
+    rx = receiver_register(addr, client_data)
+    if rx is None:
+        echo(rxcnn, 'Invalid Credential', {}, negotiate_protocol(client_data))
+        rxcnn.close()
+        return 1
+
+    # Send welcome message
+    # rxcnn.send(WelcomeMessage.encode())
+    echo(rxcnn, WelcomeMessage, {}, rx['protocol'])
+
+    # Create a loop to send messages
+    db, db_cursor = get_db()
+    subscriber = None
+    if UseBroker:
+        try:
+            subscriber = BrokerClient(BrokerAddress, subscribe=True, client_id=rx['client_id'])
+            enable_client_cache()
+        except OSError as e:
+            log.error('BROKER NOT AVAILABLE', error=e)
+    # The cursor is the id of the last message handled, messages are always handled in id order.
+    # It is read after subscribing, so every message stored later is pushed by the broker.
+    latest_id = latest_message_id()
+    cursor = backfill_cursor(rx, latest_id)
+    backfill = cursor < latest_id
+    pending = []
+    while True:
+        try:
+            if not pending:
+                if backfill:
+                    # Catch up with the messages missed since since_id, then wait for the broker
+                    pending = fetch_messages(cursor, client_id=rx['client_id'])
+                    backfill = len(pending) == ReceiverBatchSize
+                    continue
+                if subscriber is None:
+                    # Poll the messages of this receiver from the database
+                    pending = fetch_messages(cursor, client_id=rx['client_id'])
+                    if not pending:
+                        time.sleep(0.05)
+                    continue
+                # Wait until the broker pushes a new message
+                try:
+                    event = subscriber.recv()
+                except OSError as e:
+                    log.error('BROKER', error=e)
+                    subscriber = None
+                    disable_client_cache()
+                    continue
+                if event['type'] == 'client':
+                    invalidate_client_cache(event['client_id'])
+                    continue
+                if event['type'] != 'message' or event['message'][0] <= cursor:
+                    continue
+                receive_compressed(event)
+                pending = [event['message']]
+                continue
+            message = pending.pop(0)
+            cursor = message[0]
+
+            # Send message
+            client_id = rx['client_id']
+            message_send = receiver_route(rx, message)
+            if rx['client_id'] != client_id and subscriber is not None:
+                # Identity changed, receive the messages of the new client
+                subscriber.subscribe(client_id=rx['client_id'])
+            if message_send is None:
+                continue
+            # rxcnn.send(message_send.encode())
+            echo(rxcnn, message_send, {'message_id': message[0]}, rx['protocol'], rx['compression'])
+            if rx['closed']:
+                rxcnn.close()
+                return 1
+            errcount = 0
+            if rx['log'].enabled(DEBUG):
+                rx['log'].debug('SENT', message_id=message[0], text=text_preview(message_send))
+
+        except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
+            rx['log'].info('RX DISCONNECTED (UNEXPECTED)')
+            rxcnn.close()
+            try:
+                db.commit()
+            except Exception:
+                pass
+            return 0
+
+        except Exception as e:
+            rx['log'].error('RECEIVER', error=e)
+            if errcount >= 3:
+                rx['log'].info('RX DISCONNECTED (UNEXPECTED)')
+                rxcnn.close()
+                try:
+                    db.commit()
+                except Exception:
+                    pass
+                return 0
+            errcount += 1
+            continue
+
+
+async def receiver_main_async(reader, writer):
+    """receiver communication (asyncio)
+
+    Coroutine version of receiver_main, messages are handed over by message_poller
+
+    Args:
+        :param reader: asyncio.StreamReader of the connection
+        :param writer: asyncio.StreamWriter of the connection
+
+    Returns:
+        Method returns an integer
+
+        Normal exit returns 0
+        Validation fails returns 1
+    """
+
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')[:2]
+    client_address = str(addr)
+
+    log.debug('RX CONNECTED', client=client_address)
+    queue = asyncio.Queue()
+    rx = None
+    try:
+        # Receive credential from the client
+        writer.write(json.dumps(server_info).encode())
+        await writer.drain()
+        client_data = json.loads((await reader.read(1024)).decode())
+
+        rx = await loop.run_in_executor(executor, receiver_register, addr, client_data)
+        if rx is None:
+            await echo_async(reader, writer, 'Invalid Credential', {}, negotiate_protocol(client_data))
+            return 1
+
+        # Send welcome message
+        await echo_async(reader, writer, WelcomeMessage, {}, rx['protocol'])
+
+        # Create a loop to send messages
+        add_receiver_queue(rx['client_id'], queue)
+        latest_id = await loop.run_in_executor(executor, latest_message_id)
+        cursor = await loop.run_in_executor(executor, backfill_cursor, rx, latest_id)
+        backfill = cursor < latest_id
+        pending = []
+        while True:
+            if not pending and backfill:
+                # Catch up with the messages missed since since_id, the queue holds the messages stored meanwhile
+                pending = await loop.run_in_executor(executor, fetch_messages, cursor, None, rx['client_id'])
+                backfill = len(pending) == ReceiverBatchSize
+            if pending:
+                message = pending.pop(0)
+            else:
+                message = await queue.get()
+            if message[0] <= cursor:
+                continue
+            cursor = message[0]
+            client_id = rx['client_id']
+            message_send = await loop.run_in_executor(executor, receiver_route, rx, message)
+            if rx['client_id'] != client_id:
+                # Identity changed, receive the messages of the new client
+                remove_receiver_queue(client_id, queue)
+                add_receiver_queue(rx['client_id'], queue)
+            if message_send is None:
+                continue
+            await echo_async(reader, writer, message_send, {'message_id': message[0]}, rx['protocol'], rx['compression'])
+            if rx['closed']:
                 return 1
+            if rx['log'].enabled(DEBUG):
+                rx['log'].debug('SENT', message_id=message[0], text=text_preview(message_send))
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        log.info('RX DISCONNECTED (UNEXPECTED)', client=client_address)
+        return 0
+    except Exception as e:
+        log.error('RECEIVER', client=client_address, error=e)
+        log.info('RX DISCONNECTED (UNEXPECTED)', client=client_address)
+        return 0
+    finally:
+        if rx is not None:
+            remove_receiver_queue(rx['client_id'], queue)
+        writer.close()
+
+
+def fetch_messages(after_id, limit=None, client_id=None):
+    """Get the messages stored after a message id
+
+    Args:
+        :param after_id: int, id of the last message delivered (the cursor)
+        :param limit: int, maximum number of messages, ReceiverBatchSize by default
+        :param client_id: int, only get the messages delivered to this client
+
+    Returns:
+        Method returns a list of ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob") in id order
+    """
+
+    if limit is None:
+        limit = ReceiverBatchSize
+    db, db_cursor = get_db()
+    if client_id is None:
+        messages = db_cursor.execute('''SELECT "id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob"
+                                        FROM messages WHERE "id" > ? ORDER BY "id" LIMIT ?;''', (after_id, limit)).fetchall()
+    else:
+        messages = db_cursor.execute('''SELECT "id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob"
+                                        FROM messages
+                                        WHERE "id" > ? AND "nosend" = 0 AND ("kind" = ? OR "recipient_id" = ? OR "client" = ?)
+                                        ORDER BY "id" LIMIT ?;''', (after_id, MESSAGE_KIND_CHAT, client_id, client_id, limit)).fetchall()
+    return messages
+
+
+# Messages in a page of ##search
+SEARCH_PAGE_SIZE = 20
+
+
+def search_query(terms):
+    """Turn the words typed by a user into an FTS5 query matching messages that contain all of them"""
+
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms.split())
+
+
+def search_messages(query, client_id=None, before_id=None, limit=SEARCH_PAGE_SIZE):
+    """Search the messages with the full-text index, the newest first
+
+    The index is walked backwards from before_id and stops after limit matches, like fetch_history,
+    the archives are searched after the database
+
+    Args:
+        :param query: str, FTS5 query
+        :param client_id: int, only get the messages this client can see, None for every message
+        :param before_id: int, only get the messages before this id, None for the latest messages
+        :param limit: int, maximum number of messages
+
+    Returns:
+        Method returns a list of ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob") in
+        descending id order, raises sqlite3.OperationalError for an invalid query
+    """
+
+    def search(db_cursor, before_id, limit):
+        if client_id is None:
+            return db_cursor.execute('''SELECT m."id", m."client", m."time", m."content", m."meta", m."recipient_id", m."kind", m."nosend",
+                                               m."client_msg_id", m."blob"
+                                        FROM "messages_fts" JOIN "messages" m ON m."id" = "messages_fts"."rowid"
+                                        WHERE "messages_fts" MATCH ? AND "messages_fts"."rowid" < ?
+                                        ORDER BY "messages_fts"."rowid" DESC LIMIT ?;''', (query, before_id, limit)).fetchall()
+        return db_cursor.execute('''SELECT m."id", m."client", m."time", m."content", m."meta", m."recipient_id", m."kind", m."nosend",
+                                               m."client_msg_id", m."blob"
+                                    FROM "messages_fts" JOIN "messages" m ON m."id" = "messages_fts"."rowid"
+                                    WHERE "messages_fts" MATCH ? AND "messages_fts"."rowid" < ?
+                                    AND (m."kind" = ? OR (m."kind" = ? AND (m."recipient_id" = ? OR m."client" = ?)))
+                                    ORDER BY "messages_fts"."rowid" DESC LIMIT ?;''',
+                                 (query, before_id, MESSAGE_KIND_CHAT, MESSAGE_KIND_DM, client_id, client_id, limit)).fetchall()
+
+    if before_id is None:
+        before_id = latest_message_id() + 1
+    db, db_cursor = get_db()
+    return read_archives(search, search(db_cursor, before_id, limit), before_id, limit)
+
+
+def search_page(session, query=None, client_id=None):
+    """Get the next page of a search of a sender
+
+    Args:
+        :param session: dict, the sender session, session['search'] keeps the search between pages
+        :param query: str, FTS5 query of a new search, None for the next page of the last search
+        :param client_id: int, only search the messages this client can see, None for every message
+
+    Returns:
+        Method returns the text of the page
+    """
+
+    if query is not None:
+        search = {'query': query, 'client_id': client_id, 'before_id': None}
+    else:
+        search = session['search']
+    if search is None:
+        return 'NO SEARCH'
+    if search['before_id'] == 0:
+        return 'SEARCH: NO MORE RESULTS'
+    results = search_messages(search['query'], search['client_id'], search['before_id'])
+    # 0 after the last page
+    search['before_id'] = results[-1][0] if len(results) == SEARCH_PAGE_SIZE else 0
+    session['search'] = search
+    search_str = 'SEARCH:'
+    for message in results:
+        text = message_text(message)
+        if text is not None:
+            search_str = search_str + '\n[{}] {}'.format(message[0], text)
+    if search['before_id'] != 0:
+        search_str = search_str + '\n(SEND THE SEARCH COMMAND WITHOUT TERMS FOR MORE)'
+    return search_str
+
+
+# Messages in a page of ##history
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+# Clients in a page of ###get id
+LOOKUP_PAGE_SIZE = 20
+
+LOOKUP_EXACT = 'exact'
+LOOKUP_PREFIX = 'prefix'
+LOOKUP_SUBSTRING = 'substring'
+LOOKUP_MODES = [LOOKUP_EXACT, LOOKUP_PREFIX, LOOKUP_SUBSTRING]
+
+
+def like_escape(term):
+    """Escape the wildcards of LIKE in a term, for LIKE ... ESCAPE '\\'"""
+
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def lookup_clients(term, mode=LOOKUP_SUBSTRING, before_id=None, limit=LOOKUP_PAGE_SIZE):
+    """Look up the online clients by name or address (case insensitive), the newest first
+
+    Exact and prefix matches seek the partial indexes of the online clients, substring matches of 3 or more
+    characters use the trigram index, shorter ones (or every one without the trigram tokenizer) scan the partial
+    indexes, so a lookup never reads the offline clients
+
+    Args:
+        :param term: str, the name or address to look for
+        :param mode: LOOKUP_EXACT, LOOKUP_PREFIX or LOOKUP_SUBSTRING
+        :param before_id: int, only get the clients before this id, None for the latest clients
+        :param limit: int, maximum number of clients
+
+    Returns:
+        Method returns a list of ("id", "address", "name") in descending id order
+    """
+
+    if before_id is None:
+        before_id = sys.maxsize
+    db, db_cursor = get_db()
+    if mode == LOOKUP_SUBSTRING and LOOKUP_INDEXED and len(term) >= 3:
+        return db_cursor.execute('''SELECT c."id", c."address", c."name"
+                                    FROM "clients_fts" JOIN "clients" c ON c."id" = "clients_fts"."rowid"
+                                    WHERE "clients_fts" MATCH ? AND "clients_fts"."rowid" < ? AND c."valid" = 1
+                                    ORDER BY "clients_fts"."rowid" DESC LIMIT ?;''',
+                                 ('"' + term.replace('"', '""') + '"', before_id, limit)).fetchall()
+    if mode == LOOKUP_EXACT:
+        condition, pattern = '= ? COLLATE NOCASE', term
+    elif mode == LOOKUP_PREFIX:
+        condition, pattern = "LIKE ? ESCAPE '\\'", like_escape(term) + '%'
+    else:
+        condition, pattern = "LIKE ? ESCAPE '\\'", '%' + like_escape(term) + '%'
+    # Names and addresses
+    return db_cursor.execute('''SELECT * FROM (
+                                    SELECT * FROM (SELECT "id", "address", "name" FROM "clients"
+                                                   WHERE "valid" = 1 AND "name" {0} AND "id" < ?
+                                                   ORDER BY "id" DESC LIMIT ?)
+                                    UNION
+                                    SELECT * FROM (SELECT "id", "address", "name" FROM "clients"
+                                                   WHERE "valid" = 1 AND "address" {0} AND "id" < ?
+                                                   ORDER BY "id" DESC LIMIT ?)
+                                )
+                                ORDER BY "id" DESC LIMIT ?;'''.format(condition),
+                             (pattern, before_id, limit, pattern, before_id, limit, limit)).fetchall()
+
+
+def lookup_page(session, term=None, mode=LOOKUP_SUBSTRING):
+    """Get the next page of a client lookup of a sender
+
+    Args:
+        :param session: dict, the sender session, session['lookup'] keeps the lookup between pages
+        :param term: str, the name or address of a new lookup, None for the next page of the last lookup
+        :param mode: LOOKUP_EXACT, LOOKUP_PREFIX or LOOKUP_SUBSTRING
+
+    Returns:
+        Method returns the text of the page
+    """
+
+    if term is not None:
+        lookup = {'term': term, 'mode': mode, 'before_id': None}
+    else:
+        lookup = session['lookup']
+    if lookup is None:
+        return 'NO LOOKUP'
+    if lookup['before_id'] == 0:
+        return 'RES: NO MORE RESULTS'
+    results = lookup_clients(lookup['term'], lookup['mode'], lookup['before_id'])
+    # 0 after the last page
+    lookup['before_id'] = results[-1][0] if len(results) == LOOKUP_PAGE_SIZE else 0
+    session['lookup'] = lookup
+    target_str = 'RES:\n'
+    for item in results:
+        target_str = target_str + str(item) + '\n'
+    if lookup['before_id'] != 0:
+        target_str = target_str + '(SEND ###get id FOR MORE)\n'
+    return target_str
+
+
+def fetch_history(client_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+    """Get the messages a client can see stored before a message id, the newest first
+
+    Keyset pagination: every part of the query seeks an index to before_id and stops after limit rows,
+    so a page costs the same however deep in the history it is, the archives are read after the database
+
+    Args:
+        :param client_id: int, id of the client
+        :param before_id: int, only get the messages before this id, None for the latest messages
+        :param limit: int, maximum number of messages
+
+    Returns:
+        Method returns a list of ("id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob") in
+        descending id order
+    """
+
+    def history(db_cursor, before_id, limit):
+        # Broadcast messages, DMs received and DMs sent
+        return db_cursor.execute('''SELECT * FROM (
+                                        SELECT * FROM (SELECT "id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob"
+                                                       FROM messages WHERE "id" < ? AND "kind" = ? AND "nosend" = 0
+                                                       ORDER BY "id" DESC LIMIT ?)
+                                        UNION
+                                        SELECT * FROM (SELECT "id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob"
+                                                       FROM messages WHERE "recipient_id" = ? AND "id" < ? AND "kind" = ? AND "nosend" = 0
+                                                       ORDER BY "id" DESC LIMIT ?)
+                                        UNION
+                                        SELECT * FROM (SELECT "id", "client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob"
+                                                       FROM messages WHERE "client" = ? AND "id" < ? AND "kind" = ? AND "nosend" = 0
+                                                       ORDER BY "id" DESC LIMIT ?)
+                                    )
+                                    ORDER BY "id" DESC LIMIT ?;''',
+                                 (before_id, MESSAGE_KIND_CHAT, limit,
+                                  client_id, before_id, MESSAGE_KIND_DM, limit,
+                                  client_id, before_id, MESSAGE_KIND_DM, limit,
+                                  limit)).fetchall()
+
+    if before_id is None:
+        before_id = latest_message_id() + 1
+    db, db_cursor = get_db()
+    return read_archives(history, history(db_cursor, before_id, limit), before_id, limit)
+
+
+def blob_visible(client_id, digest):
+    """Check that a client can see a message with a blob, the broadcast messages and its DMs like fetch_history
+
+    The database and the archives are looked up by the index of messages.blob
+
+    Args:
+        :param client_id: int, id of the client
+        :param digest: str, sha256 of the blob
+    """
+
+    visible = '''"nosend" = 0 AND ("kind" = ? OR ("kind" = ? AND ("recipient_id" = ? OR "client" = ?)))'''
+    visible_params = (MESSAGE_KIND_CHAT, MESSAGE_KIND_DM, client_id, client_id)
+    db, db_cursor = get_db()
+    if db_cursor.execute('''SELECT 1 FROM messages WHERE "blob" = ? AND ''' + visible + ''' LIMIT 1;''',
+                         (digest,) + visible_params).fetchall():
+        return True
+    for archive_cursor in get_archives():
+        if archive_cursor.execute('''SELECT 1 FROM messages WHERE "blob" = ? AND ''' + visible + ''' LIMIT 1;''',
+                                  (digest,) + visible_params).fetchall():
+            return True
+    return False
+
+
+def backfill_cursor(rx, latest_id):
+    """Get the cursor a receiver starts from
+
+    A client that reconnects sends since_id, the id of the last message it received, in client_info and
+    gets the messages it missed first, at most BackfillLimit of them
+
+    Args:
+        :param rx: dict, the receiver session created by receiver_register
+        :param latest_id: int, id of the latest message when the receiver subscribed
+
+    Returns:
+        Method returns the id of the last message handled, latest_id if nothing is backfilled
+    """
+
+    since_id = rx['since_id']
+    if not isinstance(since_id, int) or not 0 <= since_id < latest_id or BackfillLimit <= 0:
+        return latest_id
+    history = fetch_history(rx['client_id'], latest_id + 1, BackfillLimit)
+    if len(history) == BackfillLimit:
+        since_id = max(since_id, history[-1][0] - 1)
+    return since_id
+
+
+def latest_message_id():
+    """Get the id of the latest message, 0 if there is none"""
+
+    db, db_cursor = get_db()
+    # The sequence of AUTOINCREMENT, it still counts the messages moved to the archives
+    return db_cursor.execute('''SELECT max("seq") FROM "sqlite_sequence" WHERE "name" = 'messages';''').fetchall()[0][0] or 0
+
+
+def add_receiver_queue(client_id, queue):
+    receiver_queues.setdefault(client_id, set()).add(queue)
+
+
+def remove_receiver_queue(client_id, queue):
+    queues = receiver_queues.get(client_id)
+    if queues is not None:
+        queues.discard(queue)
+        if not queues:
+            del receiver_queues[client_id]
+
+
+def dispatch_message(message):
+    """Hand a message over to the queues of the receivers it is delivered to
+
+    A DM only reaches the queues of its recipients, its cost does not depend on the number of receivers
+    """
+
+    recipients = message_recipients(message)
+    if recipients is None:
+        for queues in receiver_queues.values():
+            for queue in queues:
+                queue.put_nowait(message)
+        return
+    for client_id in set(recipients):
+        for queue in receiver_queues.get(client_id, ()):
+            queue.put_nowait(message)
+
+
+async def message_poller():
+    """Hand new messages over to every asyncio receiver
+
+    One poller serves all receivers of the event loop, instead of every receiver polling the database
+    """
+
+    loop = asyncio.get_running_loop()
+    cursor = await loop.run_in_executor(executor, latest_message_id)
+    while True:
+        try:
+            messages = await loop.run_in_executor(executor, fetch_messages, cursor)
+        except Exception as e:
+            log.error('DELIVERY', error=e)
+            messages = []
+        for message in messages:
+            cursor = message[0]
+            dispatch_message(message)
+        # Keep reading while a full batch is returned
+        if len(messages) < ReceiverBatchSize:
+            await asyncio.sleep(0.05)
+
+
+async def broker_listener():
+    """Hand the messages pushed by the broker over to every asyncio receiver
+
+    Messages are handed over in id order, a message pushed after a gap (e.g. published by another writer
+    first) makes the listener catch up from the database
+    """
+
+    loop = asyncio.get_running_loop()
+    cursor = await loop.run_in_executor(executor, latest_message_id)
+    while True:
+        try:
+            if isinstance(BrokerAddress, str):
+                reader, writer = await asyncio.open_unix_connection(BrokerAddress, limit=2**26)
+            else:
+                reader, writer = await asyncio.open_connection(BrokerAddress[0], BrokerAddress[1], limit=2**26)
+            writer.write(encode_event({'op': 'subscribe'}))
+            await writer.drain()
+            enable_client_cache()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionResetError('broker disconnected')
+                event = json.loads(line)
+                if 'payload' in event:
+                    event['payload'] = await reader.readexactly(event['payload'])
+                if event['type'] == 'client':
+                    invalidate_client_cache(event['client_id'])
+                    continue
+                if event['type'] != 'message' or event['message'][0] <= cursor:
+                    continue
+                receive_compressed(event)
+                message = event['message']
+                while message[0] > cursor + 1:
+                    messages = await loop.run_in_executor(executor, fetch_messages, cursor)
+                    if not messages:
+                        break
+                    for catch_up_message in messages:
+                        if catch_up_message[0] < message[0]:
+                            cursor = catch_up_message[0]
+                            dispatch_message(catch_up_message)
+                    if messages[-1][0] >= message[0]:
+                        break
+                cursor = message[0]
+                dispatch_message(message)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            log.error('BROKER', error=e)
+            disable_client_cache()
+            await asyncio.sleep(1)
+
+
+def broker_launcher(listener):
+    """broker launcher
+
+    This method runs the message broker on the listening socket
+    """
+
+    Broker(listener, log=log).serve_forever()
+
+
+def writer_launcher(listener):
+    """writer launcher
+
+    This method runs the database writer on the listening socket, it owns the only read-write connection
+    """
+
+    if Durability == 'message':
+        writer = GroupCommitWriter(DATABASE_FILE, 1, 0, log=log)
+    else:
+        writer = GroupCommitWriter(DATABASE_FILE, GroupCommitRows, GroupCommitMs / 1000, log=log)
+    if RetentionDays > 0:
+        retention = RetentionEngine(DATABASE_FILE, writer, RetentionDays, ArchiveDir, SEARCH_ENABLED, log=log)
+        threading.Thread(target=retention.serve_forever, daemon=True).start()
+    # Messages are published in commit order by their own thread, the commit thread only queues them
+    published = queue.Queue()
+    threading.Thread(target=publisher_main, args=(published,), daemon=True).start()
+    on_publish = lambda request: published.put([request.lastrowid] + list(request.params))
+    WriterServer(listener, writer, on_publish, log=log).serve_forever()
+
+
+def publisher_main(published):
+    """Publish the messages committed by the writer, compressing the broadcast ones (see compress_broadcast)"""
+
+    while True:
+        publish_message(published.get())
+
+
+# Local ids of the clients of the peers by (node, client id), in the federation process
+federation_clients = {}
+
+
+def client_alias(client):
+    """Get the name a client is shown with, its address if it has no nickname"""
+
+    if not client[4]:
+        return str((client[1].split(',')[0], int(client[1].split(',')[1])))
+    return client[4]
+
+
+def is_federated(client):
+    """Check if a client record stands for a client of a peer (its address is '@<node>:<client id>')"""
+
+    return client[1] is not None and client[1].startswith('@')
+
+
+def federation_client(node, client_id, name=None, online=None):
+    """Get the local id of a client of a peer, the record is created on first use
+
+    Args:
+        :param node: str, name of the peer
+        :param client_id: int, id of the client on the peer
+        :param name: str, name the client is shown with on the peer, None to keep it
+        :param online: bool, the client is connected to the peer, None to keep it
+
+    Returns:
+        Method returns the id of the local record
+    """
+
+    address = '@{}:{}'.format(node, client_id)
+    local_id = federation_clients.get((node, client_id))
+    if local_id is None:
+        db, db_cursor = get_db()
+        client = db_cursor.execute('''SELECT "id" FROM "main"."clients" WHERE "address" = ?;''', (address,)).fetchall()
+        if client:
+            local_id = client[0][0]
+        else:
+            # No credential, nobody can log in as a client of a peer
+            local_id = db_write('''INSERT INTO "main"."clients"("address","name","code","valid","meta") VALUES (?,?,NULL,?,?);''',
+                                (address, '{}@{}'.format(name or '#' + str(client_id), node), 1 if online else 0,
+                                 json.dumps({'node': node, 'id': client_id}))).lastrowid
+            publish_client_change(local_id)
+        federation_clients[(node, client_id)] = local_id
+    if name is not None or online is not None:
+        client = get_client(local_id)
+        new_name = client[4] if name is None else '{}@{}'.format(name, node)
+        new_valid = client[3] if online is None else (1 if online else 0)
+        if new_name != client[4] or new_valid != client[3]:
+            db_write('''UPDATE "main"."clients" SET "name"=?, "valid"=? WHERE "_rowid_"=?;''', (new_name, new_valid, local_id))
+            publish_client_change(local_id)
+    return local_id
+
+
+def federation_presence(client):
+    return {'type': 'presence', 'client': client[0], 'name': client_alias(client), 'online': bool(client[3])}
+
+
+def federation_forward(node, event):
+    """Relay an event of the local broker to the peers
+
+    Broadcast messages go to every peer, a DM goes to the peer of its recipient, and a change of a client record
+    is sent as the presence of the client. Messages and clients of peers are never relayed again.
+    A large message is relayed with its whole body, read from the blob store (the database only keeps its preview),
+    an attachment is relayed as its text, "##download" only finds it on this node.
+
+    Args:
+        :param node: FederationNode
+        :param event: dict, event of the broker
+    """
+
+    if event['type'] == 'client':
+        invalidate_client_cache(event['client_id'])
+        if event['client_id'] is None or event['client_id'] == 0:
+            return
+        client = get_client(event['client_id'])
+        if client is not None and not is_federated(client):
+            node.send(federation_presence(client))
+        return
+    message = event['message']
+    # Server notices, commands and hidden messages stay on this node
+    if message[1] == 0 or message[7] or message[3] == '#':
+        return
+    author = get_client(message[1])
+    if author is None or is_federated(author):
+        return
+    relay = {
+        'type': 'message',
+        'id': message[0],
+        'client': author[0],
+        'name': client_alias(author),
+        'time': message[2],
+        'content': message[3]
+    }
+    digest = large_message_blob(message)
+    if digest is not None and blob_store.exists(digest):
+        with open(blob_store.path(digest), 'rb') as body_file:
+            relay['content'] = body_file.read().decode()
+    if message[6] == MESSAGE_KIND_CHAT:
+        node.send(relay)
+    elif message[6] == MESSAGE_KIND_DM and message[5] is not None:
+        recipient = get_client(message[5])
+        if recipient is None or not is_federated(recipient):
+            return
+        peer_name, relay['recipient'] = recipient[1][1:].rsplit(':', 1)
+        relay['recipient'] = int(relay['recipient'])
+        node.send(relay, [peer_name])
+
+
+def federation_receive(node, events):
+    """Store the events of a peer
+
+    Messages of the clients of the peer are stored as messages of local records standing for them,
+    so they are delivered, listed and searched like local messages
 
-            # Check meta
-            if load_credential[3] is not None:
-                load_meta_data = json.loads(load_credential[3])
-                if 'mute' in load_meta_data and load_meta_data['mute'] > current_milli_time():
-                    remain_mute_time = int((load_meta_data['mute'] - current_milli_time()) / 1000)
-                    time.sleep(0.9)
-                    echo(cnn, 'YOU ARE NOT ALLOWED TO SEND MESSAGES IN {} SECONDS'.format(str(remain_mute_time)), {'message_id': message_id})
-                    continue
+    Args:
+        :param node: str, name of the peer
+        :param events: list, a batch of events
+    """
 
-            # Update nickname
-            nickname = load_credential[4]
+    for i, event in enumerate(events):
+        try:
+            if event['type'] == 'presence':
+                federation_client(node, event['client'], event['name'], event['online'])
+            elif event['type'] == 'message':
+                author = federation_client(node, event['client'], event['name'], True)
+                content, blob = federation_content(event['content'])
+                meta = {'origin': node, 'origin_id': event['id']}
+                if blob is not None:
+                    meta['file'] = blob
+                recipient_id = event.get('recipient')
+                kind = MESSAGE_KIND_CHAT if recipient_id is None else MESSAGE_KIND_DM
+                # The writer executes the batch in order, waiting for the last message covers the batch
+                durable = Durability != 'async' and i == len(events) - 1
+                db_write('''
+                         INSERT INTO "main"."messages"
+                         ("client", "time", "content", "meta", "recipient_id", "kind", "nosend", "client_msg_id", "blob")
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+                         (author, event['time'], content, json.dumps(meta), recipient_id, kind, 0, None, blob), durable, True)
+        except Exception as e:
+            log.error('FEDERATION', node=node, error=e)
 
-            # Detect if the received message is an instruction to the server
-            if len(request.strip()) > 2 and request[0] == '#':
-                message_time = current_milli_time()
-                message_content = request
-                cmd_meta_data = message_header
-                cmd_meta_data.update({'nosend': True})
-                
-                try:
-                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                    db_cursor.execute('''
-                                        INSERT INTO "main"."messages"
-                                        ("client", "time", "content", "meta")
-                                        VALUES (?, ?, ?, ?);''', (client_id, message_time, message_content, cmd_meta_data_dump))
-                    message_id = db_cursor.lastrowid
-                except Exception:
-                    echo(cnn, 'SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {'message_id': message_id})
-                    continue
-                db.commit()
-                if request[0:2] == '##' and request[2] != '#':
-                    # Session command
-                    request_cmd_session_fmt = request.lower()[2:].strip()
-                    user_cmd = ' '.join(filter(lambda x: x, request_cmd_session_fmt.split(' '))).split(' ')
-                    if user_cmd[0] == 'exit':
-                        print(client_address + ' Disconnected')
-                        db_cursor.execute('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (client_id,))
-                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'Success'}
-                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                        db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                        db.commit()
-                        cnn.close()
-                        return 0
-                    elif user_cmd[0] == 'welcome':
-                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'Success'}
-                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                        db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                        db.commit()
-                        echo(cnn, WelcomeMessage, {'message_id': message_id})
-                    elif len(user_cmd) > 1 and user_cmd[0] == 'nick':
-                        if user_cmd[1] == 'get':
-                            if use_nickname:
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': nickname}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, nickname, {'message_id': message_id})
-                            else:
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': '#NICKNAME NOT SET#'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, '#NICKNAME NOT SET#', {'message_id': message_id})
-                        elif len(user_cmd) > 2 and user_cmd[1] == 'set':
-                            new_nickname = request[request.lower().find(user_cmd[2]):]
-                            new_nickname = new_nickname.strip('#').strip('<').strip('>').strip(':')
-                            db_cursor.execute('''UPDATE "main"."clients" SET "name"=? WHERE "_rowid_"=?;''', (new_nickname, client_id,))
-                            message_time = current_milli_time()
-                            if use_nickname:
-                                client_alias = nickname
-                            else:
-                                client_alias = str(addr)
-                            message_content = client_alias + ' ==> ' + new_nickname
-                            db_cursor.execute('''
-                                                INSERT INTO "main"."messages"
-                                                ("client", "time", "content")
-                                                VALUES (?, ?, ?);''', (0, message_time, message_content))
-                            db.commit()
-                            use_nickname = True
-                            cmd_meta_data['command_result'] = {'code': 0, 'message': 'NICKNAME SET'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'NICKNAME SET', {'message_id': message_id})
-                        else:
-                            cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                    elif len(user_cmd) > 2 and user_cmd[0] == 'dm':
-                        meta_data = json.dumps({'to': user_cmd[1], 'dm': True})
-                        message_time = current_milli_time()
-                        message_content = request[request.lower().find(user_cmd[2]):]
-                        try:
-                            db_cursor.execute('''
-                                                INSERT INTO "main"."messages"
-                                                ("client", "time", "content", "meta")
-                                                VALUES (?, ?, ?, ?);''', (client_id, message_time, message_content, meta_data))
-                            cmd_meta_data['command_result'] = {'code': 0, 'message': 'MESSAGE SENT'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'MESSAGE SENT', {'message_id': message_id})
-                        except Exception:
-                            echo(cnn, 'SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {'message_id': message_id})
-                            continue
-                        db.commit()
-                    elif user_cmd[0] == 'su' and (len(user_cmd) > 2 or (len(user_cmd) > 1 and client_id == 0)):
-                        try:
-                            new_uid = int(user_cmd[1])
-                            load_credential = db_cursor.execute('''SELECT "id", "code"
-                                                                    FROM "main"."clients"
-                                                                    WHERE "id" = ?''', (new_uid,)).fetchall()[0]
-                            if client_id == 0 or (user_cmd[2] == load_credential[1]):
-                                if new_uid == 0:
-                                    AllowAdminCommands = True
-                                    AllowNickname = True
-                                meta_data = json.dumps({'to': '#'+str(client_id),
-                                                         'su': True,
-                                                         'id': new_uid
-                                                         })
-                                try:
-                                    message_time = current_milli_time()
-                                    message_content = '#SU'
-                                    db_cursor.execute('''
-                                                        INSERT INTO "main"."messages"
-                                                        ("client", "time", "content", "meta")
-                                                        VALUES (?, ?, ?, ?);''',
-                                                      (client_id, message_time, message_content, meta_data))
-                                    db_cursor.execute('''UPDATE "main"."clients" SET "address"=? WHERE "_rowid_"=?;''',
-                                                      (addr[0]+','+str(addr[1]), new_uid))
-                                except Exception:
-                                    echo(cnn, 'SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER', {'message_id': message_id})
-                                    continue
-                                db.commit()
-                                load_credential = db_cursor.execute('''SELECT "id", "name"
-                                                                                        FROM "main"."clients"
-                                                                                        WHERE "id" = ?''',
-                                                                    (new_uid,)).fetchall()[0]
-                                client_id = new_uid
-                                if load_credential[1] == '' or load_credential[1] is None:
-                                    use_nickname = False
-                                    nickname = ''
-                                else:
-                                    use_nickname = True
-                                    nickname = load_credential[1]
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': 'SU SUCCESS'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, 'Welcome!', {'message_id': message_id})
-                                continue
-                            else:
-                                cmd_meta_data['command_result'] = {'code': 2, 'message': 'SU FAILURE'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, 'SU FAILURE!', {'message_id': message_id})
-                                continue
-                        except Exception:
-                            cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'CLIENT NOT FOUND', {'message_id': message_id})
-                    else:
-                        cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
-                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                        db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                        db.commit()
-                        echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                    continue
 
-                elif len(request.strip()) > 3 and request[0:3] == '###':
-                    # Server command
-                    if not AllowAdminCommands:
-                        cmd_meta_data['command_result'] = {'code': 3, 'message': 'INVALID COMMAND: ADMIN COMMANDS NOT ALLOWED'}
-                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                        db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                        db.commit()
-                        echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                        continue
-                    request_cmd_server_fmt = request.lower()[3:].strip()
-                    user_cmd = ' '.join(filter(lambda x: x, request_cmd_server_fmt.split(' '))).split(' ')
-                    print('SERVER COMMAND')
-                    print(user_cmd)
-                    if len(user_cmd) > 2 and user_cmd[0] == 'pause':
-                        try:
-                            pause_time = int(user_cmd[1])
-                            resume_time = int(user_cmd[2])
-                        except Exception:
-                            cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                            continue
-                        message_time = current_milli_time()
-                        if resume_time > 0:
-                            message_content = 'THE SERVER WILL PAUSE AFTER {} SECONDS AND WILL REMAIN UNAVAILABLE FOR {} SECONDS'.format(pause_time, resume_time)
-                        else:
-                            message_content = 'THE SERVER WILL PAUSE AFTER {} SECONDS AND WILL REMAIN UNAVAILABLE UNTIL IT IS RESUMED'.format(pause_time)
-                        db_cursor.execute('''
-                                            INSERT INTO "main"."messages"
-                                            ("client", "time", "content")
-                                            VALUES (?, ?, ?);''', (0, message_time, message_content))
-                        db.commit()
-                        time.sleep(pause_time)
-                        message_time = current_milli_time()
-                        message_content = 'SERVER PAUSED'.format(pause_time, resume_time)
-                        db_cursor.execute('''
-                                            INSERT INTO "main"."messages"
-                                            ("client", "time", "content")
-                                            VALUES (?, ?, ?);''', (0, message_time, message_content))
-                        db.commit()
-                        cmd_meta_data['command_result'] = {'code': 0, 'message': 'SERVER PAUSED'}
-                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                        db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                        db.commit()
-                        db_cursor.execute('''UPDATE "main"."clients" SET "valid"=1 WHERE "_rowid_"=?;''', (client_id,))
-                        print('SERVER PAUSED')
-                        if resume_time > 0:
-                            time.sleep(resume_time)
-                        else:
-                            while request != 'resume':
-                                echo(cnn, 'SERVER PAUSED, SEND "RESUME" TO RESUME', {'message_id': message_id})
-                                try:
-                                    request = cnn.recv(4096).decode().lower()
-                                except Exception:
-                                    print(client_address + ' Disconnected (Unexpected)')
-                                    while True:
-                                        print('WARN: SERVICE TERMINATED!')
-                                        message_time = current_milli_time()
-                                        message_content = 'SERVICE TERMINATED, YOU MAY DISCONNECT NOW'.format(pause_time, resume_time)
-                                        db_cursor.execute('''
-                                                            INSERT INTO "main"."messages"
-                                                            ("client", "time", "content")
-                                                            VALUES (?, ?, ?);''', (0, message_time, message_content))
-                                        db.commit()
-                                        db_cursor.execute('''UPDATE "main"."clients" SET "valid"=1 WHERE "_rowid_"=?;''', (client_id,))
-                                        time.sleep(60)
-                        db.commit()
-                        message_time = current_milli_time()
-                        message_content = 'SERVER RESUMED'.format(pause_time, resume_time)
-                        db_cursor.execute('''
-                                            INSERT INTO "main"."messages"
-                                            ("client", "time", "content")
-                                            VALUES (?, ?, ?);''', (0, message_time, message_content))
-                        db.commit()
-                        print('SERVER RESUMED')
-                        echo(cnn, 'SERVER RESUMED', {'message_id': message_id})
-                        continue
-                    elif user_cmd[0] == 'kick' and len(user_cmd) > 1:
-                        target_client_id = user_cmd[1]
-                        print(target_client_id)
-                        try:
-                            db_cursor.execute('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (target_client_id,))
-                            db.commit()
-                            if db_cursor.rowcount > 0:
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': 'KICKED'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, 'KICKED', {'message_id': message_id})
-                            else:
-                                cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, 'CLIENT NOT FOUND', {'message_id': message_id})
-                        except Exception:
-                            cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                        continue
-                    elif user_cmd[0] == 'mute' and len(user_cmd) > 2:
-                        target_client_id = user_cmd[1]
-                        try:
-                            load_credential = db_cursor.execute('''SELECT "id", "code", "valid", "meta", "name"
-                                        FROM "main"."clients"
-                                        WHERE "id" = ?''', (target_client_id,)).fetchall()[0]
-                            meta_data = json.loads(load_credential[3])
-                            mute_time = int(user_cmd[2])*1000
-                            meta_data['mute'] = current_milli_time() + mute_time
-                            meta_data_dump = json.dumps(meta_data)
-                            try:
-                                db_cursor.execute('''UPDATE "main"."clients" SET "meta"=? WHERE "_rowid_"=?;''',
-                                                  (meta_data_dump, target_client_id,))
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': 'MUTE'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, 'MUTE', {'message_id': message_id})
-                            except Exception:
-                                cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data, message_id,))
-                                db.commit()
-                                echo(cnn, 'CLIENT NOT FOUND', {'message_id': message_id})
-                            continue
-                        except Exception:
-                            cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                            continue
-                    elif user_cmd[0] == 'unmute' and len(user_cmd) > 1:
-                        target_client_id = user_cmd[1]
-                        try:
-                            load_meta = db_cursor.execute('''SELECT "id", "address", "name", "code", "valid", "meta" FROM "main"."clients" WHERE "id" = ?''', (target_client_id,)).fetchall()[0]
-                            print(load_meta)
-                            meta_data = json.loads(load_meta[5])
-                            meta_data['mute'] = current_milli_time()
-                            meta_data_dump = json.dumps(meta_data)
-                            db_cursor.execute('''UPDATE "main"."clients" SET "meta"=? WHERE "_rowid_"=?;''',
-                                              (meta_data_dump, target_client_id,))
-                            db.commit()
-                            cmd_meta_data['command_result'] = {'code': 0, 'message': 'UNMUTE'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'UNMUTE', {'message_id': message_id})
-                        except Exception as e:
-                            print(e)
-                            cmd_meta_data['command_result'] = {'code': 2, 'message': 'CLIENT NOT FOUND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'CLIENT NOT FOUND', {'message_id': message_id})
-                    elif len(user_cmd) > 2 and user_cmd[0] == 'get':
-                        if user_cmd[1] == 'id':
-                            target_name = user_cmd[2]
-                            target_style = '%' + target_name + '%'
-                            target_list = db_cursor.execute('''SELECT "id", "address", "name"
-                                                                FROM "clients"
-                                                                WHERE "valid" = 1 AND ("address" LIKE ? OR "name" LIKE ?);
-                                                            ''', (target_style, target_style)).fetchall()
-                            target_str = 'RES:\n'
-                            for item in target_list:
-                                target_str = target_str + str(item) + '\n'
-                            cmd_meta_data['command_result'] = {'code': 0, 'message': target_str.strip('\n')}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, target_str.strip('\n'), {'message_id': message_id})
-                            continue
-                        elif user_cmd[1] == 'cdt':
-                            try:
-                                target_client_id = int(user_cmd[2])
-                                if target_client_id == 0:
-                                    cmd_meta_data['command_result'] = {'code': 2, 'message': 'OPERATION NOT ALLOWED'}
-                                    cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                    db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                    db.commit()
-                                    echo(cnn, 'OPERATION NOT ALLOWED', {'message_id': message_id})
-                                    continue
-                                load_credential = db_cursor.execute('''SELECT "id", "code"
-                                                                        FROM "main"."clients"
-                                                                        WHERE "id" = ?''',
-                                                                    (target_client_id,)).fetchall()[0]
-                                target_str = 'ID:\n' + str(load_credential[0]) + '\nAccess Code:\n' + load_credential[1]
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': target_str}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, target_str, {'message_id': message_id})
-                                continue
-                            except Exception as e:
-                                cmd_meta_data['command_result'] = {'code': 2, 'message': 'INVALID COMMAND: ' + str(e)}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                echo(cnn, 'INVALID COMMAND: ' + str(e), {'message_id': message_id})
-                                continue
-                        else:
-                            cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, 'INVALID COMMAND', {'message_id': message_id})
-                    elif len(user_cmd) > 2 and user_cmd[0] == 'block':
-                        pass
-                    elif user_cmd[0] == 'dbcmd' and len(user_cmd) > 1:
-                        try:
-                            sql = request[request.lower().find(user_cmd[1]):]
-                            print(sql)
-                            res = json.dumps(db_cursor.execute(sql).fetchall())
-                            print('QUERY END')
-                            echo(cnn, res, {'message_id': message_id})
-                            if len(res) > 8192:
-                                message_dump_file = './MESSAGE_DUMP/MESSAGE_DUMP_' + str(message_id) + '_' + str(current_milli_time()) + '.txt'
-                                with open(message_dump_file, 'w') as dump_file:
-                                    dump_file.write(res)
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': 'RESULT TOO LONG', 'meta': {'file': os.path.abspath(message_dump_file)}}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                print(res[:64] + '...' + res[-64:])
-                                print('Result too long, dumped to ' + message_dump_file)
-                            else:
-                                cmd_meta_data['command_result'] = {'code': 0, 'message': res}
-                                cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                                db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                                db.commit()
-                                print(res)
-                        except Exception as e:
-                            db.commit()
-                            cmd_meta_data['command_result'] = {'code': 2, 'message': str(e)}
-                            cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                            db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                            db.commit()
-                            echo(cnn, str(e), {'message_id': message_id})
-                        continue
-                    else:
-                        cmd_meta_data['command_result'] = {'code': 1, 'message': 'INVALID COMMAND'}
-                        cmd_meta_data_dump = json.dumps(cmd_meta_data)
-                        db_cursor.execute('''UPDATE "main"."messages" SET "meta"=? WHERE "_rowid_"=?;''', (cmd_meta_data_dump, message_id,))
-                        db.commit()
-                        echo(cnn, 'INVALID COMMAND')
-                    continue
+def federation_content(content):
+    """Get the content and the blob of a message relayed by a peer
 
-            '''
-            If the client is disconnected, the server may receive an empty message indefinitely.
-            If an empty message is received, a message is sent to the client receiver to confirm if that client is still alive.
-            '''
-            if request == '':
-                time.sleep(0.5)
-                cnn.send('ACTIVE'.encode())
-                continue
+    A body over LargeMessageSize bytes is kept in the blob store, like the large message of a client
 
-            # Send message
-            message_time = current_milli_time()
-            message_content = request
-            meta_data = json.dumps(message_header)
-            try:
-                db_cursor.execute('''
-                                    INSERT INTO "main"."messages"
-                                    ("client", "time", "content", "meta")
-                                    VALUES (?, ?, ?, ?);''', (client_id, message_time, message_content, meta_data))
-                message_id = db_cursor.lastrowid
-                db.commit()
-            except Exception as e:
-                db.rollback()
-                echo(cnn, 'SERVER NOT AVAILABLE, PLEASE TRY AGAIN LATER')
-                continue
+    Returns:
+        Method returns a tuple (content, blob), blob is the sha256 of the body, None if it is stored in the database
+    """
 
+    body = content.encode()
+    if len(body) <= LargeMessageSize:
+        return content, None
+    digest = hashlib.sha256(body).hexdigest()
+    spool = blob_store.spool()
+    spool.write(body)
+    blob_store.commit(spool, digest)
+    return body[:LARGE_MESSAGE_PREVIEW].decode(errors='ignore') + ' ...', digest
 
-            # The received message is returned to the client receiver to help the client confirm that the message has
-            # been delivered.
-            echo(cnn, request, {'message_id': message_id})
-            errcount = 0
-            time.sleep(0.1)
 
+def federation_link(node, peer_name, linked):
+    """Send the presence of the local clients to a peer when its link is up, mark its clients offline when it is down"""
 
-        except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
-            print(client_address + ' Disconnected (Unexpected)')
-            db_cursor.execute('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (client_id,))
-            db.commit()
-            cnn.close()
-            return 0
-        except Exception as e:
-            print(e)
-            echo(cnn, 'ACTIVE')
+    db, db_cursor = get_db()
+    if linked:
+        clients = db_cursor.execute('''SELECT "id", "address", "code", "valid", "name", "mute_until" FROM "main"."clients"
+                                       WHERE "valid" = 1 AND "id" != 0 AND "address" NOT LIKE '@%';''').fetchall()
+        for client in clients:
+            node.send(federation_presence(client), [peer_name])
+        return
+    prefix = '@' + peer_name + ':'
+    db_write('''UPDATE "main"."clients" SET "valid"=0 WHERE substr("address", 1, ?) = ? AND "valid"=1;''',
+             (len(prefix), prefix))
+    publish_client_change(None)
+
+
+def federation_launcher(listener):
+    """federation launcher
+
+    This method links this node to its peers and relays the events of the local broker to them
+    """
+
+    node = FederationNode(NodeName, listener, Peers, FederationKey,
+                          on_events=federation_receive, on_link=lambda peer_name, linked: federation_link(node, peer_name, linked),
+                          log=log)
+    threading.Thread(target=node.serve_forever, daemon=True).start()
+    while True:
+        try:
+            subscriber = BrokerClient(BrokerAddress, subscribe=True, types=['message', 'client'])
+            enable_client_cache()
+            while True:
+                federation_forward(node, subscriber.recv())
+        except (OSError, ValueError) as e:
+            log.error('FEDERATION', error=e)
+            disable_client_cache()
             time.sleep(1)
-            errcount += 1
-            if errcount >= 10:
-                print(client_address + ' Disconnected (Unexpected)')
-                db_cursor.execute('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (client_id,))
-                db.commit()
-                cnn.close()
-                return 0
-            continue
 
 
-def receiver_launcher():
-    """receiver launcher
+def start_federation(runner):
+    """Start the federation launcher if the node has peers
 
-    This method is used to create a child process that communicates with the receiver (client)
+    Args:
+        :param runner: threading.Thread or multiprocessing.Process
     """
 
-    rxs = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    rxs.bind((HOST, rx_port))
-    rxs.listen(5)
+    if not FederationPort or not Peers:
+        return
+    if not UseBroker:
+        log.warning('FEDERATION NEEDS THE BROKER')
+        return
+    runner(target=federation_launcher, args=(listen_socket([HOST, FederationPort]),), daemon=True).start()
+
+
+executor = None
+# Queues of the asyncio receivers by client id
+receiver_queues = {}
+
+
+async def async_main(worker_id=None, listeners=None):
+    """asyncio engine
+
+    Serve senders and receivers as coroutines on one event loop
+
+    Args:
+        :param worker_id: int, id of the worker if the engine runs in several workers (the writer and the broker
+            are run by the main process then), None if it runs alone
+        :param listeners: tuple, listening sockets (sender, receiver) shared by the workers,
+            None to listen on the ports (with SO_REUSEPORT if there are several workers)
+    """
+
+    global executor
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=ExecutorWorkers)
+    if worker_id is None:
+        threading.Thread(target=writer_launcher, args=(listen_socket(WriterAddress),), daemon=True).start()
+        if UseBroker:
+            threading.Thread(target=broker_launcher, args=(listen_socket(BrokerAddress),), daemon=True).start()
+        start_federation(threading.Thread)
+    if UseBroker:
+        delivery = broker_listener()
+    else:
+        delivery = message_poller()
+    sender_handler = admission_handler(sender_main_async, sender_admission, True)
+    receiver_handler = admission_handler(receiver_main_async, receiver_admission, False)
+    if listeners is not None:
+        sender_server = await asyncio.start_server(sender_handler, sock=listeners[0])
+        receiver_server = await asyncio.start_server(receiver_handler, sock=listeners[1])
+    else:
+        reuse_port = True if worker_id is not None else None
+        sender_server = await asyncio.start_server(
+            sender_handler, HOST, port, backlog=ListenBacklog, reuse_port=reuse_port)
+        receiver_server = await asyncio.start_server(
+            receiver_handler, HOST, rx_port, backlog=ListenBacklog, reuse_port=reuse_port)
+
+    if worker_id is None:
+        print('Server started!')
+    else:
+        print('Worker ' + str(worker_id) + ' started!')
+
+    await asyncio.gather(sender_server.serve_forever(), receiver_server.serve_forever(), delivery)
+
+
+def worker_main(worker_id, listeners=None):
+    """asyncio worker
+
+    This method runs the asyncio engine in a worker process
+    """
+
+    asyncio.run(async_main(worker_id, listeners))
+
+
+def workers_main():
+    """asyncio engine in several workers
+
+    Start Workers processes running the asyncio engine, a worker that exits is started again
+    """
+
+    if UseBroker:
+        brm = multiprocessing.Process(target=broker_launcher, args=(listen_socket(BrokerAddress),))
+        brm.start()
+    wrm = multiprocessing.Process(target=writer_launcher, args=(listen_socket(WriterAddress),))
+    wrm.start()
+    start_federation(multiprocessing.Process)
+
+    listeners = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        # Without SO_REUSEPORT the workers accept on the same listening sockets
+        listeners = []
+        for listen_port in (port, rx_port):
+            ls = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            ls.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            ls.bind((HOST, listen_port))
+            ls.listen(ListenBacklog)
+            listeners.append(ls)
+
+    workers = {}
+    for worker_id in range(Workers):
+        workers[worker_id] = multiprocessing.Process(target=worker_main, args=(worker_id, listeners))
+        workers[worker_id].start()
+
+    print('Server started!')
+
+    while True:
+        multiprocessing.connection.wait([m.sentinel for m in workers.values()])
+        for worker_id, m in list(workers.items()):
+            if m.is_alive():
+                continue
+            m.join()
+            print('Worker ' + str(worker_id) + ' exited (' + str(m.exitcode) + '), restarting')
+            time.sleep(1)
+            workers[worker_id] = multiprocessing.Process(target=worker_main, args=(worker_id, listeners))
+            workers[worker_id].start()
+
+
+def process_main():
+    """process engine
+
+    Fork a process for every sender and receiver connection
+    """
+
+    if UseBroker:
+        brm = multiprocessing.Process(target=broker_launcher, args=(listen_socket(BrokerAddress),))
+        brm.start()
+    wrm = multiprocessing.Process(target=writer_launcher, args=(listen_socket(WriterAddress),))
+    wrm.start()
+    start_federation(multiprocessing.Process)
+
+    # Create an object for establishing socket communication
+    rxm = multiprocessing.Process(target=receiver_launcher, args=())
+    rxm.start()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((HOST, port))
+    s.listen(ListenBacklog)
+    # Sender processes by the address they serve
+    connections = {}
+
+    print('Server started!')
 
     while True:
         try:
-            # Listening port, waiting for connection (for receivers)
-            rxcnn, addr = rxs.accept()
-            m = multiprocessing.Process(target=receiver_main, args=(
-                rxcnn,
+            # Listening port, waiting for connection
+            cnn, addr = s.accept()
+            reap_connections(connections, sender_admission)
+            reason = sender_admission.admit(addr[0])
+            if reason is not None:
+                refuse_connection(cnn, addr, reason, True)
+                continue
+            m = multiprocessing.Process(target=sender_main, args=(
+                cnn,
                 addr,
             ))
             # Enable daemon
             m.daemon = True
             # Initiate a subprocess
             m.start()
+            cnn.close()
+            connections[m] = addr[0]
 
         except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
             pass
         except Exception as e:
-            print(e)
+            log.error('SENDER ACCEPT', error=e)
             continue
 
 
-def receiver_main(rxcnn, addr):
-    """receiver communication
+# Messages of the prefork channels are JSON objects, a handed over connection carries its file descriptor
+PREFORK_MESSAGE_SIZE = 1024
+PREFORK_SENDER = 'sender'
+PREFORK_RECEIVER = 'receiver'
 
-    This method is used to communicate with the receiver (client)
 
-    Args:
-        :param rxcnn: socket object, for socket communication
-        :param addr: tuple, store the client address
+class PreforkWorker(object):
+    """A worker process of the prefork engine as seen by the acceptor"""
 
-    Returns:
-        Method returns an integer
+    def __init__(self):
+        self.channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.process = multiprocessing.Process(target=prefork_worker, args=(worker_channel,))
+        self.process.daemon = True
+        self.process.start()
+        worker_channel.close()
+        # Open connections as (kind, address)
+        self.sessions = []
+        # Connections handed over, the worker retires after MaxSessionsPerWorker
+        self.handed = 0
+        self.retiring = False
 
-        Normal exit returns 0
-        Validation fails returns 1
-    """
 
-    errcount = 0
-    client_address = str(addr)
+def prefork_worker(channel):
+    """prefork worker
 
-    print(client_address + ' RX Connected')
-    # Receive credential from the client
-    rxcnn.send(json.dumps(server_info).encode())
-    client_data = json.loads(rxcnn.recv(1024).decode())
+    This method serves the connections handed over by the acceptor, every connection on its own thread.
+    After MaxSessionsPerWorker connections the worker exits once the ones it serves are closed,
+    the acceptor stops handing connections over to it at the same count.
+    """
 
-    client_id = client_data['id']
-    client_credential = client_data['code']
+    lock = threading.Lock()
+    sessions = []
+    served = 0
+    while not MaxSessionsPerWorker or served < MaxSessionsPerWorker:
+        try:
+            data, fds, flags, addr = socket.recv_fds(channel, PREFORK_MESSAGE_SIZE, 1)
+        except OSError:
+            break
+        if not data:
+            # The acceptor is gone
+            break
+        message = json.loads(data.decode())
+        cnn = socket.socket(fileno=fds[0])
+        session = threading.Thread(target=prefork_session, args=(channel, lock, message['kind'], cnn,
+                                                                 tuple(message['addr'])), daemon=True)
+        session.start()
+        sessions = [session for session in sessions if session.is_alive()] + [session]
+        served += 1
+    for session in sessions:
+        session.join()
+    channel.close()
+
+
+def prefork_session(channel, lock, kind, cnn, addr):
+    """Serve a connection in a prefork worker and tell the acceptor when it is closed"""
 
-    # Validate credentials
     try:
-        load_credential = db_cursor.execute('''SELECT "id", "address", "code", "valid"
-                                                FROM "main"."clients"
-                                                WHERE "id" = ?''', (client_id,)).fetchall()[0]
-        if not ((load_credential[2] == client_credential) and load_credential[3] and (
-                load_credential[1].split(',')[0] == addr[0])):
-            db_cursor.execute('''UPDATE "main"."clients" SET "valid"=0 WHERE "_rowid_"=?;''', (client_id,))
-            db.commit()
-            print(client_address + ' RX Rejected (Invalid Credential)')
-            echo(rxcnn, 'Invalid Credential')
-            rxcnn.close()
-            return 1
-    except:
-        print(client_address + ' RX Rejected (Invalid Credential)')
-        echo(rxcnn, 'Invalid Credential')
-        rxcnn.close()
-        return 1
+        if kind == PREFORK_SENDER:
+            sender_main(cnn, addr)
+        else:
+            receiver_main(cnn, addr)
+    except SystemExit:
+        pass
+    except Exception as e:
+        log.error('PREFORK CONNECTION', client=str(addr), error=e)
+    finally:
+        cnn.close()
+        try:
+            with lock:
+                channel.send(json.dumps({'op': 'closed', 'kind': kind, 'address': addr[0]}).encode())
+        except OSError:
+            pass
 
-    # Send welcome message
-    # rxcnn.send(WelcomeMessage.encode())
-    echo(rxcnn, WelcomeMessage)
 
-    # Create a loop to send messages
-    message = []
-    try:
-        message = db_cursor.execute('''SELECT "id", "client", "time", "content", "meta"
-                                FROM messages ORDER BY id DESC LIMIT 1;''').fetchall()[0]
-        temp_message_id = message[0]
-        message_id = temp_message_id
-    except:
-        temp_message_id = 0
-        message_id = temp_message_id
+def prefork_main():
+    """prefork engine
+
+    Hand the accepted connections over to a pool of PreforkWorkers long-lived worker processes,
+    a retired worker is replaced by a new one
+    """
+
+    if UseBroker:
+        brm = multiprocessing.Process(target=broker_launcher, args=(listen_socket(BrokerAddress),))
+        brm.start()
+    wrm = multiprocessing.Process(target=writer_launcher, args=(listen_socket(WriterAddress),))
+    wrm.start()
+    start_federation(multiprocessing.Process)
+
+    selector = selectors.DefaultSelector()
+    admissions = {PREFORK_SENDER: sender_admission, PREFORK_RECEIVER: receiver_admission}
+    for kind, listen_port in ((PREFORK_SENDER, port), (PREFORK_RECEIVER, rx_port)):
+        ls = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        ls.bind((HOST, listen_port))
+        ls.listen(ListenBacklog)
+        selector.register(ls, selectors.EVENT_READ, kind)
+
+    workers = []
+
+    def start_worker():
+        worker = PreforkWorker()
+        workers.append(worker)
+        selector.register(worker.channel, selectors.EVENT_READ, worker)
+
+    for i in range(PreforkWorkers):
+        start_worker()
+
+    print('Server started!')
+
     while True:
-        try:
-            # Wait until a new message is detected
-            while temp_message_id == message_id:
-                time.sleep(0.05)
-                message = db_cursor.execute('''SELECT "id", "client", "time", "content", "meta"
-                                                FROM messages ORDER BY id DESC LIMIT 1;''').fetchall()[0]
-                message_id = message[0]
-            temp_message_id = message_id
-            client = db_cursor.execute('''SELECT "id", "address", "name"
-                                            FROM clients WHERE "id"=?;''', (message[1],)).fetchall()[0]
-            # Validate credentials
+        for key, events in selector.select():
             try:
-                load_credential = db_cursor.execute('''SELECT "id", "address", "code", "valid", "name"
-                                                        FROM "main"."clients"
-                                                        WHERE "id" = ?''', (client_id,)).fetchall()[0]
-                if not ((load_credential[2] == client_credential) and load_credential[3] and (
-                        load_credential[1].split(',')[0] == addr[0])):
-                    print(client_address + ' RX Rejected (Invalid Credential)')
-                    echo(rxcnn, 'Invalid Credential')
-                    rxcnn.close()
-                    return 1
-            except:
-                print(client_address + ' RX Rejected (Invalid Credential)')
-                echo(rxcnn, 'Invalid Credential')
-                rxcnn.close()
-                return 1
-
-            # Send message
-            message_content = message[3]
-            if message[4] is not None:
-                load_meta = json.loads(message[4])
-                if 'to' in load_meta:
-                    if str(load_meta['to']) in ['#'+str(client_id), str(load_credential[4]).lower()] or message[1] == client_id:
-                        if 'dm' in load_meta and load_meta['dm'] == True:
-                            if message_content == '#':
-                                continue
-                            if client[2] == "":
-                                client_alias = str((client[1].split(',')[0], int(client[1].split(',')[1])))
-                            else:
-                                client_alias = client[2]
-                            message_send = '<DM> {} [#{}]: {}'.format(client_alias, client[0], message_content)
-                            # rxcnn.send(message_send.encode())
-                            echo(rxcnn, message_send)
-                            print('Local==>' + client_address + ' RX Send: ' + message_send)
-                            continue
-                        elif 'su' in load_meta:
-                            client_id = load_meta['id']
-                            load_credential = db_cursor.execute('''SELECT "id", "address", "code", "valid", "name"
-                                                                                    FROM "main"."clients"
-                                                                                    WHERE "id" = ?''',
-                                                                (client_id,)).fetchall()[0]
-                            client_credential = load_credential[2]
-                            echo(rxcnn, 'Identity change to ' + str(client_id))
-                            continue
-                        else:
-                            continue
-                    else:
+                if isinstance(key.data, PreforkWorker):
+                    worker = key.data
+                    data = worker.channel.recv(PREFORK_MESSAGE_SIZE)
+                    if not data:
+                        # The worker exited, its connections are closed
+                        selector.unregister(worker.channel)
+                        worker.channel.close()
+                        worker.process.join()
+                        for kind, address in worker.sessions:
+                            admissions[kind].release(address)
+                        workers.remove(worker)
+                        if not worker.retiring:
+                            start_worker()
                         continue
-                # Add before here
-                elif 'nosend' in load_meta and load_meta['nosend'] == True:
+                    message = json.loads(data.decode())
+                    if message['op'] == 'closed':
+                        worker.sessions.remove((message['kind'], message['address']))
+                        admissions[message['kind']].release(message['address'])
                     continue
 
-            if message_content == '#':
-                continue
-            if client[2] == "":
-                client_alias = str((client[1].split(',')[0], int(client[1].split(',')[1])))
-            else:
-                client_alias = client[2]
-            message_send = '{} [#{}]: {}'.format(client_alias, str(client[0]), message_content)
-            # rxcnn.send(message_send.encode())
-            echo(rxcnn, message_send)
-            errcount = 0
-            if len(message_send) > 80:
-                print('Local==>' + client_address + ' RX Send: ' + message_send[:40] + '...' + message_send[-40:])
-            else:
-                print('Local==>' + client_address + ' RX Send: ' + message_send)
+                kind = key.data
+                cnn, addr = key.fileobj.accept()
+                reason = admissions[kind].admit(addr[0])
+                if reason is not None:
+                    refuse_connection(cnn, addr, reason, kind == PREFORK_SENDER)
+                    continue
+                # The least busy worker that still takes connections
+                worker = min([worker for worker in workers if not worker.retiring], key=lambda worker: len(worker.sessions))
+                try:
+                    socket.send_fds(worker.channel, [json.dumps({'kind': kind, 'addr': addr[:2]}).encode()], [cnn.fileno()])
+                    worker.sessions.append((kind, addr[0]))
+                except OSError:
+                    admissions[kind].release(addr[0])
+                    raise
+                finally:
+                    cnn.close()
+                worker.handed += 1
+                if MaxSessionsPerWorker and worker.handed >= MaxSessionsPerWorker:
+                    # The worker takes no more connections, it exits once they are closed
+                    worker.retiring = True
+                    start_worker()
 
-        except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
-            print(client_address + ' RX Disconnected (Unexpected)')
-            rxcnn.close()
-            try:
-                db.commit()
-            except Exception:
+            except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
                 pass
-            return 0
-
-        except Exception as e:
-            print(e)
-            if errcount >= 3:
-                print(client_address + ' RX Disconnected (Unexpected)')
-                rxcnn.close()
-                try:
-                    db.commit()
-                except Exception:
-                    pass
-                return 0
-            errcount += 1
-            continue
+            except Exception as e:
+                log.error('PREFORK ACCEPT', error=e)
+                continue
 
 
 if __name__ == '__main__':
@@ -946,34 +3805,24 @@ if __name__ == '__main__':
     print('SU Access Code:')
     print(client_credential)
     db.commit()
+    # Archives written before the blob column get it, blob_visible looks them up by its index
+    upgrade_archives(ArchiveDir, SEARCH_ENABLED)
+    # From here on the writer process owns the only read-write connection
+    db.execute('PRAGMA journal_mode=WAL')
+    db.close()
 
-    # Create an object for establishing socket communication
-    rxm = multiprocessing.Process(target=receiver_launcher, args=())
-    rxm.start()
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((HOST, port))
-    s.listen(5)
-
-    sender_holder = Holder(0.2, 4, 0.2, 0.1)
-
-    print('Server started!')
-
-    while True:
-        try:
-            # Listening port, waiting for connection
-            cnn, addr = s.accept()
-            m = multiprocessing.Process(target=sender_main, args=(
-                cnn,
-                addr,
-            ))
-            # Enable daemon
-            m.daemon = True
-            # Initiate a subprocess
-            m.start()
-            # sender_holder.evoke()
+    # Created before any worker is forked, so that every process maps it
+    client_table = ClientTable(ClientTableSize)
+    update_client_table()
 
-        except (BrokenPipeError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
-            pass
-        except Exception as e:
-            print(e)
-            continue
+    try:
+        if Engine == 'asyncio' and Workers > 1:
+            workers_main()
+        elif Engine == 'asyncio':
+            asyncio.run(async_main())
+        elif Engine == 'prefork':
+            prefork_main()
+        else:
+            process_main()
+    finally:
+        client_table.close()
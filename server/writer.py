@@ -0,0 +1,237 @@
+"""
+Database writer of PyChat
+
+The writer process owns the only read-write connection of the database, handlers send their writes to it
+and read through their own read-only connections (the database is switched to WAL so reads never wait on writes).
+
+Write requests are queued and executed by one thread.
+They are committed in groups, when max_rows requests are pending or max_delay seconds have passed since the
+first one, whichever comes first, so that many messages share one fsync.
+A busy database (e.g. an admin tool holding a lock) is retried with backoff instead of failing the request.
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    from broker import connect_socket
+    from log import Log, LogSink
+except ImportError:
+    from .broker import connect_socket
+    from .log import Log, LogSink
+
+BUSY_RETRIES = 10
+BUSY_BACKOFF = 0.001
+BUSY_BACKOFF_MAX = 0.1
+
+
+def is_busy(e):
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+
+def retry_busy(func, *args):
+    """Call func, retry with exponential backoff while the database is busy"""
+
+    backoff = BUSY_BACKOFF
+    for attempt in range(BUSY_RETRIES):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == BUSY_RETRIES - 1:
+                raise
+            time.sleep(backoff)
+            backoff = min(backoff * 2, BUSY_BACKOFF_MAX)
+
+
+class WriteRequest(object):
+    def __init__(self, sql, params=(), on_commit=None):
+        self.sql = sql
+        self.params = params
+        self.on_commit = on_commit
+        self.lastrowid = None
+        self.rowcount = None
+        self.rows = None
+        self.error = None
+        self.executed = threading.Event()
+        self.committed = threading.Event()
+
+    def wait(self, durable=True, timeout=30):
+        """Wait for the request
+
+        Args:
+            :param durable: wait until the request is committed, otherwise only until it is executed
+            :param timeout: seconds
+        Returns:
+            Method returns the request itself, raises the error of the request if it failed
+        """
+
+        event = self.committed if durable else self.executed
+        if not event.wait(timeout):
+            raise TimeoutError('write request timed out')
+        if self.error is not None:
+            raise self.error
+        return self
+
+
+class GroupCommitWriter(object):
+    def __init__(self, database_file, max_rows=64, max_delay=0.005, log=None):
+        self.database_file = database_file
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.log = log if log is not None else Log(LogSink())
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params=(), on_commit=None):
+        """Queue a write request
+
+        Args:
+            :param sql: str, statement to execute
+            :param params: tuple, parameters of the statement
+            :param on_commit: callable, called with the request (on the writer thread) after it is committed
+        """
+
+        request = WriteRequest(sql, params, on_commit)
+        self.requests.put(request)
+        return request
+
+    def execute(self, sql, params=(), durable=True):
+        return self.submit(sql, params).wait(durable)
+
+    def run(self):
+        db = sqlite3.connect(self.database_file)
+        retry_busy(db.execute, 'PRAGMA journal_mode=WAL')
+        db_cursor = db.cursor()
+        while True:
+            group = [self.requests.get()]
+            deadline = time.monotonic() + self.max_delay
+            self.apply(db_cursor, group[0])
+            while len(group) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                self.apply(db_cursor, request)
+                group.append(request)
+            try:
+                retry_busy(db.commit)
+            except sqlite3.Error as e:
+                self.log.error('WRITER COMMIT FAILED', rows=len(group), error=e)
+                db.rollback()
+                for request in group:
+                    if request.error is None:
+                        request.error = e
+            for request in group:
+                request.committed.set()
+                if request.error is None and request.on_commit is not None:
+                    try:
+                        request.on_commit(request)
+                    except Exception as e:
+                        self.log.error('WRITER ON COMMIT', error=e)
+
+    def apply(self, db_cursor, request):
+        try:
+            retry_busy(db_cursor.execute, request.sql, request.params)
+            request.rows = db_cursor.fetchall()
+            request.lastrowid = db_cursor.lastrowid
+            request.rowcount = db_cursor.rowcount
+        except sqlite3.Error as e:
+            request.error = e
+        request.executed.set()
+
+
+class WriterServer(object):
+    """Serve write requests of other processes
+
+    Requests and replies are JSON objects, one per line, over a local Unix socket (TCP on platforms without AF_UNIX):
+
+        {"sql": ..., "params": [...], "durable": true, "publish": false}
+        {"lastrowid": ..., "rowcount": ..., "rows": [...], "error": null}
+
+    error is [exception class name, message] when the request failed.
+    """
+
+    def __init__(self, listener, writer, on_publish=None, log=None):
+        self.listener = listener
+        self.writer = writer
+        self.on_publish = on_publish
+        self.log = log if log is not None else Log(LogSink())
+
+    def serve_forever(self):
+        while True:
+            try:
+                cnn, addr = self.listener.accept()
+                threading.Thread(target=self.handle, args=(cnn,), daemon=True).start()
+            except OSError as e:
+                self.log.error('WRITER', error=e)
+
+    def handle(self, cnn):
+        """Serve requests of one connection until it is closed"""
+
+        cnn_file = cnn.makefile('rb')
+        try:
+            for line in cnn_file:
+                data = json.loads(line)
+                on_commit = self.on_publish if data.get('publish') else None
+                request = self.writer.submit(data['sql'], data.get('params', []), on_commit)
+                try:
+                    request.wait(data.get('durable', True))
+                except TimeoutError as e:
+                    request.error = e
+                reply = {
+                    'lastrowid': request.lastrowid,
+                    'rowcount': request.rowcount,
+                    'rows': request.rows,
+                    'error': None
+                }
+                if request.error is not None:
+                    reply['error'] = [type(request.error).__name__, str(request.error)]
+                cnn.sendall((json.dumps(reply, default=str) + '\n').encode())
+        except (OSError, ValueError):
+            pass
+        finally:
+            cnn.close()
+
+
+class WriterClient(object):
+    def __init__(self, address):
+        self.socket = connect_socket(address)
+        self.file = self.socket.makefile('rb')
+
+    def execute(self, sql, params=(), durable=True, publish=False):
+        """Run a write request on the writer process
+
+        Args:
+            :param sql: str, statement to execute
+            :param params: tuple, parameters of the statement
+            :param durable: wait until the request is committed, otherwise only until it is executed
+            :param publish: bool, publish the row as a message once it is committed
+        Returns:
+            Method returns a WriteRequest holding lastrowid, rowcount and rows,
+            raises the sqlite3 error of the request if it failed
+        """
+
+        data = {'sql': sql, 'params': list(params), 'durable': durable, 'publish': publish}
+        self.socket.sendall((json.dumps(data) + '\n').encode())
+        line = self.file.readline()
+        if not line:
+            raise ConnectionResetError('writer disconnected')
+        reply = json.loads(line)
+        request = WriteRequest(sql, params)
+        request.lastrowid = reply['lastrowid']
+        request.rowcount = reply['rowcount']
+        request.rows = reply['rows']
+        if reply['error'] is not None:
+            raise getattr(sqlite3, reply['error'][0], sqlite3.Error)(reply['error'][1])
+        return request
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
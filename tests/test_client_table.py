@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from client_table import MAX_PROBES, NAME_SIZE, ClientTable
+
+
+class ClientTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = ClientTable(8)
+
+    def tearDown(self):
+        self.table.close()
+
+    def test_read_write(self):
+        self.table.write(1, 1, None, 'alice')
+        self.table.write(2, 1, 1234, 'bob')
+        self.assertEqual(self.table.read(1), (1, None, 'alice'))
+        self.assertEqual(self.table.read(2), (1, 1234, 'bob'))
+        self.table.write(2, 1, None, 'bobby')
+        self.assertEqual(self.table.read(2), (1, None, 'bobby'))
+
+    def test_missing_client(self):
+        self.assertIsNone(self.table.read(3))
+        self.assertIsNone(self.table.read(0))
+        self.assertIsNone(self.table.read(-1))
+        self.assertIsNone(self.table.read(True))
+        self.assertIsNone(self.table.read('1'))
+
+    def test_name_not_stored(self):
+        self.table.write(1, 1, None, 'x' * (NAME_SIZE + 1))
+        self.table.write(2, 1, None, None)
+        self.assertEqual(self.table.read(1), (1, None, None))
+        self.assertEqual(self.table.read(2), (1, None, None))
+
+    def test_ids_past_capacity(self):
+        for client_id in range(1, 9):
+            self.table.write(client_id, 1, None, str(client_id))
+        # Ids share slots modulo the capacity, every one is found by its own id
+        self.table.write(3, 0, None, '3')
+        self.table.write(11, 1, 5, '11')
+        self.assertEqual(self.table.read(11), (1, 5, '11'))
+        self.assertIsNone(self.table.read(3))
+        for client_id in (1, 2, 4, 5, 6, 7, 8):
+            self.assertEqual(self.table.read(client_id), (1, None, str(client_id)))
+
+    def test_slot_reused_after_disconnect(self):
+        for client_id in range(1, 9):
+            self.table.write(client_id, 1, None, str(client_id))
+        # The table is full, the client is read from the database
+        self.table.write(100, 1, None, '100')
+        self.assertIsNone(self.table.read(100))
+        self.table.write(5, 0, None, '5')
+        self.table.write(100, 1, None, '100')
+        self.assertEqual(self.table.read(100), (1, None, '100'))
+        self.assertIsNone(self.table.read(5))
+
+    def test_invalid_client_not_added(self):
+        self.table.write(1, 0, None, 'alice')
+        self.assertIsNone(self.table.read(1))
+        # A client in the table keeps its slot when it becomes invalid, until another client takes it
+        self.table.write(2, 1, None, 'bob')
+        self.table.write(2, 0, 99, 'bob')
+        self.assertEqual(self.table.read(2), (0, 99, 'bob'))
+
+    def test_probes_are_bounded(self):
+        table = ClientTable(MAX_PROBES * 2)
+        try:
+            for client_id in range(1, MAX_PROBES + 1):
+                table.write(client_id * 2 * MAX_PROBES, 1, None, None)
+            # Every slot from the home slot of these ids on is taken by a valid client
+            table.write(MAX_PROBES * 2 * (MAX_PROBES + 1), 1, None, None)
+            self.assertIsNone(table.read(MAX_PROBES * 2 * (MAX_PROBES + 1)))
+        finally:
+            table.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
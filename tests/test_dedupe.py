@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from dedupe import CLIENT_MSG_ID_MAX_LENGTH, SentMessages, client_msg_id
+
+
+class ClientMsgIdTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(client_msg_id({'client_msg_id': 'abc'}), 'abc')
+        self.assertEqual(client_msg_id({'client_msg_id': 42}), '42')
+        self.assertEqual(client_msg_id({'client_msg_id': 'x' * CLIENT_MSG_ID_MAX_LENGTH}),
+                         'x' * CLIENT_MSG_ID_MAX_LENGTH)
+
+    def test_invalid(self):
+        self.assertIsNone(client_msg_id({}))
+        for msg_id in (None, True, False, 1.5, '', 'x' * (CLIENT_MSG_ID_MAX_LENGTH + 1), ['a'], {'a': 1}):
+            self.assertIsNone(client_msg_id({'client_msg_id': msg_id}), msg_id)
+
+
+class SentMessagesTest(unittest.TestCase):
+    def test_get_and_add(self):
+        sent = SentMessages(4)
+        self.assertIsNone(sent.get(1, 'a'))
+        sent.add(1, 'a', 10)
+        self.assertEqual(sent.get(1, 'a'), 10)
+        # Ids are per client
+        self.assertIsNone(sent.get(2, 'a'))
+
+    def test_window(self):
+        sent = SentMessages(2)
+        sent.add(1, 'a', 10)
+        sent.add(1, 'b', 11)
+        # A hit makes 'a' the most recently used, 'b' is evicted
+        self.assertEqual(sent.get(1, 'a'), 10)
+        sent.add(1, 'c', 12)
+        self.assertIsNone(sent.get(1, 'b'))
+        self.assertEqual(sent.get(1, 'a'), 10)
+        self.assertEqual(sent.get(1, 'c'), 12)
+
+    def test_lookup(self):
+        stored = {(1, 'old'): 5}
+        calls = []
+
+        def lookup(client_id, msg_id):
+            calls.append((client_id, msg_id))
+            return stored.get((client_id, msg_id))
+
+        sent = SentMessages(4, lookup)
+        self.assertEqual(sent.get(1, 'old'), 5)
+        # The hit is remembered, the database is not asked again
+        self.assertEqual(sent.get(1, 'old'), 5)
+        self.assertIsNone(sent.get(1, 'new'))
+        self.assertIsNone(sent.get(1, 'new'))
+        self.assertEqual(calls, [(1, 'old'), (1, 'new'), (1, 'new')])
+
+    def test_window_zero(self):
+        sent = SentMessages(0, lambda client_id, msg_id: 7 if msg_id == 'a' else None)
+        sent.add(1, 'b', 10)
+        self.assertIsNone(sent.get(1, 'b'))
+        self.assertEqual(sent.get(1, 'a'), 7)
+        self.assertEqual(len(sent.sent), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
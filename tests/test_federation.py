@@ -0,0 +1,98 @@
+import io
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from broker import listen_socket
+from federation import FederationNode
+from log import Log, LogSink
+
+
+def quiet_log():
+    return Log(LogSink(stream=io.StringIO()))
+
+
+def start_node(name, listener, peers, key, on_events=None, on_link=None):
+    node = FederationNode(name, listener, peers, key, on_events=on_events, on_link=on_link, log=quiet_log())
+    threading.Thread(target=node.serve_forever, daemon=True).start()
+    return node
+
+
+class HelloTest(unittest.TestCase):
+    def setUp(self):
+        self.node = FederationNode('a', None, {'b': ['127.0.0.1', 1]}, 'secret', log=quiet_log())
+
+    def test_hello_peer(self):
+        self.assertEqual(self.node.hello_peer({'hello': 'b', 'nonce': '00ff'}), 'b')
+        self.assertIsNone(self.node.hello_peer({'hello': 'b'}))
+        self.assertIsNone(self.node.hello_peer({'hello': 'b', 'nonce': ''}))
+        self.assertIsNone(self.node.hello_peer({'hello': 'b', 'nonce': 'f' * 1000}))
+        self.assertIsNone(self.node.hello_peer({'hello': 1, 'nonce': '00ff'}))
+        self.assertIsNone(self.node.hello_peer(['b']))
+        # The key of an older version is not a proof
+        self.assertIsNone(self.node.hello_peer({'hello': 'b', 'key': 'secret'}))
+
+    def test_proof(self):
+        other = FederationNode('b', None, {'a': ['127.0.0.1', 1]}, 'secret', log=quiet_log())
+        proof = other.proof('b', '01', '02')
+        self.assertNotIn('secret', proof)
+        self.assertTrue(self.node.check_proof({'proof': proof}, 'b', '01', '02'))
+        # Bound to the name of its sender and to both nonces
+        self.assertFalse(self.node.check_proof({'proof': proof}, 'a', '01', '02'))
+        self.assertFalse(self.node.check_proof({'proof': proof}, 'b', '02', '01'))
+        self.assertFalse(self.node.check_proof({'proof': proof}, 'b', '01', '03'))
+        self.assertFalse(self.node.check_proof({}, 'b', '01', '02'))
+        self.assertFalse(self.node.check_proof({'proof': 1}, 'b', '01', '02'))
+        self.assertFalse(self.node.check_proof(None, 'b', '01', '02'))
+
+    def test_proof_needs_the_key(self):
+        impostor = FederationNode('b', None, {'a': ['127.0.0.1', 1]}, 'guess', log=quiet_log())
+        self.assertFalse(self.node.check_proof({'proof': impostor.proof('b', '01', '02')}, 'b', '01', '02'))
+
+
+class LinkTest(unittest.TestCase):
+    def test_link_and_relay(self):
+        listeners = {name: listen_socket(['127.0.0.1', 0]) for name in ('a', 'b')}
+        peers = {name: list(listener.getsockname()) for name, listener in listeners.items()}
+        received = []
+        got_event = threading.Event()
+
+        def on_events(peer_name, events):
+            received.append((peer_name, events))
+            got_event.set()
+
+        linked = threading.Event()
+        node_a = start_node('a', listeners['a'], peers, 'secret', on_link=lambda peer_name, up: up and linked.set())
+        start_node('b', listeners['b'], peers, 'secret', on_events=on_events)
+        self.assertTrue(linked.wait(5))
+        node_a.send({'type': 'message', 'content': 'hello'})
+        self.assertTrue(got_event.wait(5))
+        self.assertEqual(received, [('a', [{'type': 'message', 'content': 'hello'}])])
+
+    def test_wrong_key_refused(self):
+        listeners = {name: listen_socket(['127.0.0.1', 0]) for name in ('a', 'b')}
+        peers = {name: list(listener.getsockname()) for name, listener in listeners.items()}
+        linked = threading.Event()
+        start_node('a', listeners['a'], peers, 'secret', on_link=lambda peer_name, up: up and linked.set())
+        start_node('b', listeners['b'], peers, 'other', on_link=lambda peer_name, up: up and linked.set())
+        self.assertFalse(linked.wait(1.5))
+
+    def test_key_never_sent(self):
+        listener = listen_socket(['127.0.0.1', 0])
+        start_node('b', listener, {'a': ['127.0.0.1', 1], 'b': list(listener.getsockname())}, 'secret')
+        cnn = socket.create_connection(listener.getsockname(), timeout=5)
+        try:
+            cnn.sendall(b'{"hello": "a", "nonce": "0011"}\n')
+            reply = cnn.makefile('rb').readline()
+        finally:
+            cnn.close()
+        self.assertIn(b'"proof"', reply)
+        self.assertNotIn(b'secret', reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+import mylibs
+from broker import BrokerClient, encode_event, listen_socket, read_payload
+from framing import (COMPRESSION_DEFLATE, COMPRESSION_DEFLATE_DICT, COMPRESSIONS, DEFLATE_DICTIONARY, Inflater,
+                     compress, decompress)
+
+TEXT = ('alice [#1]: what the server sends, with some repetition, what the server sends ' * 40).encode()
+
+
+class CompressTest(unittest.TestCase):
+    def test_round_trip(self):
+        for compression in COMPRESSIONS:
+            compressed = compress(TEXT, compression)
+            self.assertLess(len(compressed), len(TEXT))
+            self.assertEqual(decompress(compressed, compression), TEXT)
+
+    def test_does_not_shrink(self):
+        self.assertIsNone(compress(os.urandom(1024), COMPRESSION_DEFLATE))
+
+    def test_invalid_body(self):
+        with self.assertRaises(ValueError):
+            decompress(b'not deflate', COMPRESSION_DEFLATE)
+        # Compressed with the other dictionary
+        with self.assertRaises(ValueError):
+            decompress(compress(TEXT, COMPRESSION_DEFLATE_DICT), COMPRESSION_DEFLATE)
+
+    def test_same_dictionary_as_the_client(self):
+        self.assertEqual(DEFLATE_DICTIONARY, mylibs.DEFLATE_DICTIONARY)
+
+    def test_client_round_trip(self):
+        for compression in COMPRESSIONS:
+            header = {'size': len(TEXT)}
+            body = mylibs.compress_body(header, TEXT, compression)
+            self.assertEqual(header['encoding'], compression)
+            self.assertEqual(decompress(body, compression), TEXT)
+            header = {'size': len(TEXT), 'encoding': compression}
+            self.assertEqual(mylibs.decompress_body(header, compress(TEXT, compression)), TEXT)
+
+
+class InflaterTest(unittest.TestCase):
+    def test_chunked_write(self):
+        compressed = compress(TEXT, COMPRESSION_DEFLATE_DICT)
+        spool = io.BytesIO()
+        inflater = Inflater(spool, COMPRESSION_DEFLATE_DICT, chunk_size=100)
+        for i in range(0, len(compressed), 7):
+            inflater.write(compressed[i:i + 7])
+        self.assertEqual(spool.getvalue(), TEXT)
+        self.assertEqual(inflater.hexdigest(), hashlib.sha256(TEXT).hexdigest())
+
+    def test_truncated_body(self):
+        inflater = Inflater(None, COMPRESSION_DEFLATE)
+        inflater.write(compress(TEXT, COMPRESSION_DEFLATE)[:-4])
+        self.assertIsNone(inflater.hexdigest())
+
+    def test_max_size(self):
+        inflater = Inflater(None, COMPRESSION_DEFLATE, max_size=len(TEXT) - 1)
+        inflater.write(compress(TEXT, COMPRESSION_DEFLATE))
+        self.assertIsNone(inflater.hexdigest())
+        inflater = Inflater(None, COMPRESSION_DEFLATE, max_size=len(TEXT))
+        inflater.write(compress(TEXT, COMPRESSION_DEFLATE))
+        self.assertEqual(inflater.body, TEXT)
+
+    def test_unknown_compression(self):
+        inflater = Inflater(None, 'gzip')
+        inflater.write(b'anything')
+        self.assertIsNone(inflater.hexdigest())
+
+
+class BrokerPayloadTest(unittest.TestCase):
+    def test_encode_and_read(self):
+        payload = compress(TEXT, COMPRESSION_DEFLATE_DICT)
+        line = encode_event({'type': 'message', 'compressed': ['x', COMPRESSION_DEFLATE_DICT]}, payload)
+        stream = io.BytesIO(line + encode_event({'type': 'client'}))
+        event = json.loads(stream.readline())
+        self.assertEqual(event['payload'], len(payload))
+        self.assertEqual(read_payload(stream, event), payload)
+        self.assertEqual(json.loads(stream.readline()), {'type': 'client'})
+
+    def test_recv(self):
+        directory = tempfile.mkdtemp()
+        listener = listen_socket(os.path.join(directory, 'broker.sock'))
+        client = BrokerClient(os.path.join(directory, 'broker.sock'))
+        left, addr = listener.accept()
+        try:
+            payload = bytes(range(256)) + b'\n' * 10
+            left.sendall(encode_event({'type': 'message'}, payload) + encode_event({'type': 'client'}))
+            self.assertEqual(client.recv(), {'type': 'message', 'payload': payload})
+            self.assertEqual(client.recv(), {'type': 'client'})
+            left.sendall(encode_event({'type': 'message'}, payload)[:-1])
+            left.close()
+            with self.assertRaises(ConnectionResetError):
+                client.recv()
+        finally:
+            client.close()
+            listener.close()
+            os.remove(os.path.join(directory, 'broker.sock'))
+            os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()